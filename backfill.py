@@ -0,0 +1,132 @@
+"""
+Project: Air Partners
+
+Bulk backfill of historical MOD-PM data from exported QuantAQ .csv files.
+
+Every .csv file in a directory is read (only the needed columns, with fixed types), files of the same
+sensor are combined on their parsed timestamps, and the cleaned data is stored one month at a time in
+{year-month}/qaq_cleaned_data/{sensor}/, the same place the pipeline stores data downloaded from the
+API. Later runs of the pipeline for those months then load it instead of downloading it again.
+Sensors are processed in parallel, with the IEM wind data of each month fetched once for all of them.
+
+Usage: python3 backfill.py <csv directory> [workers]
+"""
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import data_analysis.quantaq_pipeline as qp
+from data_analysis.iem import fetch_data
+
+
+def _classify(path):
+    """
+    Works out which sensor a .csv file belongs to and whether it holds raw or final data.
+
+    :param path: (str) path to an exported .csv file
+    :returns: (serial number, True if the file holds raw data)
+    """
+    first = pd.read_csv(path, nrows=1)
+    # raw exports have the particle bin counts, final exports do not
+    raw = "bin0" in first.columns
+    sn = first["sn"].iloc[0] if "sn" in first.columns and not first.empty else Path(path).stem
+    return sn, raw
+
+
+def _month_bounds(timestamp):
+    """
+    :param timestamp: (pd.Timestamp) any time in a month
+    :returns: datetimes of the first day of the month and of the next month, like DataImporter uses
+    """
+    start = datetime(timestamp.year, timestamp.month, 1)
+    end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start, end
+
+
+def _months(paths):
+    """
+    :param paths: (list of str) .csv files with final data
+    :returns: set of the months (pd.Period) the files have data for, read from their timestamps only
+    """
+    months = set()
+    for path in paths:
+        timestamps = qp.read_sensor_csv(path, {"timestamp": qp.MOD_PM_FINAL_DTYPES["timestamp"]})["timestamp"]
+        months.update(timestamps.dt.tz_localize(None).dt.to_period("M").dropna().unique())
+    return months
+
+
+def backfill_sensor(sn, final_paths, raw_paths, smoothed=True, iem_dfs=None):
+    """
+    Reads, cleans and stores all .csv data of one sensor, one month at a time.
+
+    :param sn: (str) serial number of the sensor
+    :param final_paths: (list of str) .csv files with final data of the sensor
+    :param raw_paths: (list of str) .csv files with raw data of the sensor
+    :param smoothed: (optional bool) True if unrealistically large values should be removed
+    :param iem_dfs: (optional dict) IEM wind data of each month (pd.Period), months missing from it are fetched
+    :returns: list of the year-months that were stored
+    """
+    df_fin = pd.concat([qp.read_sensor_csv(p, qp.MOD_PM_FINAL_DTYPES) for p in final_paths], ignore_index=True)
+    df_raw = (pd.concat([qp.read_sensor_csv(p, qp.MOD_PM_RAW_DTYPES) for p in raw_paths], ignore_index=True)
+              if raw_paths else None)
+    # exports of overlapping date ranges repeat rows
+    df_fin = df_fin.drop_duplicates(subset="timestamp")
+    if df_raw is not None:
+        df_raw = df_raw.drop_duplicates(subset="timestamp")
+    df = qp.ModPMHandler.merge_csv_data(df_fin, df_raw)
+
+    stored = []
+    months = df["timestamp"].dt.tz_localize(None).dt.to_period("M")
+    for month, df_month in df.groupby(months):
+        start, end = _month_bounds(month.start_time)
+        handler = qp.ModPMHandler(start_date=start, end_date=end)
+        # wind data for the whole month, the same for every sensor
+        iem_df = iem_dfs[month] if iem_dfs and month in iem_dfs else fetch_data(start, end)
+        handler.from_csv_data(df_month.reset_index(drop=True), sn, smoothed=smoothed, iem_df=iem_df)
+        stored.append(handler.year_month)
+    return stored
+
+
+def backfill(csv_dir, workers=None, smoothed=True):
+    """
+    Backfills the data of every sensor with exported .csv files in a directory.
+
+    :param csv_dir: (str) directory containing exported QuantAQ .csv files
+    :param workers: (optional int) number of sensors processed at once, defaults to the number of CPUs
+    :param smoothed: (optional bool) True if unrealistically large values should be removed
+    :returns: dict of sensor keys and the year-months stored for them
+    """
+    sensors = {}
+    for path in sorted(Path(csv_dir).glob("*.csv")):
+        sn, raw = _classify(path)
+        final_paths, raw_paths = sensors.setdefault(sn, ([], []))
+        (raw_paths if raw else final_paths).append(str(path))
+    # data can only be stored for sensors that have final data
+    sensors = {sn: paths for sn, paths in sensors.items() if paths[0]}
+    print(f"Backfilling {len(sensors)} sensors from {csv_dir}")
+
+    # wind data is the same for every sensor, it is fetched once per month here and handed to the workers
+    months = {sn: _months(final_paths) for sn, (final_paths, _) in sensors.items()}
+    iem_dfs = {month: fetch_data(*_month_bounds(month.start_time)) for month in sorted(set().union(*months.values()))}
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = {pool.submit(backfill_sensor, sn, final_paths, raw_paths, smoothed,
+                               {month: iem_dfs[month] for month in months[sn]}): sn
+                   for sn, (final_paths, raw_paths) in sensors.items()}
+        for future in as_completed(futures):
+            sn = futures[future]
+            try:
+                results[sn] = future.result()
+                print(f"Finished {sn}: {', '.join(results[sn])}")
+            except Exception as e:
+                print(f"Could not backfill {sn}: {e}")
+    return results
+
+
+if __name__ == '__main__':
+    csv_dir = sys.argv[1]
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    backfill(csv_dir, workers=workers)
@@ -0,0 +1,114 @@
+"""
+Project: Air Partners
+Description: Import-time benchmark of the pipeline's entry points
+
+Every pipeline stage is a separate script, so each one pays for its imports before doing any work.
+This imports each entry point in a fresh interpreter (python -X importtime), from an empty directory
+so imports that need credentials fail, and reports how long the import took and which of its imports
+were the heaviest. Results are compared against baselines stored in benchmarks/baselines.json.
+
+Run from the top of the repository:
+
+    python3 -m benchmarks.import_time                  # compare against baselines
+    python3 -m benchmarks.import_time --save-baseline  # store new baselines
+"""
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+from benchmarks.run_benchmarks import REPO_DIR, BASELINE_PATH, MIN_SECONDS, load_baselines, save_baselines
+
+# modules the pipeline scripts start from
+MODULES = ['import_data', 'plots', 'report_generation', 'send_email', 'figure', 'backfill',
+           'utils.create_maps', 'pull_from_drive', 'service']
+BASELINE_KEY = 'imports'
+TOLERANCE = 0.25
+# heaviest imports listed per module
+TOP = 5
+
+
+def _parse(stderr, module):
+    """
+    Reads the output of python -X importtime.
+
+    :returns: seconds the module took to import, and (name, seconds) of its direct imports
+    """
+    total, children = None, []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        # names are indented two spaces per level under a single leading space
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if name.strip() == module and depth == 0:
+            total = int(cumulative) / 1e6
+        elif depth == 1:
+            children.append((name.strip(), int(cumulative) / 1e6))
+    return total, children
+
+
+def measure(module, repeat=3):
+    """
+    Imports a module in fresh interpreters.
+
+    :param module: (str) module to import
+    :param repeat: (optional int) number of imports, the fastest is kept
+    :returns: dict with the seconds of the import and its heaviest imports, or why it failed
+    """
+    env = {**os.environ, 'PYTHONPATH': str(REPO_DIR)}
+    best = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(repeat):
+            r = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                               cwd=tmp, env=env, capture_output=True, text=True)
+            if r.returncode != 0:
+                errors = [l for l in r.stderr.splitlines() if not l.startswith('import time:')]
+                return {'failed': errors[-1] if errors else f'exit status {r.returncode}'}
+            total, children = _parse(r.stderr, module)
+            if total is not None and (best is None or total < best[0]):
+                best = (total, children)
+    if best is None:
+        return {'failed': 'no import time reported'}
+    # imports appear under whichever module imported them first, so only the direct imports are listed
+    heaviest = sorted(best[1], key=lambda c: -c[1])[:TOP]
+    return {'seconds': round(best[0], 4), 'heaviest': [[name, round(s, 4)] for name, s in heaviest]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure how long the pipeline entry points take to import.')
+    parser.add_argument('--modules', default=','.join(MODULES), help='comma separated modules to import')
+    parser.add_argument('--repeat', type=int, default=3, help='imports of every module, the fastest is kept')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='relative slowdown allowed')
+    parser.add_argument('--baselines', default=str(BASELINE_PATH), help='baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    baseline = load_baselines(args.baselines).get(BASELINE_KEY, {})
+    results = {m: measure(m, args.repeat) for m in args.modules.split(',')}
+    print(f"{'module':<22}{'seconds':>10}{'baseline':>10}  heaviest imports")
+    for module, r in results.items():
+        if 'failed' in r:
+            print(f'{module:<22}failed: {r["failed"]}')
+            continue
+        base = f"{baseline[module]['seconds']:.2f}" if module in baseline else '-'
+        heaviest = ', '.join(f'{name} {s:.2f}s' for name, s in r['heaviest'])
+        print(f"{module:<22}{r['seconds']:>10.2f}{base:>10}  {heaviest}")
+
+    if args.save_baseline:
+        save_baselines(BASELINE_KEY, results, args.baselines)
+        print(f'Saved baseline to {args.baselines}')
+        return 0
+    regressions = [m for m, r in results.items()
+                   if 'seconds' in r and m in baseline
+                   and r['seconds'] > baseline[m]['seconds'] * (1 + args.tolerance)
+                   and r['seconds'] - baseline[m]['seconds'] > MIN_SECONDS]
+    for m in regressions:
+        print(f"REGRESSION {m}: {results[m]['seconds']:.2f}s vs {baseline[m]['seconds']:.2f}s baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
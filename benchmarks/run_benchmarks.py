@@ -0,0 +1,326 @@
+"""
+Project: Air Partners
+Description: Benchmarks of every pipeline stage on a synthetic sensor network
+
+Generates a seeded synthetic network (see benchmarks/synthetic.py), runs each stage of the pipeline on it
+in a temporary directory, and records the wall time, CPU time and peak Python memory (tracemalloc) of
+each stage. Results are compared against baselines stored in benchmarks/baselines.json, so performance
+regressions show up before the monthly run. Baselines are stored per network configuration, and are
+only comparable between runs on the same machine.
+
+Run from the top of the repository:
+
+    python3 -m benchmarks.run_benchmarks --sensors 20 --seed 0                # compare against baselines
+    python3 -m benchmarks.run_benchmarks --sensors 20 --seed 0 --save-baseline # store new baselines
+
+Stages whose dependencies are not installed (e.g. R for wind_polar_plot) are skipped.
+Exits with status 1 if any stage regressed.
+"""
+import io
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+from contextlib import redirect_stdout
+from PIL import Image
+from benchmarks.synthetic import SyntheticNetwork
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+BASELINE_PATH = REPO_DIR / 'benchmarks' / 'baselines.json'
+STAGES = ['clean_mod_pm', 'flags', 'cutoffs', 'replace_with_iem', 'calendar_plot', 'timeplot_threshold',
+          'diurnal_plot', 'wind_polar_plot', 'report_image', 'report_pdf', 'zip']
+# relative slowdown or memory growth that counts as a regression
+TOLERANCE = 0.25
+# differences smaller than these are noise, not regressions
+MIN_SECONDS = 0.05
+MIN_MB = 1.0
+
+
+def _import(module):
+    """
+    Imports a pipeline module, or returns the reason it cannot be imported.
+    """
+    try:
+        return __import__(module, fromlist=['*']), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def measure(fn, repeat=1):
+    """
+    Times a stage and measures its peak memory.
+    Stages are timed without tracemalloc, which slows Python code down, and run once more with it.
+
+    :param fn: (callable) the stage, called without arguments
+    :param repeat: (optional int) number of timed runs, the fastest is kept
+    :returns: result of the stage and a dict of its seconds, cpu_seconds and peak_mb
+    """
+    seconds, cpu_seconds = [], []
+    result = None
+    for _ in range(repeat):
+        gc.collect()
+        s, c = time.perf_counter(), time.process_time()
+        with redirect_stdout(io.StringIO()):
+            result = fn()
+        seconds.append(time.perf_counter() - s)
+        cpu_seconds.append(time.process_time() - c)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with redirect_stdout(io.StringIO()):
+            fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, {'seconds': min(seconds), 'cpu_seconds': min(cpu_seconds), 'peak_mb': peak / 2**20}
+
+
+def _report_images(year_month, sn):
+    """
+    Paths of every image a sensor's report is made from.
+    """
+    graphs = [f'timeplot_threshold/{sn}_{year_month}_timeplot_threshold.jpeg']
+    for pm in ('pm1', 'pm25', 'pm10'):
+        graphs.append(f'wind_polar_plot/{pm}/{sn}_{year_month}_wind_polar_plot.jpeg')
+        graphs.append(f'calendar_plot/{pm}/{sn}_{year_month}_calendar_plot.jpeg')
+        for day in ('weekday', 'weekend'):
+            graphs.append(f'diurnal_plot/{pm}/{day}/{sn}_{year_month}_diurnal_plot.jpeg')
+    return [f'{year_month}/Graphs/{g}' for g in graphs] + [f'_images/locs/{sn}.png']
+
+
+def _fill_missing_images(year_month, sn_list):
+    """
+    Creates blank stand-ins for report images that were not made (e.g. skipped plots, maps),
+    so the report stages can be measured on their own.
+    """
+    for sn in sn_list:
+        for path in _report_images(year_month, sn):
+            if not os.path.exists(path):
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                Image.new('RGB', (800, 600), 'white').save(path)
+
+
+def _prepare_workdir(workdir):
+    # the pipeline works with paths relative to the top of the repository
+    (workdir / '_images' / 'locs').mkdir(parents=True)
+    for asset in (REPO_DIR / '_images').glob('*.png'):
+        os.symlink(asset, workdir / '_images' / asset.name)
+
+
+def run(network, stages=STAGES, repeat=1, workdir=None):
+    """
+    Runs the benchmarks of a synthetic network.
+
+    :param network: (SyntheticNetwork) the network to run the pipeline on
+    :param stages: (optional list of str) stages to measure, earlier stages still run to make their inputs
+    :param repeat: (optional int) number of timed runs of every stage
+    :param workdir: (optional str) directory to run in, a temporary directory by default
+    :returns: dict of stage keys and their measurements, or {'skipped'/'failed': reason}
+    """
+    # pipeline modules are imported from the repository before moving into the working directory
+    qp, _ = _import('data_analysis.quantaq_pipeline')
+    compact, _ = _import('data_analysis.compact_frames')
+    plots, plots_error = _import('utils.create_plots')
+    report, report_error = _import('report_generation')
+    zipping, zip_error = _import('utils.zip_directory')
+
+    results = {}
+    ym = f'{network.year}-{network.month:02d}'
+    handler = qp.ModPMHandler(start_date=network.start, end_date=network.end)
+    raw = network.sensors()
+    iem_df = network.iem()
+    rows = sum(len(df) for df in raw.values())
+
+    def stage(name, fn, needs=None):
+        """
+        Runs a stage, measuring it if it was asked for. Returns its result, or None if it could not run.
+        """
+        if needs is not None:
+            results[name] = {'skipped': needs}
+            return None
+        try:
+            if name in stages:
+                result, results[name] = measure(fn, repeat)
+                results[name]['rows'] = rows
+                return result
+            with redirect_stdout(io.StringIO()):
+                return fn()
+        except Exception as e:
+            results[name] = {'failed': f'{type(e).__name__}: {e}'}
+            return None
+
+    cleaned = stage('clean_mod_pm', lambda: {sn: handler._clean_mod_pm(df) for sn, df in raw.items()})
+    if cleaned is None:
+        return results
+    stage('flags', lambda: [handler.flags(df) for df in cleaned.values()])
+    stage('cutoffs', lambda: [handler._cutoffs(df.copy()) for df in cleaned.values()])
+    final = stage('replace_with_iem', lambda: {
+        sn: handler._replace_with_iem(df.assign(wind_dir=0.0, wind_speed=0.0), iem_df)
+        for sn, df in cleaned.items()})
+    if final is None:
+        # later stages still need wind columns
+        final = {sn: df.assign(wind_dir=0.0, wind_speed=0.0) for sn, df in cleaned.items()}
+
+    cwd = os.getcwd()
+    tmp = None
+    if workdir is None:
+        tmp = tempfile.mkdtemp(prefix='bench_')
+        workdir = tmp
+    workdir = Path(workdir)
+    try:
+        _prepare_workdir(workdir)
+        os.chdir(workdir)
+        sn_list = list(final)
+
+        if plots is not None:
+            import matplotlib.pyplot as plt
+            pl = plots.Plotter(ym, sn_list, {sn: compact.compact_frame(df) for sn, df in final.items()})
+
+            def plot(fn, variants):
+                def run_plots():
+                    for kwargs in variants:
+                        pl.plot_and_export(fn, **kwargs)
+                        plt.close('all')
+                return run_plots
+
+            pms = ('pm1', 'pm25', 'pm10')
+            stage('calendar_plot', plot(plots.calendar_plot,
+                                        [dict(pm=pm, month=network.month, year=network.year) for pm in pms]))
+            stage('timeplot_threshold', plot(plots.timeplot_threshold, [dict(pm=None)]))
+            stage('diurnal_plot', plot(plots.diurnal_plot,
+                                       [dict(pm=pm, weekday=w) for w in (True, False) for pm in pms]))
+            stage('wind_polar_plot', plot(plots.wind_polar_plot, [dict(pm=pm) for pm in pms]))
+        else:
+            for name in ('calendar_plot', 'timeplot_threshold', 'diurnal_plot', 'wind_polar_plot'):
+                stage(name, None, needs=plots_error)
+
+        _fill_missing_images(ym, sn_list)
+        if report is not None:
+            def report_images():
+                for sn in sn_list:
+                    report.ReportGenerator(network.month, network.year, sn)._create_report_image()
+            stage('report_image', report_images)
+            stage('report_pdf', lambda: report.create_report_pdfs(network.month, network.year, sn_list))
+        else:
+            stage('report_image', None, needs=report_error)
+            stage('report_pdf', None, needs=report_error)
+
+        if zipping is not None:
+            stage('zip', lambda: _zip(zipping, ym))
+        else:
+            stage('zip', None, needs=zip_error)
+    finally:
+        os.chdir(cwd)
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return {name: results[name] for name in STAGES if name in results and name in stages}
+
+
+def _zip(zipping, year_month):
+    # a fresh archive every run, like the monthly run makes
+    with zipping.ArchiveBuilder(year_month, zip_dir='zips') as archive:
+        archive.add_tree()
+    return archive.zip_path
+
+
+def config_key(network):
+    """
+    :returns: string identifying the network configuration, baselines are stored per configuration
+    """
+    return (f'sensors={network.n_sensors},seed={network.seed},month={network.year}-{network.month:02d},'
+            f'gaps={network.gap_rate},spikes={network.spike_rate},coverage={network.coverage}')
+
+
+def load_baselines(path=BASELINE_PATH):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_baselines(key, results, path=BASELINE_PATH):
+    baselines = load_baselines(path)
+    baselines[key] = {name: r for name, r in results.items() if 'seconds' in r}
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Compares measurements against a baseline.
+
+    :param results: (dict) measurements from run()
+    :param baseline: (dict) stored measurements of the same configuration
+    :param tolerance: (optional float) relative slowdown or memory growth allowed
+    :returns: list of (stage, description) tuples of regressions
+    """
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if 'seconds' not in r or not base:
+            continue
+        if r['seconds'] > base['seconds'] * (1 + tolerance) and r['seconds'] - base['seconds'] > MIN_SECONDS:
+            regressions.append((name, f"{r['seconds']:.2f}s vs {base['seconds']:.2f}s baseline"))
+        if r['peak_mb'] > base['peak_mb'] * (1 + tolerance) and r['peak_mb'] - base['peak_mb'] > MIN_MB:
+            regressions.append((name, f"{r['peak_mb']:.1f} MB vs {base['peak_mb']:.1f} MB baseline"))
+    return regressions
+
+
+def print_results(results, baseline):
+    print(f"{'stage':<20}{'seconds':>10}{'cpu':>10}{'peak MB':>10}{'baseline s':>12}{'baseline MB':>13}")
+    for name, r in results.items():
+        if 'seconds' not in r:
+            print(f"{name:<20}{'skipped' if 'skipped' in r else 'failed'}: {r.get('skipped') or r.get('failed')}")
+            continue
+        base = baseline.get(name, {})
+        base_s = f"{base['seconds']:.2f}" if base else '-'
+        base_mb = f"{base['peak_mb']:.1f}" if base else '-'
+        print(f"{name:<20}{r['seconds']:>10.2f}{r['cpu_seconds']:>10.2f}{r['peak_mb']:>10.1f}{base_s:>12}{base_mb:>13}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every pipeline stage on a synthetic sensor network.')
+    parser.add_argument('--sensors', type=int, default=20, help='number of sensors in the network')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--month', type=int, default=6)
+    parser.add_argument('--gap-rate', type=float, default=0.02, help='chance of an outage starting in any hour')
+    parser.add_argument('--spike-rate', type=float, default=0.001, help='fraction of readings that are spikes')
+    parser.add_argument('--coverage', type=float, default=1.0, help='fraction of the month sensors are installed for')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated stages to measure')
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs of every stage, the fastest is kept')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='relative slowdown allowed')
+    parser.add_argument('--baselines', default=str(BASELINE_PATH), help='baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args(argv)
+
+    network = SyntheticNetwork(args.sensors, args.year, args.month, args.seed,
+                               args.gap_rate, args.spike_rate, args.coverage)
+    results = run(network, stages=args.stages.split(','), repeat=args.repeat)
+    key = config_key(network)
+    baseline = load_baselines(args.baselines).get(key, {})
+    print(key)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        save_baselines(key, results, args.baselines)
+        print(f'Saved baseline to {args.baselines}')
+        return 0
+    if not baseline:
+        print('No baseline stored for this configuration, run with --save-baseline to store one')
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for name, description in regressions:
+        print(f'REGRESSION {name}: {description}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
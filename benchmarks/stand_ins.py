@@ -0,0 +1,710 @@
+"""
+Project: Air Partners
+Description: Local record/replay stand-ins for the services the pipeline talks to
+
+Every service the pipeline uses can be replaced by a local server, so whole runs can be benchmarked
+offline and reproducibly:
+
+    service   client                           pointed at the stand-in by
+    quantaq   data_analysis/quantaq_client.py  QUANTAQ_API_URL
+    iem       data_analysis/iem.py             IEM_SERVICE_URL
+    drive     pull_from_drive.py               DRIVE_API_URL
+    dropbox   utils/dropbox_util.py            DROPBOX_API_URL
+    smtp      send_email.py                    SMTP_SERVER
+
+The HTTP stand-ins run in one of two modes:
+- record: requests are passed on to the real service and every response is stored as a fixture in
+  benchmarks/fixtures/{service}/. Real credentials are needed, and Dropbox uploads really happen.
+- replay: requests are answered from the fixtures. Requests without a fixture are answered from the
+  synthetic network (see benchmarks/synthetic.py), so no recording is needed to run the pipeline.
+
+The SMTP stand-in never sends anything, messages are stored as .eml files in benchmarks/outbox/.
+Every stand-in can add latency and fail a fraction of requests (429/503 responses, 451 for SMTP), so
+concurrency, retries and caching can be measured under realistic conditions.
+
+In a benchmark:
+
+    with stand_ins(faults=Faults(latency=0.2, failure_rate=0.05)) as servers:
+        ...  # run pipeline stages, the clients read the environment variables set here
+        print(servers['quantaq'].stats)
+
+From a shell, start the stand-ins and export the printed variables before running the pipeline:
+
+    python3 -m benchmarks.stand_ins --mode replay --latency 0.2 --failure-rate 0.05
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import hashlib
+import argparse
+import threading
+import contextlib
+import socketserver
+from pathlib import Path
+from functools import lru_cache
+from datetime import datetime, timedelta
+from urllib import request as urlrequest
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+from benchmarks.synthetic import SyntheticNetwork
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+FIXTURE_DIR = REPO_DIR / 'benchmarks' / 'fixtures'
+OUTBOX_DIR = REPO_DIR / 'benchmarks' / 'outbox'
+SERVICES = ['quantaq', 'iem', 'drive', 'dropbox', 'smtp']
+# real services that requests are passed on to in record mode, Dropbox requests carry their own host
+UPSTREAMS = {
+    'quantaq': 'https://api.quant-aq.com',
+    'iem': 'http://mesonet.agron.iastate.edu',
+    'drive': 'https://www.googleapis.com',
+}
+# response headers kept in fixtures
+FIXTURE_HEADERS = ['Content-Type', 'Retry-After', 'Dropbox-API-Result']
+# QuantAQ page size when the client does not ask for one
+PER_PAGE = 100
+HOST = '127.0.0.1'
+
+
+class Faults(object):
+    """
+    Latency and failures added to the responses of a stand-in.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, statuses=(429, 503), retry_after=1, seed=0):
+        """
+        Args:
+            latency: (optional float) seconds added to every response
+            jitter: (optional float) up to this many seconds more are added at random
+            failure_rate: (optional float) fraction of requests that fail
+            statuses: (optional tuple of int) HTTP statuses failed requests are answered with, picked at random
+            retry_after: (optional int) Retry-After seconds sent with 429 responses
+            seed: (optional int) seed of the random generator, so the same requests fail on every run
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.statuses = statuses
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """
+        Sleeps for the latency of one response.
+        """
+        with self._lock:
+            extra = self._rng.uniform(0, self.jitter) if self.jitter else 0.0
+        if self.latency + extra > 0:
+            time.sleep(self.latency + extra)
+
+    def failure(self):
+        """
+        :returns: the status a request should fail with, or None if it should succeed
+        """
+        with self._lock:
+            if self.failure_rate and self._rng.random() < self.failure_rate:
+                return self._rng.choice(self.statuses)
+        return None
+
+
+class FixtureStore(object):
+    """
+    Recorded responses of one service, one JSON file per distinct request.
+    """
+
+    def __init__(self, folder):
+        """
+        Args:
+            folder: (str or Path) folder the fixtures of the service are stored in
+        """
+        self.folder = Path(folder)
+
+    @staticmethod
+    def key(method, path, query, headers, body):
+        """
+        Identifies a request by everything that changes its response (not by credentials).
+
+        :param method: (str) HTTP method
+        :param path: (str) request path
+        :param query: (list of (str, str)) query string parameters
+        :param headers: (dict) request headers
+        :param body: (bytes) request body
+        :returns: hex digest naming the request's fixture
+        """
+        identity = [method, path, sorted(query), headers.get('Dropbox-API-Arg'), hashlib.sha1(body).hexdigest()]
+        return hashlib.sha1(json.dumps(identity).encode()).hexdigest()
+
+    def load(self, key):
+        """
+        :param key: (str) key of the request
+        :returns: (status, headers, body) tuple of the recorded response, or None if it was never recorded
+        """
+        try:
+            with open(self.folder / f'{key}.json', 'r') as f:
+                fixture = json.load(f)
+        except OSError:
+            return None
+        return fixture['status'], fixture['headers'], base64.b64decode(fixture['body'])
+
+    def save(self, key, request, response):
+        """
+        :param key: (str) key of the request
+        :param request: (dict) method, path and query of the request, stored to make fixtures readable
+        :param response: (tuple) status, headers and body of the response
+        """
+        status, headers, body = response
+        self.folder.mkdir(parents=True, exist_ok=True)
+        tmp = self.folder / f'{key}.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'request': request, 'status': status, 'headers': headers,
+                       'body': base64.b64encode(body).decode()}, f, indent=2)
+        os.replace(tmp, self.folder / f'{key}.json')
+
+
+def _json(status, payload, headers=None):
+    # Dropbox checks the content type is exactly application/json
+    return status, {'Content-Type': 'application/json', **(headers or {})}, json.dumps(payload, default=_scalar).encode()
+
+
+def _scalar(value):
+    # numpy numbers in synthetic frames
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class QuantAQResponder(object):
+    """
+    Answers QuantAQ device and data requests from a synthetic network.
+    """
+
+    def __init__(self, network):
+        self.network = network
+
+    @lru_cache(maxsize=1)
+    def devices(self):
+        created = (self.network.start - timedelta(days=90)).strftime('%Y-%m-%dT%H:%M:%S')
+        last_seen = self.network.end.strftime('%Y-%m-%dT%H:%M:%S')
+        devices = []
+        for i, sn in enumerate(self.network.sn_list):
+            df = self.network.sensor(i)
+            devices.append({'sn': sn, 'model': 'modulair_pm', 'status': 'ACTIVE', 'last_seen': last_seen,
+                            'city': 'Roxbury', 'description': f'Synthetic sensor {i}', 'outdoors': True,
+                            'created': created, 'geo': df.iloc[0]['geo'], 'n_datapoints': len(df)})
+        return devices
+
+    @lru_cache(maxsize=4)
+    def data(self, i, raw, start, stop):
+        df = self.network.sensor(i)
+        timestamps = pd.to_datetime(df['timestamp'], utc=True)
+        if start:
+            df = df[timestamps >= pd.Timestamp(start, tz='UTC')]
+            timestamps = timestamps[df.index]
+        if stop:
+            df = df[timestamps <= pd.Timestamp(stop, tz='UTC')]
+        if raw:
+            df = pd.DataFrame({'timestamp': df['timestamp'], 'sn': df['sn'],
+                               'sample_rh': [m['rh'] for m in df['met']],
+                               'sample_temp': [m['temp'] for m in df['met']]})
+        return df.to_dict('records')
+
+    def __call__(self, stand_in, method, path, query, headers, body):
+        params = dict(query)
+        parts = [p for p in path.split('/') if p]
+        # /device-api/v1/devices/ and /device-api/v1/devices/{sn}/data/[raw/]
+        if parts[:3] != ['device-api', 'v1', 'devices']:
+            return _json(404, {'error': 'Not found'})
+        if len(parts) == 3:
+            items = self.devices()
+        elif len(parts) >= 5 and parts[4] == 'data' and parts[3] in self.network.sn_list:
+            start = stop = None
+            for f in params.get('filter', '').split(';'):
+                if f.startswith('timestamp,ge,'):
+                    start = f.split(',', 2)[2]
+                elif f.startswith('timestamp,le,'):
+                    stop = f.split(',', 2)[2]
+            items = self.data(self.network.sn_list.index(parts[3]), parts[-1] == 'raw', start, stop)
+        else:
+            return _json(404, {'error': 'Not found'})
+
+        per_page = int(params.get('per_page', PER_PAGE))
+        page = int(params.get('page', 1))
+        pages = max(1, -(-len(items) // per_page))
+        next_url = None
+        if page < pages:
+            next_url = f"{stand_in.url}{path}?{urlencode({**params, 'page': page + 1})}"
+        return _json(200, {'data': items[(page - 1) * per_page:page * per_page],
+                           'meta': {'page': page, 'pages': pages, 'per_page': per_page,
+                                    'total': len(items), 'next_url': next_url}})
+
+
+class IEMResponder(object):
+    """
+    Answers IEM ASOS downloads with the synthetic network's wind data.
+    """
+
+    def __init__(self, network):
+        self.network = network
+
+    def __call__(self, stand_in, method, path, query, headers, body):
+        params = dict(query)
+        try:
+            start = datetime(int(params['year1']), int(params['month1']), int(params['day1']))
+            end = datetime(int(params['year2']), int(params['month2']), int(params['day2']))
+        except (KeyError, ValueError):
+            return 200, {'Content-Type': 'text/plain'}, b'ERROR: invalid request'
+        df = self.network.iem()
+        valid = pd.to_datetime(df['valid'])
+        df = df[(valid >= start) & (valid < end)]
+        return 200, {'Content-Type': 'text/plain'}, df.to_csv(index=False).encode()
+
+
+class DriveResponder(object):
+    """
+    Answers Drive file and export requests with a synthetic mailing list and sensor install sheet.
+    """
+
+    def __init__(self, network, subscribers=5):
+        self.network = network
+        self.subscribers = subscribers
+
+    def _sheets(self):
+        try:
+            from pull_from_drive import ITEMS
+        except ImportError:
+            return {}
+        installed = (self.network.start - timedelta(days=30)).strftime('%m/%d/%Y')
+        install = pd.DataFrame({
+            'Timestamp': installed,
+            'Select action': 'Sensor installation',
+            'Sensor serial number (SN)': self.network.sn_list,
+            'Date': installed,
+            'Time': '12:00:00 PM',
+            'Location site': [f'Site {i}' for i in range(len(self.network.sn_list))],
+            'Is the sensor being installed indoors or outdoors?': 'Outdoors',
+        })
+        maillist = pd.DataFrame({'Emails': [f'subscriber{i}@example.org' for i in range(self.subscribers)],
+                                 'Status of Subscription': 'Subbed'})
+        return {ITEMS['maillist']: maillist, ITEMS['sensor_install_data']: install}
+
+    def __call__(self, stand_in, method, path, query, headers, body):
+        parts = [p for p in path.split('/') if p]
+        sheets = self._sheets()
+        # /drive/v3/files/{id} and /drive/v3/files/{id}/export
+        if parts[:3] != ['drive', 'v3', 'files'] or len(parts) < 4 or parts[3] not in sheets:
+            return _json(404, {'error': {'code': 404, 'message': 'File not found'}})
+        if parts[-1] == 'export':
+            return 200, {'Content-Type': 'text/csv'}, sheets[parts[3]].to_csv(index=False).encode()
+        return _json(200, {'modifiedTime': self.network.start.strftime('%Y-%m-%dT%H:%M:%S.000Z'), 'version': '1'})
+
+
+class DropboxResponder(object):
+    """
+    Keeps uploaded files (their sizes, not their contents) and upload sessions in memory, like a Dropbox account.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _metadata(path, size):
+        digest = hashlib.sha1(path.encode()).hexdigest()
+        now = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        return {'name': path.rsplit('/', 1)[-1], 'id': f'id:{digest[:22]}', 'client_modified': now,
+                'server_modified': now, 'rev': digest[:16], 'size': size,
+                'path_lower': path.lower(), 'path_display': path}
+
+    @staticmethod
+    def _error(tag, summary, **fields):
+        return _json(409, {'error': {'.tag': tag, **fields}, 'error_summary': f'{summary}/..'})
+
+    def _check_offset(self, cursor):
+        # returns the correct offset when the client sent a different one
+        offset = self.sessions.get(cursor['session_id'])
+        if offset is None or offset == cursor['offset']:
+            return None
+        return offset
+
+    def __call__(self, stand_in, method, path, query, headers, body):
+        if path == '/oauth2/token':
+            return _json(200, {'access_token': 'stand-in', 'expires_in': 14400, 'token_type': 'bearer'})
+        arg = json.loads(headers.get('Dropbox-API-Arg') or body or b'{}')
+        route = path[len('/2/'):]
+        with self._lock:
+            if route == 'files/upload':
+                self.files[arg['path']] = len(body)
+                return _json(200, self._metadata(arg['path'], len(body)))
+            if route == 'files/upload_session/start':
+                session_id = uuid.uuid4().hex
+                self.sessions[session_id] = len(body)
+                return _json(200, {'session_id': session_id})
+            if route == 'files/upload_session/append_v2':
+                cursor = arg['cursor']
+                if cursor['session_id'] not in self.sessions:
+                    return self._error('not_found', 'not_found')
+                correct = self._check_offset(cursor)
+                if correct is not None:
+                    return self._error('incorrect_offset', 'incorrect_offset', correct_offset=correct)
+                self.sessions[cursor['session_id']] += len(body)
+                return _json(200, None)
+            if route == 'files/upload_session/finish':
+                cursor = arg['cursor']
+                if cursor['session_id'] not in self.sessions:
+                    return self._error('lookup_failed', 'lookup_failed/not_found', lookup_failed={'.tag': 'not_found'})
+                correct = self._check_offset(cursor)
+                if correct is not None:
+                    return self._error('lookup_failed', 'lookup_failed/incorrect_offset',
+                                       lookup_failed={'.tag': 'incorrect_offset', 'correct_offset': correct})
+                size = self.sessions.pop(cursor['session_id']) + len(body)
+                self.files[arg['commit']['path']] = size
+                return _json(200, self._metadata(arg['commit']['path'], size))
+            if route in ('files/delete', 'files/delete_v2'):
+                if arg['path'] not in self.files:
+                    return self._error('path_lookup', 'path_lookup/not_found', path_lookup={'.tag': 'not_found'})
+                metadata = {'.tag': 'file', **self._metadata(arg['path'], self.files.pop(arg['path']))}
+                return _json(200, {'metadata': metadata} if route == 'files/delete_v2' else metadata)
+        return _json(400, {'error_summary': f'unknown route {route}'})
+
+
+class StandInServer(object):
+    """
+    Local HTTP server standing in for one service, see the module docstring.
+    """
+
+    def __init__(self, service, mode='replay', responder=None, fixtures=None, faults=None, port=0):
+        """
+        Args:
+            service: (str) name of the service, one of SERVICES
+            mode: (optional str) 'record' or 'replay'
+            responder: (optional callable) answers requests without a fixture in replay mode
+            fixtures: (optional FixtureStore) defaults to benchmarks/fixtures/{service}
+            faults: (optional Faults) latency and failures to add, defaults to none
+            port: (optional int) port to listen on, a free port is picked by default
+        """
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown mode {mode}, use record or replay')
+        self.service = service
+        self.mode = mode
+        self.responder = responder
+        self.fixtures = fixtures or FixtureStore(FIXTURE_DIR / service)
+        self.faults = faults or Faults()
+        self.stats = {'requests': 0, 'faults': 0, 'recorded': 0, 'replayed': 0, 'synthetic': 0, 'missing': 0}
+        self._stats_lock = threading.Lock()
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                status, headers, payload = stand_in.handle(self.command, self.path, dict(self.headers), body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((HOST, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://{HOST}:{self.httpd.server_address[1]}'
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def _upstream(self, headers):
+        # the Dropbox client sends each request's real host along (see utils/dropbox_util.py)
+        if self.service == 'dropbox':
+            return f"https://{headers.get('X-Stand-In-Host', 'api.dropboxapi.com')}"
+        return UPSTREAMS[self.service]
+
+    def _proxy(self, method, path, headers, body):
+        skip = {'host', 'content-length', 'accept-encoding', 'connection', 'x-stand-in-host'}
+        req = urlrequest.Request(self._upstream(headers) + path, data=body or None, method=method,
+                                 headers={k: v for k, v in headers.items() if k.lower() not in skip})
+        try:
+            with urlrequest.urlopen(req, timeout=300) as r:
+                status, response_headers, payload = r.status, r.headers, r.read()
+        except HTTPError as e:
+            status, response_headers, payload = e.code, e.headers, e.read()
+        return status, {k: response_headers[k] for k in FIXTURE_HEADERS if response_headers.get(k)}, payload
+
+    def handle(self, method, path, headers, body):
+        """
+        Answers one request.
+
+        :param method: (str) HTTP method
+        :param path: (str) request path, with the query string
+        :param headers: (dict) request headers
+        :param body: (bytes) request body
+        :returns: (status, headers, body) tuple of the response
+        """
+        self._count('requests')
+        self.faults.delay()
+        status = self.faults.failure()
+        if status is not None:
+            self._count('faults')
+            extra = {'Retry-After': str(self.faults.retry_after)} if status == 429 else {}
+            return status, {'Content-Type': 'text/plain', **extra}, b'stand-in fault'
+
+        parts = urlsplit(path)
+        query = parse_qsl(parts.query, keep_blank_values=True)
+        key = FixtureStore.key(method, parts.path, query, headers, body)
+        if self.mode == 'record':
+            response = self._proxy(method, path, headers, body)
+            self.fixtures.save(key, {'method': method, 'path': parts.path, 'query': query}, response)
+            self._count('recorded')
+        else:
+            response = self.fixtures.load(key)
+            if response is not None:
+                self._count('replayed')
+            elif self.responder is not None:
+                response = self.responder(self, method, parts.path, query, headers, body)
+                self._count('synthetic')
+            else:
+                self._count('missing')
+                return 404, {'Content-Type': 'text/plain'}, b'no fixture recorded for this request'
+
+        # recorded responses link to the real service (e.g. QuantAQ's next_url), keep clients on the stand-in
+        status, response_headers, payload = response
+        upstream = UPSTREAMS.get(self.service)
+        if upstream:
+            payload = payload.replace(upstream.encode(), self.url.encode())
+        return status, response_headers, payload
+
+    def start(self):
+        """
+        Starts serving in a background thread.
+
+        :returns: the server
+        """
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class SMTPStandIn(object):
+    """
+    Minimal SMTP server that stores every message it receives as an .eml file instead of sending it.
+    Failed recipients are answered with 451 (try again later), like a busy mail server.
+    """
+
+    def __init__(self, outbox=OUTBOX_DIR, faults=None, port=0):
+        """
+        Args:
+            outbox: (optional str or Path) folder messages are stored in
+            faults: (optional Faults) latency and failures to add to every recipient, defaults to none
+            port: (optional int) port to listen on, a free port is picked by default
+        """
+        self.outbox = Path(outbox)
+        self.faults = faults or Faults()
+        self.stats = {'messages': 0, 'recipients': 0, 'faults': 0}
+        self._lock = threading.Lock()
+
+        stand_in = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def reply(self, line):
+                self.wfile.write(line.encode() + b'\r\n')
+
+            def handle(self):
+                self.reply('220 stand-in ESMTP')
+                recipients = []
+                while True:
+                    line = self.rfile.readline().decode(errors='replace').rstrip('\r\n')
+                    if not line:
+                        return
+                    command = line.split(' ', 1)[0].upper()
+                    if command == 'EHLO':
+                        self.reply('250-stand-in')
+                        self.reply('250 8BITMIME')
+                    elif command == 'RCPT':
+                        stand_in.faults.delay()
+                        if stand_in.faults.failure() is not None:
+                            stand_in._count('faults')
+                            self.reply('451 4.3.0 stand-in fault, try again later')
+                        else:
+                            recipients.append(line.split(':', 1)[-1].strip())
+                            stand_in._count('recipients')
+                            self.reply('250 OK')
+                    elif command == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        lines = []
+                        while True:
+                            data = self.rfile.readline()
+                            if data in (b'.\r\n', b'.\n', b''):
+                                break
+                            lines.append(data[1:] if data.startswith(b'..') else data)
+                        stand_in.store(b''.join(lines))
+                        recipients = []
+                        self.reply('250 OK')
+                    elif command == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    elif command in ('HELO', 'MAIL', 'RSET', 'NOOP'):
+                        if command == 'RSET':
+                            recipients = []
+                        self.reply('250 OK')
+                    elif command == 'AUTH':
+                        self.reply('235 Authentication successful')
+                    else:
+                        self.reply('502 Command not implemented')
+
+        self.server = socketserver.ThreadingTCPServer((HOST, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self):
+        return f'{HOST}:{self.server.server_address[1]}'
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def store(self, message):
+        """
+        :param message: (bytes) message as it was sent
+        """
+        self.outbox.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self.stats['messages'] += 1
+            n = self.stats['messages']
+        with open(self.outbox / f'{n:06d}.eml', 'wb') as f:
+            f.write(message)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def environment(servers):
+    """
+    :param servers: (dict) service names and running stand-ins
+    :returns: dict of the environment variables that point the pipeline's clients at the stand-ins
+    """
+    urls = {
+        'quantaq': ('QUANTAQ_API_URL', lambda s: f'{s.url}/device-api/'),
+        'iem': ('IEM_SERVICE_URL', lambda s: f'{s.url}/cgi-bin/request/asos.py?'),
+        'drive': ('DRIVE_API_URL', lambda s: f'{s.url}/drive/v3/'),
+        'dropbox': ('DROPBOX_API_URL', lambda s: s.url),
+        'smtp': ('SMTP_SERVER', lambda s: s.address),
+    }
+    return {urls[service][0]: urls[service][1](server) for service, server in servers.items()}
+
+
+def start_stand_ins(mode='replay', network=None, faults=None, services=SERVICES, fixture_dir=FIXTURE_DIR,
+                    outbox=OUTBOX_DIR):
+    """
+    Starts stand-ins for the given services.
+
+    :param mode: (optional str) 'record' or 'replay', see the module docstring
+    :param network: (optional SyntheticNetwork) answers requests without fixtures, defaults to 20 sensors
+    :param faults: (optional Faults or dict) latency and failures for every stand-in, or per service name
+    :param services: (optional list of str) services to stand in for
+    :param fixture_dir: (optional str or Path) folder the fixtures are stored in, one folder per service
+    :param outbox: (optional str or Path) folder the SMTP stand-in stores messages in
+    :returns: dict of service names and running stand-ins
+    """
+    network = network or SyntheticNetwork()
+    responders = {'quantaq': QuantAQResponder(network), 'iem': IEMResponder(network),
+                  'drive': DriveResponder(network), 'dropbox': DropboxResponder()}
+    servers = {}
+    for service in services:
+        service_faults = faults.get(service) if isinstance(faults, dict) else faults
+        if service == 'smtp':
+            servers[service] = SMTPStandIn(outbox, faults=service_faults).start()
+        else:
+            servers[service] = StandInServer(service, mode, responders[service], FixtureStore(Path(fixture_dir) / service),
+                                             faults=service_faults).start()
+    return servers
+
+
+@contextlib.contextmanager
+def stand_ins(**kwargs):
+    """
+    Runs stand-ins (see start_stand_ins for the arguments) and points the pipeline's clients at them
+    for the duration of the block. Clients created before the block (e.g. the shared QuantAQ client)
+    keep talking to the services they were created for.
+
+    :returns: dict of service names and running stand-ins
+    """
+    servers = start_stand_ins(**kwargs)
+    env = environment(servers)
+    saved = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        yield servers
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        for server in servers.values():
+            server.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run local stand-ins for the services the pipeline talks to.')
+    parser.add_argument('--mode', choices=['record', 'replay'], default='replay')
+    parser.add_argument('--services', default=','.join(SERVICES), help='comma separated services to stand in for')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many random seconds more')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data and the failures')
+    parser.add_argument('--sensors', type=int, default=20, help='number of sensors in the synthetic network')
+    parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--month', type=int, default=6)
+    args = parser.parse_args(argv)
+
+    faults = {s: Faults(args.latency, args.jitter, args.failure_rate, seed=args.seed) for s in SERVICES}
+    network = SyntheticNetwork(n_sensors=args.sensors, year=args.year, month=args.month, seed=args.seed)
+    servers = start_stand_ins(args.mode, network, faults, args.services.split(','))
+    for k, v in environment(servers).items():
+        print(f"export {k}='{v}'")
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for service, server in servers.items():
+            print(service, server.stats, file=sys.stderr)
+            server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+Project: Air Partners
+Description: Seeded generator of synthetic MOD-PM sensor networks
+
+Generates data shaped like what the pipeline receives from its services, so every stage can be run
+without credentials or a network connection:
+- sensor frames like QuantAQHandler.request_data returns for a MOD-PM sensor (final data, nested
+  geo and met columns, string timestamps)
+- wind data like data_analysis.iem.fetch_data returns
+
+The same seed always generates the same network.
+"""
+import calendar
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+
+# Roxbury, where the real network is
+CENTER_LAT, CENTER_LON = 42.3152, -71.0892
+
+
+class SyntheticNetwork(object):
+    """
+    A month of data for a network of MOD-PM sensors and the IEM wind station.
+    """
+
+    def __init__(self, n_sensors=20, year=2022, month=6, seed=0, gap_rate=0.02, spike_rate=0.001, coverage=1.0):
+        """
+        Args:
+            n_sensors: (optional int) number of sensors in the network
+            year: (optional int) year of the data
+            month: (optional int) month of the data
+            seed: (optional int) seed of the random generator
+            gap_rate: (optional float) chance that a sensor goes offline in any given hour
+            spike_rate: (optional float) fraction of readings that are spikes
+            coverage: (optional float) fraction of the month a sensor is installed for, sensors are
+                installed at a random point in the month when this is below 1
+        """
+        self.n_sensors = n_sensors
+        self.year = year
+        self.month = month
+        self.seed = seed
+        self.gap_rate = gap_rate
+        self.spike_rate = spike_rate
+        self.coverage = coverage
+        self.start = datetime(year, month, 1)
+        self.end = self.start + timedelta(days=calendar.monthrange(year, month)[1])
+        self.sn_list = [f'MOD-PM-{i:05d}' for i in range(1, n_sensors + 1)]
+
+    def _rng(self, *key):
+        # one generator per sensor, so a sensor's data does not depend on how many other sensors there are
+        return np.random.default_rng([self.seed, *key])
+
+    def _wind(self, rng, n):
+        # wind direction drifts around a prevailing south westerly, speed in mph
+        drct = (225 + np.cumsum(rng.normal(0, 8, n))) % 360
+        sped = np.clip(rng.gamma(2.0, 4.0, n), 0, None)
+        return np.round(drct / 10) * 10, np.round(sped)
+
+    def iem(self):
+        """
+        Generates wind data for the month, like data_analysis.iem.fetch_data.
+
+        :returns: dataframe with station, valid, drct and sped columns, one row every 5 minutes
+        """
+        rng = self._rng(0)
+        valid = pd.date_range(self.start, self.end, freq='5min', inclusive='left')
+        drct, sped = self._wind(rng, len(valid))
+        return pd.DataFrame({'station': 'BOS', 'valid': valid.strftime('%Y-%m-%d %H:%M'), 'drct': drct, 'sped': sped})
+
+    def sensor(self, i):
+        """
+        Generates a month of final data for one sensor, like QuantAQHandler.request_data.
+
+        :param i: (int) index of the sensor in sn_list
+        :returns: dataframe of the sensor's readings, newest first like the API returns them
+        """
+        sn = self.sn_list[i]
+        rng = self._rng(1, i)
+        timestamps = pd.date_range(self.start, self.end, freq='1min', inclusive='left', tz='UTC')
+        # readings come in a few seconds after the minute
+        timestamps = timestamps + pd.Timedelta(seconds=int(rng.integers(0, 60)))
+        n = len(timestamps)
+
+        keep = np.ones(n, dtype=bool)
+        # sensors installed part way through the month
+        if self.coverage < 1:
+            keep[:int(rng.uniform(0, 1 - self.coverage) * n)] = False
+        # outages of up to a day
+        for hour in np.flatnonzero(rng.random(n // 60) < self.gap_rate):
+            keep[hour * 60:hour * 60 + int(rng.integers(5, 24 * 60))] = False
+
+        # daily cycle with morning and evening traffic peaks, plus noise that drifts over days
+        hours = (timestamps.hour + timestamps.minute / 60).to_numpy()
+        daily = 1 + 0.5 * np.exp(-((hours - 12) ** 2) / 4) + 0.4 * np.exp(-((hours - 22) ** 2) / 6)
+        level = np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+        pm1 = rng.lognormal(np.log(4), 0.3, n) * daily * level
+        pm25 = pm1 * rng.uniform(1.2, 1.6, n)
+        pm10 = pm25 * rng.uniform(1.3, 2.0, n)
+        spikes = rng.random(n) < self.spike_rate
+        for pm in (pm1, pm25, pm10):
+            pm[spikes] *= rng.uniform(20, 80, spikes.sum())
+
+        lat = CENTER_LAT + rng.normal(0, 0.01)
+        lon = CENTER_LON + rng.normal(0, 0.01)
+        rh = np.clip(60 + 20 * np.sin(2 * np.pi * hours / 24) + rng.normal(0, 3, n), 0, 100)
+        temp = 22 + 6 * np.sin(2 * np.pi * (hours - 9) / 24) + rng.normal(0, 1, n)
+
+        df = pd.DataFrame({
+            'geo': [{'lat': lat, 'lon': lon}] * n,
+            'met': [{'rh': r, 'temp': t} for r, t in zip(np.round(rh, 2), np.round(temp, 2))],
+            'pm1': np.round(pm1, 4),
+            'pm10': np.round(pm10, 4),
+            'pm25': np.round(pm25, 4),
+            'pm1_model_id': 2905,
+            'pm10_model_id': 2907,
+            'pm25_model_id': 2906,
+            'sn': sn,
+            'timestamp': timestamps.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'timestamp_local': timestamps.tz_convert('US/Eastern').strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'url': [f'/device/{sn}/data/{k}' for k in range(n)],
+        })[keep]
+        return df.iloc[::-1].reset_index(drop=True)
+
+    def sensors(self):
+        """
+        :returns: dict of serial number keys and sensor dataframes from sensor()
+        """
+        return {sn: self.sensor(i) for i, sn in enumerate(self.sn_list)}
@@ -0,0 +1,104 @@
+"""
+Project: Air Partners
+Description: Compact in-memory representation of cleaned sensor dataframes
+
+The data of every sensor is held in memory for a whole run, so it is stored compactly:
+- pollutant and other measurement columns are float32
+- timestamps are int64 nanoseconds since the epoch (UTC)
+- string and flag columns are categoricals
+- values that are the same on every row (serial number, location, ...) are stored once per sensor in
+  df.attrs['sensor'] instead of on every row. The location is kept as df.attrs['sensor']['lat'/'lon'].
+
+expand_frame() turns a compact frame back into the schema the visualizers expect, one sensor at a time.
+"""
+import numpy as np
+import pandas as pd
+
+
+def _last_valid(s):
+    valid = s.dropna()
+    return valid.iloc[-1] if not valid.empty else None
+
+
+def compact_frame(df):
+    """
+    Converts a cleaned sensor dataframe into its compact form.
+
+    :param df: (pd.DataFrame) cleaned sensor data, as returned by ModPMHandler
+    :returns: compact dataframe, with per-sensor metadata in df.attrs['sensor']
+    """
+    if df.empty:
+        return df
+    meta = {}
+    timestamps = {}
+    columns = {}
+    for c in df.columns:
+        s = df[c]
+        if pd.api.types.is_datetime64_any_dtype(s):
+            # keep the time zone to restore it later, the values themselves are always UTC
+            timestamps[c] = str(s.dt.tz) if s.dt.tz is not None else None
+            values = s.dt.tz_convert('UTC').dt.tz_localize(None) if s.dt.tz is not None else s
+            columns[c] = values.to_numpy().astype('datetime64[ns]').view('int64')
+        elif pd.api.types.is_float_dtype(s):
+            columns[c] = s.astype('float32')
+        elif pd.api.types.is_bool_dtype(s) or pd.api.types.is_integer_dtype(s):
+            columns[c] = s
+        else:
+            last = _last_valid(s)
+            if isinstance(last, dict):
+                # nested values (e.g. geo) describe the sensor, keep the latest one
+                meta.update(last)
+            elif s.nunique(dropna=False) <= 1:
+                meta[c] = last
+            else:
+                columns[c] = s.astype('category')
+    compact = pd.DataFrame(columns, index=df.index)
+    compact.attrs['sensor'] = meta
+    compact.attrs['timestamps'] = timestamps
+    return compact
+
+
+def expand_frame(df):
+    """
+    Converts a compact sensor dataframe back into the schema the visualizers work with:
+    datetime timestamps and float64 measurements. Frames that are not compact are returned as they are.
+
+    :param df: (pd.DataFrame) compact sensor data from compact_frame
+    :returns: expanded dataframe
+    """
+    if 'timestamps' not in df.attrs:
+        return df
+    columns = {}
+    for c in df.columns:
+        s = df[c]
+        if c in df.attrs['timestamps']:
+            s = pd.Series(s.to_numpy().view('datetime64[ns]'), index=df.index, name=c)
+            tz = df.attrs['timestamps'][c]
+            if tz is not None:
+                s = s.dt.tz_localize('UTC').dt.tz_convert(tz)
+        elif s.dtype == np.float32:
+            s = s.astype('float64')
+        columns[c] = s
+    return pd.DataFrame(columns, index=df.index)
+
+
+def sensor_location(df):
+    """
+    Gets the latest location of a sensor.
+
+    :param df: (pd.DataFrame) compact or full sensor data
+    :returns: (lat, lon) tuple
+    """
+    meta = df.attrs.get('sensor', {})
+    if 'lat' in meta and 'lon' in meta:
+        return meta['lat'], meta['lon']
+    geo = df.iloc[-1]['geo']
+    return geo['lat'], geo['lon']
+
+
+def memory_usage(frames):
+    """
+    :param frames: (iterable of pd.DataFrame) sensor dataframes
+    :returns: total memory used by the dataframes in bytes
+    """
+    return sum(int(df.memory_usage(deep=True).sum()) for df in frames)
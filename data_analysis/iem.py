@@ -12,16 +12,23 @@ Code to automatically pull meteorology data from IEM website based on following
     * denote trace with blank string
 Specifications based on https://github.com/scott-hersey/EB_AQ_Network/blob/master/initial_analysis_walkthrough.Rmd
 """
+import os
 import json
 import time
 import datetime
 import pandas as pd
 from urllib import parse, request
 from io import StringIO
+from utils import metrics, watchdog
 
 # Number of attempts to download data
 MAX_ATTEMPTS = 6
+# seconds a request may wait for the server, and seconds all attempts of a download may take together
+REQUEST_TIMEOUT = 60
+DOWNLOAD_BUDGET = 5 * 60
 SERVICE = "http://mesonet.agron.iastate.edu/cgi-bin/request/asos.py?"
+# set to download from another server, e.g. a local stand-in (see benchmarks/stand_ins.py)
+SERVICE_URL_VAR = "IEM_SERVICE_URL"
 
 # based on specifications these should not change unless we decide to change sensor networks
 DEFAULT_PARAMS = {
@@ -44,21 +51,30 @@ def download_data(uri):
     """Fetch the data from the IEM
     The IEM download service has some protections in place to keep the number
     of inbound requests in check.  This function implements a backoff 
-    to keep individual downloads from erroring.
+    to keep individual downloads from erroring, and gives up once the download
+    has taken DOWNLOAD_BUDGET seconds (or the job it is part of is out of time).
     Args:
       uri (string): URL to fetch
     Returns:
       string data
     """
     attempt = 0
-    while attempt < MAX_ATTEMPTS:
+    give_up = time.monotonic() + DOWNLOAD_BUDGET
+    while attempt < MAX_ATTEMPTS and time.monotonic() < give_up:
+        s = time.monotonic()
         try:
-            data = request.urlopen(uri, timeout=300).read().decode("utf-8")
+            timeout = watchdog.remaining(min(REQUEST_TIMEOUT, give_up - s))
+            data = request.urlopen(uri, timeout=timeout).read().decode("utf-8")
+            metrics.observe("pipeline_request_seconds", time.monotonic() - s, service="iem", status=200)
             if data is not None and not data.startswith("ERROR"):
                 return data
+        except watchdog.JobTimeout:
+            raise
         except Exception as exp:
             print("download_data(%s) failed with %s" % (uri, exp))
-            time.sleep(5)
+            metrics.inc("pipeline_failures_total", stage="iem_download")
+            # back off a little longer after every failure
+            time.sleep(watchdog.remaining(max(0, min(5 * 2**attempt, give_up - time.monotonic()))))
         attempt += 1
 
     print("Exhausted attempts to download, returning empty data")
@@ -82,7 +98,7 @@ def make_request_uri(start, end):
     params.update(DEFAULT_PARAMS)
 
     #build/return full uri
-    return SERVICE + parse.urlencode(params) + ADDTL_PARAMS_STR
+    return os.environ.get(SERVICE_URL_VAR, SERVICE) + parse.urlencode(params) + ADDTL_PARAMS_STR
 
 def fetch_data(start, end):
     """
@@ -0,0 +1,190 @@
+"""
+Project: Air Partners
+Description: Memory-mapped columnar store of a month of sensor data
+
+Every column of every sensor is stored as a fixed-width .npy array, next to a validity mask and a
+meta.json describing the columns:
+
+    {year-month}/qaq_cleaned_data/{sensor}/columns/
+        meta.json               column names, dtypes, categories and sensor metadata
+        timestamp.npy           int64 nanoseconds since the epoch (UTC), sorted, the index of every column
+        {column}.npy            values, categoricals are stored as their integer codes and nullable
+                                columns (Int64, boolean, ...) as their numpy values
+        {column}.valid.npy      bool mask, False where the value is missing
+
+meta.json also keeps a digest of every column's contents, so caches of anything made from the data
+(e.g. rendered figures) can tell whether it changed without reading it.
+
+Arrays are opened with numpy.memmap (through np.load(mmap_mode='r')), so any number of worker processes
+can read the same sensor from the OS page cache without unpickling or copying it.
+"""
+import os
+import json
+import hashlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+def _numpy_values(c, s):
+    # values of a column as a fixed-width numpy array that can be memory-mapped, missing values are in the mask
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return s.cat.codes.to_numpy()
+    numpy_dtype = getattr(s.dtype, 'numpy_dtype', None)
+    if isinstance(s.dtype, pd.api.extensions.ExtensionDtype) and numpy_dtype is not None and numpy_dtype.kind in 'biuf':
+        # nullable columns, e.g. Int64 model ids
+        return s.to_numpy(dtype=numpy_dtype, na_value=numpy_dtype.type(0))
+    values = s.to_numpy()
+    if values.dtype.hasobject:
+        raise TypeError(f'Column {c} ({s.dtype}) cannot be memory-mapped, compact the frame first (see compact_frames.py)')
+    return values
+
+
+def _digest(values, valid):
+    h = hashlib.sha1(np.ascontiguousarray(values).tobytes())
+    h.update(np.ascontiguousarray(valid).tobytes())
+    return h.hexdigest()
+
+
+class MonthStore(object):
+    """
+    Writes compact sensor frames (see data_analysis/compact_frames.py) to disk and maps them back.
+    Holds only paths, so it can be passed to worker processes cheaply.
+    """
+
+    def __init__(self, year_month):
+        """
+        Args:
+            year_month: (str) month of the data, e.g. '2022-06'
+        """
+        self.year_month = year_month
+
+    def _dir(self, sn):
+        return Path(f'{self.year_month}/qaq_cleaned_data/{sn}/columns')
+
+    def _meta(self, sn):
+        with open(self._dir(sn) / 'meta.json', 'r') as f:
+            return json.load(f)
+
+    def __contains__(self, sn):
+        return (self._dir(sn) / 'meta.json').exists()
+
+    def write(self, sn, df):
+        """
+        Stores a compact sensor frame, replacing what was stored for the sensor before.
+
+        :param sn: (str) serial number of the sensor
+        :param df: (pd.DataFrame) compact sensor data from compact_frame, sorted by timestamp
+        :raises TypeError: if a column holds Python objects, which cannot be memory-mapped
+        """
+        # every column is converted before anything is written, a frame that cannot be stored is refused as a whole
+        arrays = {c: (_numpy_values(c, df[c]), df[c].notna().to_numpy()) for c in df.columns}
+        folder = self._dir(sn)
+        folder.mkdir(parents=True, exist_ok=True)
+        meta = {'rows': len(df), 'columns': {}, 'attrs': df.attrs}
+
+        def save(name, array):
+            # write next to the final file and swap it in, so readers never map a half written array
+            tmp = folder / f'{name}.tmp.npy'
+            np.save(tmp, np.ascontiguousarray(array))
+            os.replace(tmp, folder / f'{name}.npy')
+
+        for c, (values, valid) in arrays.items():
+            s = df[c]
+            if isinstance(s.dtype, pd.CategoricalDtype):
+                meta['columns'][c] = {'dtype': 'category', 'categories': [str(v) for v in s.cat.categories]}
+            else:
+                meta['columns'][c] = {'dtype': str(s.dtype)}
+            meta['columns'][c]['sha1'] = _digest(values, valid)
+            save(c, values)
+            save(f'{c}.valid', valid)
+
+        # meta.json is written last, a sensor only exists in the store once all of its arrays do
+        with open(folder / 'meta.json.tmp', 'w') as f:
+            json.dump(meta, f, default=str)
+        os.replace(folder / 'meta.json.tmp', folder / 'meta.json')
+
+    def digest(self, sn, columns=None):
+        """
+        Gets a digest of the stored data of a sensor, which changes whenever the data does.
+
+        :param sn: (str) serial number of the sensor
+        :param columns: (optional list of str) columns to include, defaults to every column
+        :returns: hex digest, or None if the sensor is not in the store
+        """
+        if sn not in self:
+            return None
+        meta = self._meta(sn)
+        columns = sorted(meta['columns'] if columns is None else set(columns) & set(meta['columns']))
+        h = hashlib.sha1()
+        for c in columns:
+            info = dict(meta['columns'][c])
+            # stores written before digests were kept are hashed from their arrays
+            if 'sha1' not in info:
+                values, valid = self.arrays(sn, [c])[c]
+                info['sha1'] = _digest(values, valid)
+            h.update(json.dumps([c, info], sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _range(self, timestamps, start, end):
+        lo = 0 if start is None else np.searchsorted(timestamps, pd.Timestamp(start).value, side='left')
+        hi = len(timestamps) if end is None else np.searchsorted(timestamps, pd.Timestamp(end).value, side='left')
+        return lo, hi
+
+    def arrays(self, sn, columns=None, start=None, end=None):
+        """
+        Maps the columns of a sensor without copying them.
+
+        :param sn: (str) serial number of the sensor
+        :param columns: (optional list of str) columns to map, defaults to every column
+        :param start: (optional datetime) first time to include, naive times are UTC
+        :param end: (optional datetime) first time to leave out, naive times are UTC
+        :returns: dict of column keys and (values, valid mask) tuples of read-only memmaps
+        """
+        folder = self._dir(sn)
+        meta = self._meta(sn)
+        columns = list(meta['columns']) if columns is None else [c for c in columns if c in meta['columns']]
+        lo, hi = 0, meta['rows']
+        if (start is not None or end is not None) and 'timestamp' in meta['columns']:
+            lo, hi = self._range(np.load(folder / 'timestamp.npy', mmap_mode='r'), start, end)
+        return {c: (np.load(folder / f'{c}.npy', mmap_mode='r')[lo:hi],
+                    np.load(folder / f'{c}.valid.npy', mmap_mode='r')[lo:hi])
+                for c in columns}
+
+    def frame(self, sn, columns=None, start=None, end=None):
+        """
+        Builds a compact sensor frame, like the one that was written, from the mapped columns.
+
+        :param sn: (str) serial number of the sensor
+        :param columns: (optional list of str) columns to include, defaults to every column
+        :param start: (optional datetime) first time to include, naive times are UTC
+        :param end: (optional datetime) first time to leave out, naive times are UTC
+        :returns: compact dataframe, empty if the sensor is not in the store
+        """
+        if sn not in self:
+            return pd.DataFrame()
+        meta = self._meta(sn)
+        data = {}
+        for c, (values, valid) in self.arrays(sn, columns, start, end).items():
+            info = meta['columns'][c]
+            if info['dtype'] == 'category':
+                data[c] = pd.Categorical.from_codes(np.where(valid, values, -1), categories=info['categories'])
+            elif info['dtype'] != str(values.dtype):
+                # nullable columns, missing values are put back from the mask
+                array = pd.array(np.array(values), dtype=info['dtype'])
+                array[~np.asarray(valid)] = pd.NA
+                data[c] = array
+            elif values.dtype.kind == 'f':
+                data[c] = np.where(valid, values, np.nan).astype(values.dtype)
+            else:
+                data[c] = np.asarray(values)
+        df = pd.DataFrame(data)
+        df.attrs = meta['attrs']
+        return df
+
+    def sensors(self):
+        """
+        :returns: list of serial numbers of the sensors in the store
+        """
+        root = Path(f'{self.year_month}/qaq_cleaned_data')
+        return sorted(p.parent.parent.name for p in root.glob('*/columns/meta.json'))
@@ -0,0 +1,196 @@
+"""
+Project: Air Partners
+Description: Shared QuantAQ API client for a pipeline run
+
+Every part of a run (device lists, data downloads, all worker threads) uses the same client from
+get_client(). It keeps a pool of HTTP connections open, shares one token-bucket rate limiter between
+all workers, and backs off when the API answers 429 or 5xx: the shared rate is cut when the API pushes
+back and creeps back up while requests succeed, so the import runs as fast as the API allows.
+"""
+import os
+import json
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import quantaq
+from utils import metrics, watchdog
+
+TOKEN_PATH = "token.txt"
+# set to point the client at another server, e.g. a local stand-in (see benchmarks/stand_ins.py)
+API_URL_VAR = "QUANTAQ_API_URL"
+# requests per second the limiter starts at and never goes above
+MAX_RATE = 5.0
+# requests per second the limiter never goes below
+MIN_RATE = 0.2
+BURST = 5
+MAX_RETRIES = 6
+REQUEST_TIMEOUT = 120
+POOL_SIZE = 10
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Each request takes a token, tokens refill at `rate` per second.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a token is available and take it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def slow_down(self):
+        """
+        Halve the rate and drop any saved up tokens, so every worker backs off together.
+        """
+        with self.lock:
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self.tokens = 0
+
+    def speed_up(self):
+        """
+        Raise the rate a little after a successful request.
+        """
+        with self.lock:
+            self.rate = min(MAX_RATE, self.rate + 0.1)
+
+
+class SharedQuantAQClient(quantaq.QuantAQAPIClient):
+    """
+    QuantAQ API client with pooled connections, a shared rate limiter and backoff on 429/5xx responses.
+    """
+    def __init__(self, api_key, rate=MAX_RATE, burst=BURST):
+        """
+        :param api_key: (str) QuantAQ API key
+        :param rate: (optional float) requests per second to start at
+        :param burst: (optional int) number of requests that can be made at once after being idle
+        """
+        super().__init__(api_key=api_key)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.limiter = TokenBucket(rate, burst)
+        # (endpoint, status code or None if the connection failed, seconds) of every request made
+        self.latencies = []
+        self._latency_lock = threading.Lock()
+
+    def request(self, endpoint, verb="GET", params=None, **kwargs):
+        """
+        Make a request to the QuantAQ API (same as quantaq.QuantAQAPIClient.request, but rate limited,
+        over pooled connections, and retried with backoff on 429/5xx responses and connection errors).
+
+        :param endpoint: (str) API endpoint
+        :param verb: (optional str) HTTP method
+        :param params: (optional dict) query string parameters
+        :returns: requests.Response from the QuantAQ API
+        """
+        params = dict() if params is None else params
+        params = {**params, **kwargs}
+        if verb == "GET":
+            request_kwargs = {"headers": {}, "params": params}
+        else:
+            request_kwargs = {"headers": self.headers, "data": json.dumps(params)}
+        url = self.url(endpoint)
+
+        for attempt in range(MAX_RETRIES):
+            self.limiter.acquire()
+            s = time.monotonic()
+            try:
+                # never wait longer than the job making the request has left (see utils/watchdog.py)
+                r = self.session.request(verb, url, auth=self.auth, timeout=watchdog.remaining(REQUEST_TIMEOUT),
+                                         **request_kwargs)
+                status = r.status_code
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                r, status, error = None, None, e
+            with self._latency_lock:
+                self.latencies.append((endpoint, status, time.monotonic() - s))
+            metrics.observe("pipeline_request_seconds", time.monotonic() - s, service="quantaq", status=status)
+
+            if status is not None and status != 429 and status < 500:
+                self.limiter.speed_up()
+                return r
+
+            # the API is pushing back, slow every worker down and wait before retrying
+            metrics.inc("pipeline_failures_total", stage="quantaq_request")
+            self.limiter.slow_down()
+            if attempt == MAX_RETRIES - 1:
+                break
+            retry_after = r.headers.get("Retry-After") if r is not None else None
+            wait = float(retry_after) if retry_after and retry_after.isdigit() else 2**attempt
+            time.sleep(watchdog.remaining(wait + random.uniform(0, 1)))
+
+        if r is None:
+            raise error
+        return r
+
+    def latency_summary(self):
+        """
+        Summarize request latencies recorded so far.
+
+        :returns: dict with request count, retried (429/5xx/failed) count, mean, p95 and max latency in seconds
+        """
+        with self._latency_lock:
+            times = sorted(t for _, _, t in self.latencies)
+            failed = sum(1 for _, status, _ in self.latencies if status is None or status == 429 or status >= 500)
+        if not times:
+            return {"requests": 0, "failed": 0}
+        return {
+            "requests": len(times),
+            "failed": failed,
+            "mean": sum(times) / len(times),
+            "p95": times[min(len(times) - 1, int(len(times) * 0.95))],
+            "max": times[-1],
+        }
+
+
+def get_client(token_path=TOKEN_PATH):
+    """
+    Gets the QuantAQ client shared by the whole run, creating it (and reading the token) on first use.
+
+    :param token_path: (optional str) path to the file containing the QuantAQ API key
+    :returns: SharedQuantAQClient
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            api_url = os.environ.get(API_URL_VAR)
+            if api_url and not os.path.exists(token_path):
+                # a stand-in server accepts any key
+                token = "stand-in"
+            else:
+                with open(token_path, 'r') as f:
+                    token = f.read().strip()
+            _client = SharedQuantAQClient(token)
+            if api_url:
+                _client.base_url = api_url
+        return _client
+
+
+def request_summary():
+    """
+    Summarizes the requests made by the shared client so far, without creating it if it was never used.
+
+    :returns: dict from SharedQuantAQClient.latency_summary
+    """
+    return _client.latency_summary() if _client is not None else {"requests": 0, "failed": 0}
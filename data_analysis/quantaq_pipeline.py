@@ -1,11 +1,10 @@
-from sqlite3 import Timestamp
-from matplotlib.pyplot import axis
-import quantaq
 import datetime as dt
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
 import os
 from data_analysis.iem import fetch_data
+from data_analysis.quantaq_client import get_client
+from utils.profiling import profiled
 import numpy as np
 import pandas as pd
 import pickle
@@ -24,19 +23,56 @@ TOKEN_PATH = "token.txt"
 TODAY = datetime.today()
 CUTOFF = 300
 
-class QuantAQHandler:
+# columns read from exported MOD-PM .csv files and their types, every other column is skipped while parsing
+MOD_PM_FINAL_DTYPES = {
+    "timestamp": "str", "timestamp_local": "str", "sn": "str",
+    "pm1": "float64", "pm25": "float64", "pm10": "float64",
+    "pm1_model_id": "Int64", "pm25_model_id": "Int64", "pm10_model_id": "Int64",
+    "sample_rh": "float64", "sample_temp": "float64",
+}
+MOD_PM_RAW_DTYPES = {
+    "timestamp": "str",
+    **{f"bin{i}": "float64" for i in range(24)},
+    **{f"neph_bin{i}": "float64" for i in range(6)},
+    "opcn3_pm1": "float64", "opcn3_pm25": "float64", "opcn3_pm10": "float64",
+    "pm1_env": "float64", "pm25_env": "float64", "pm10_env": "float64",
+}
+# format of timestamps in exported .csv files, parsing with an explicit format is much faster than inferring it
+CSV_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+try:
+    import pyarrow
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+
+def read_sensor_csv(path, dtypes):
     """
-    Class to fetch data from QuantAQ
+    Quickly read an exported QuantAQ .csv file, parsing only the given columns with fixed types.
+
+    :param path: (str) path to the .csv file
+    :param dtypes: (dict) column names and types to read, columns missing from the file are skipped
+    :returns: dataframe with timestamp columns parsed to UTC datetimes
     """
-    def __init__(self, token_path):
-        self.token = self._read_token(token_path)
-        self.client = quantaq.QuantAQAPIClient(api_key=self.token)
+    header = pd.read_csv(path, nrows=0).columns
+    usecols = [c for c in dtypes if c in header]
+    df = pd.read_csv(path, usecols=usecols, dtype={c: dtypes[c] for c in usecols}, engine=CSV_ENGINE)
+    for c in ("timestamp", "timestamp_local"):
+        if c in df.columns:
+            try:
+                df[c] = pd.to_datetime(df[c], format=CSV_TIMESTAMP_FORMAT, utc=True)
+            except ValueError:
+                df[c] = pd.to_datetime(df[c], utc=True)
+    return df
 
-    def _read_token(self, token_path):
-        with open(token_path, 'r') as f:
-            token = f.read()
-            return token
+class QuantAQHandler:
+    """
+    Class to fetch data from QuantAQ, through the client shared by the whole run
+    """
+    def __init__(self, token_path=TOKEN_PATH):
+        self.client = get_client(token_path)
 
+    @profiled('quantaq_request', sensor='serial_num')
     def request_data(self, serial_num, start_date=TODAY-timedelta(days=2), end_date=TODAY, raw=False):
         """
         Request data from QuantAQ's API.
@@ -368,7 +404,7 @@ class SNHandler(DataHandler):
         :returns: cleaned pandas dataframe
         """
         #initialize client class for requesting data from QuantAQ
-        client = QuantAQHandler(TOKEN_PATH)
+        client = QuantAQHandler()
 
         #get the final data from quantAQ, NOTE: SLOW! MAY TAKE SEVERAL MINUTES!
         print("pulling final data...")
@@ -452,7 +488,8 @@ class ModPMHandler(DataHandler):
         else:
             if not (set(['rh', 'temp']).issubset(df.columns)):
                 df[['rh', 'temp']] = df.met.apply(pd.Series)
-            df = df.drop(['url', 'met', 'timestamp_local'], axis = 1)
+            # data from .csv files has no url or met columns
+            df = df.drop(['url', 'met', 'timestamp_local'], axis = 1, errors='ignore')
 
         #drop duplicate rows. Timestamps don't properly get recognized as duplicates, so use data_cols.
         df = df.drop_duplicates(subset = self.data_cols, ignore_index=True)
@@ -466,16 +503,18 @@ class ModPMHandler(DataHandler):
 
         return df
 
-    def _iem(self, df, is_tz_aware=True):
+    def _iem(self, df, is_tz_aware=True, iem_df=None):
         """
         Add wind direction and speed data to MOD-PM sensors by pulling from IEM website.
 
         :param df: (pd.DataFrame) dataframe containing mod-pm data
         :param is_tz_aware: (optional bool) True if the raw, string representations of timestamps in df are time zone-aware
+        :param iem_df: (optional pd.DataFrame) IEM data for the date range, downloaded if not given
         :returns: dataframe with added wind_speed, wind_dir columns
         """
         #request data from IEM
-        iem_df = fetch_data(self.start, self.end)
+        if iem_df is None:
+            iem_df = fetch_data(self.start, self.end)
 
         #add wind direction and speed to df
         #wind_dir and wind_speed columns are not included in original df so we need to add them
@@ -484,6 +523,7 @@ class ModPMHandler(DataHandler):
         df = self._replace_with_iem(df, iem_df, is_tz_aware=is_tz_aware)
         return df
 
+    @profiled('mod_pm_from_api', sensor='sensor_id')
     def from_api(self, sensor_id, smoothed=True):
         """
         Build a cleaned dataframe containing data for a MOD-PM sensor by pulling data from the QuantAQ website over
@@ -494,7 +534,7 @@ class ModPMHandler(DataHandler):
         :param smoothed: (optional bool) True if unrealistically large values should be removed
         :returns: cleaned pandas dataframe
         """
-        client = QuantAQHandler(TOKEN_PATH) #TODO make this not rely on a global variable token_path?
+        client = QuantAQHandler()
         df = client.request_data(sensor_id, self.start, self.end, raw=False)
         
         # check for empty dataframe
@@ -524,42 +564,49 @@ class ModPMHandler(DataHandler):
         :param smoothed: (optional bool) True if unrealistically large values should be removed
         :returns: the cleaned dataframe with combined raw/final results
         """
+        df = self.merge_csv_data(read_sensor_csv(final_path, MOD_PM_FINAL_DTYPES),
+                                 read_sensor_csv(raw_path, MOD_PM_RAW_DTYPES))
+
+        #find start and end times from the local file to inform IEM request
+        self.start, self.end = df.timestamp.min().tz_localize(None), df.timestamp.max().tz_localize(None)
+
+        return self.from_csv_data(df, sensor_id, smoothed=smoothed)
+
+    @staticmethod
+    def merge_csv_data(df_fin, df_raw=None):
+        """
+        Combines final and raw data read by read_sensor_csv on their parsed timestamps.
+
+        :param df_fin: (pd.DataFrame) final data of a MOD-PM sensor
+        :param df_raw: (optional pd.DataFrame) raw data of the same sensor, if there is any
+        :returns: combined dataframe
+        """
+        # exported final data has the sensor's rh and temperature under different names than the API
+        df = df_fin.rename(columns={"sample_rh": "rh", "sample_temp": "temp"}).drop(columns=["sn"], errors="ignore")
+        if df_raw is not None and not df_raw.empty:
+            df = df.merge(df_raw, on="timestamp")
+        return df
+
+    def from_csv_data(self, df, sensor_id, smoothed=True, iem_df=None):
+        """
+        Cleans data read from .csv files, adds wind data and stores it for the date range of this handler.
+
+        :param df: (pd.DataFrame) data combined by merge_csv_data
+        :param sensor_id: (str) unique ID of the QuantAQ sensor the data is from
+        :param smoothed: (optional bool) True if unrealistically large values should be removed
+        :param iem_df: (optional pd.DataFrame) IEM data for the date range, downloaded if not given
+        :returns: the cleaned dataframe
+        """
         #local csv has a different column format than the API
-        self.data_cols = [
-            "bin0","bin1","bin2","bin3",
-            "bin4","bin5","bin6","bin7",
-            "bin8","bin9","bin10","bin11",
-            "bin12","bin13","bin14","bin15",
-            "bin16","bin17","bin18","bin19",
-            "bin20","bin21","bin22","bin23",
-            "opcn3_pm1","opcn3_pm25","opcn3_pm10","pm1_env",
-            "pm25_env","pm10_env","neph_bin0","neph_bin1",
-            "neph_bin2","neph_bin3","neph_bin4","neph_bin5",
-            "pm1", "pm10", "pm25"
-        ]
-        #columns to keep from the final dataset, many of the columns are already present in the raw data
-        final_cols = ["timestamp","pm1","pm25","pm10","pm1_model_id","pm25_model_id","pm10_model_id"]
-
-        #read final csv into df
-        df_fin = pd.read_csv(final_path)
-        df_fin = df_fin[final_cols]
-
-        #read raw csv into df
-        df_raw = pd.read_csv(raw_path)
-        #combine raw/final dataframes
-        df = df_fin.merge(df_raw, on="timestamp")
+        self.data_cols = [c for c in MOD_PM_RAW_DTYPES if c != "timestamp" and c in df.columns] + ["pm1", "pm10", "pm25"]
 
         #clean dataframe
         df = self._clean_mod_pm(df, smoothed=smoothed)
 
-        #find start and end times from the local file to inform IEM request
-        self.start, self.end = df.timestamp.min().tz_localize(None), df.timestamp.max().tz_localize(None)
-
         #add wind direction and speed to df from iem
-        df = self._iem(df, is_tz_aware=False)
+        df = self._iem(df, is_tz_aware=False, iem_df=iem_df)
 
         #store the cleaned df
         self.save_files(df, sensor_id, smoothed=smoothed)
 
-        #find the start/end time of the file
-        return df
\ No newline at end of file
+        return df
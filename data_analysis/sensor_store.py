@@ -0,0 +1,117 @@
+"""
+Project: Air Partners
+Description: Lazy, LRU-evicting store of sensor dataframes
+
+SensorStore can be used anywhere the old sn_dict (a dict of serial number keys and dataframes) was used.
+A sensor's data is only loaded when it is first accessed, and only a few recently used sensors are kept
+in memory, so memory use stays flat however many sensors the network has. Sensors without data are
+remembered as empty and never loaded again.
+"""
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+import pandas as pd
+from data_analysis.compact_frames import memory_usage
+
+# number of sensors kept in memory at once
+STORE_CAPACITY = 4
+# columns the plots use
+PLOT_COLUMNS = ['timestamp', 'pm1', 'pm25', 'pm10', 'wind_speed', 'wind_dir']
+
+
+class SensorStore(Mapping):
+    """
+    Read-only mapping of sensor serial numbers to (compact) dataframes, loaded on first access.
+    """
+
+    def __init__(self, sn_list, loader, capacity=STORE_CAPACITY, columns=None):
+        """
+        Args:
+            sn_list: (list of str) serial numbers of the sensors in the store, in order
+            loader: (callable) takes a serial number and the columns to load (None for all of them), and returns
+                that sensor's dataframe
+            capacity: (optional int) number of sensors kept in memory at once
+            columns: (optional list of str) columns to keep, all columns are kept if not given
+        """
+        self.sn_list = list(sn_list)
+        self.loader = loader
+        self.capacity = capacity
+        self.columns = columns
+        self.empty = set()
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _project(self, df):
+        if self.columns is None or df.empty:
+            return df
+        projected = df[[c for c in self.columns if c in df.columns]]
+        projected.attrs = dict(df.attrs)
+        return projected
+
+    def put(self, sn, df):
+        """
+        Adds data of a sensor that was already loaded, e.g. while it was downloaded.
+
+        :param sn: (str) serial number of the sensor
+        :param df: (pd.DataFrame) data of the sensor
+        :returns: the data as it is kept in the store
+        """
+        with self._lock:
+            if sn not in self.sn_list:
+                self.sn_list.append(sn)
+            if df.empty:
+                self.empty.add(sn)
+                self._cache.pop(sn, None)
+                return df
+            df = self._project(df)
+            self._cache[sn] = df
+            self._cache.move_to_end(sn)
+            while len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+            return df
+
+    def __getitem__(self, sn):
+        if sn not in self.sn_list:
+            raise KeyError(sn)
+        with self._lock:
+            if sn in self.empty:
+                return pd.DataFrame()
+            if sn in self._cache:
+                self.hits += 1
+                self._cache.move_to_end(sn)
+                return self._cache[sn]
+            self.misses += 1
+        return self.put(sn, self.loader(sn, self.columns))
+
+    def __iter__(self):
+        return iter(self.sn_list)
+
+    def __len__(self):
+        return len(self.sn_list)
+
+    def __contains__(self, sn):
+        return sn in self.sn_list
+
+    def select(self, columns):
+        """
+        Gets a store of the same sensors that only keeps the given columns in memory.
+
+        :param columns: (list of str) columns to keep
+        :returns: SensorStore sharing this store's loader and empty sensors, and starting with the sensors in memory
+        """
+        store = SensorStore(self.sn_list, self.loader, capacity=self.capacity, columns=columns)
+        store.empty = self.empty
+        with self._lock:
+            for sn, df in self._cache.items():
+                store.put(sn, df)
+        return store
+
+    def stats(self):
+        """
+        :returns: dict with cache hits, misses, the sensors currently in memory and the memory they use in bytes
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'loaded': list(self._cache),
+                    'bytes': memory_usage(self._cache.values())}
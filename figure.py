@@ -2,10 +2,10 @@
 Author: Neel Dhulipala
 Project: Air Partners
 
-File to create singular files when needed. 
+File to create singular files when needed.
 To run from command line, activate virtual environment, then run:
 
-        $ python3 figure.py <YEAR> <MONTH> <FIGURE_TYPE> <SENSOR_ID> <PM>
+        $ python3 figure.py <YEAR> <MONTH> <FIGURE_TYPE> <SENSOR_ID> <PM> [--weekend] [--profile PROFILE] [--output PATH]
 
 Where <YEAR> and <MONTH> are replaced with the appropriate year and month from
 when the data is from, <FIGURE_TYPE> is replaced with the name of the function
@@ -18,69 +18,123 @@ This dictionary should be used for identifying which PM to use:
 - PM 10: 'pm10'
 
 If you choose to make a timeplot, which includes the plots for all three PMs, set <PM>
-to None.
+to None. --weekend makes the weekend diurnal plot instead of the weekday one, and --profile
+picks the output quality profile (print, email or web, see utils/output_profiles.py).
+
+Figures are drawn from the month's stored data (see data_analysis/month_store.py), so the month
+must have been imported first, and written as a JPEG (by default to the current directory).
+If the long-running service is listening (see service.py), it renders the figure instead: it keeps
+rendered figures in a size-bounded cache keyed by the data they were drawn from and the figure's
+parameters, so a figure that was asked for before is returned at once.
 """
 
-import pandas as pd
-import matplotlib.pyplot as plt
-from calendar import monthrange
-from datetime import datetime
-import data_analysis.quantaq_pipeline as qp
-from utils.create_plots import *
+import os
 import sys
+import base64
+import argparse
+import matplotlib.pyplot as plt
+from plots import PLOT_FUNCTIONS, figure_args
+from data_analysis.month_store import MonthStore
+from data_analysis.sensor_store import PLOT_COLUMNS
+from data_analysis.compact_frames import expand_frame
+from utils.output_profiles import PROFILES, encode_figure
+from utils.figure_cache import figure_key as cache_key
+from utils.service_client import SOCKET_PATH, request
+
+
+def figure_key(year, month, sn, plot, pm=None, weekday=True, profile='print'):
+    """
+    Makes the cache key of a figure from the digest of the sensor's stored data and the figure's parameters.
+
+    :returns: hex digest, or None if the sensor has no stored data for the month
+    """
+    digest = MonthStore(f'{year}-{month:02d}').digest(sn, PLOT_COLUMNS)
+    if digest is None:
+        return None
+    # parameters a figure does not use (e.g. weekday of a calendar plot) are left out of the key
+    _, pm, kwargs = figure_args(year, month, plot, pm, weekday)
+    return cache_key(digest, sn=sn, plot=plot, pm=pm, profile=profile, **kwargs)
+
+
+def render_figure(year, month, sn, plot, pm=None, weekday=True, profile='print'):
+    """
+    Renders one figure of one sensor from the month's stored data.
+
+    :param year: (int) year of the data
+    :param month: (int) month of the data
+    :param sn: (str) serial number of the sensor
+    :param plot: (str) name of the plot function, e.g. 'diurnal_plot'
+    :param pm: (optional str) 'pm1', 'pm25' or 'pm10', None for the timeplot
+    :param weekday: (optional bool) False for the weekend diurnal plot
+    :param profile: (optional str) output profile of the JPEG
+    :returns: bytes of the JPEG
+    """
+    plot_function, pm, kwargs = figure_args(year, month, plot, pm, weekday)
+    year_month = f'{year}-{month:02d}'
+    df = MonthStore(year_month).frame(sn, PLOT_COLUMNS)
+    if df.empty:
+        raise ValueError(f'{sn} has no stored data for {year_month}, import the month first')
+    data = expand_frame(df)
+    plt.close('all')
+    try:
+        if pm is None:
+            plot_function(data, **kwargs)
+        else:
+            plot_function(data, pm, **kwargs)
+        return encode_figure(plt.gcf(), profile)
+    finally:
+        plt.close('all')
+
+
+def render_cached(cache, year, month, sn, plot, pm=None, weekday=True, profile='print'):
+    """
+    Gets a figure from a cache, rendering and caching it if it is not there.
+
+    :param cache: (FigureCache) cache of rendered figures
+    :returns: bytes of the JPEG, and True if it came from the cache
+    """
+    key = figure_key(year, month, sn, plot, pm, weekday, profile)
+    data = cache.get(key) if key is not None else None
+    if data is not None:
+        return data, True
+    data = render_figure(year, month, sn, plot, pm, weekday, profile)
+    cache.put(key, data)
+    return data, False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render one figure of one sensor.')
+    parser.add_argument('year', type=int)
+    parser.add_argument('month', type=int)
+    parser.add_argument('plot', choices=sorted(PLOT_FUNCTIONS))
+    parser.add_argument('sn', help='serial number of the sensor')
+    parser.add_argument('pm', choices=['pm1', 'pm25', 'pm10', 'None'])
+    parser.add_argument('--weekend', dest='weekday', action='store_false', help='weekend diurnal plot')
+    parser.add_argument('--profile', default='print', choices=sorted(PROFILES), help='output quality profile')
+    parser.add_argument('--output', help='path of the JPEG')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='unix socket of the service, if it is running')
+    args = parser.parse_args(argv)
+
+    params = dict(year=args.year, month=args.month, sn=args.sn, plot=args.plot,
+                  pm=None if args.pm == 'None' else args.pm, weekday=args.weekday, profile=args.profile)
+    if os.path.exists(args.socket):
+        answer = request({'kind': 'render', 'args': params}, args.socket)
+        if 'image' not in answer:
+            print(answer.get('error', answer))
+            return 1
+        data, cached = base64.b64decode(answer['image']), answer['cached']
+    else:
+        data, cached = render_figure(**params), False
+
+    name = '_'.join([args.sn, f'{args.year}-{args.month:02d}', args.plot]
+                    + ([params['pm']] if params['pm'] else [])
+                    + (['weekend'] if args.plot == 'diurnal_plot' and not args.weekday else []))
+    path = args.output or f'{name}.jpeg'
+    with open(path, 'wb') as f:
+        f.write(data)
+    print(f'{path}' + (' (cached)' if cached else ''))
+    return 0
 
-# Following _ functions are helpers that call plotting functions
-def _calendar(df, pm, month, year):
-        calendar_plot(df, pm=pm, month=month, year=year)
-
-def _wind(df, pm, month, year):
-        wind_polar_plot(df, pm)
-
-def _timeplot(df, pm, month, year):
-        timeplot_threshold(df)
-
-def _diurnal(df, pm, month, year):
-        diurnal_plot(df, pm)
-
-# Downloads data from designated timeframe and plots it using designated plot function
-def create_singular_figure(year, month, plot_function, sensor, pm):
-        """
-        Creates figure of your choice and plots it.
-
-        Args:
-                year: (int) year of when you want data from
-                month: (int) month of year where you want data from
-                plot_function: (string) type of plot you want to generate
-                sensor: (string) the sensor you want to pull data from
-                pm: (string) particulate matter you want to plot (if plot_function is timeplot_thresholds, pm=None)
-        """
-        # parsing variables
-        year = int(year)
-        month = int(month)
-        func_dict = {'calendar_plot': _calendar, 
-                     'timeplot_threshold': _timeplot,
-                     'wind_polar_plot': _wind,
-                     'diurnal_plot': _diurnal}
-        plot_function = func_dict[plot_function]
-
-        def _get_start_end_dates(year_int_YYYY, month_int):
-                # get next month
-                next_month = month_int+1 if month!=12 else 1
-                # get next year
-                next_year = year_int_YYYY if next_month!=1 else year_int_YYYY+1
-                # get start and end dates in type datetime
-                start_date = datetime(year_int_YYYY, month_int, 1)
-                end_date = datetime(next_year, next_month, 1)
-                return start_date, end_date
-
-
-        start_date, end_date = _get_start_end_dates(2022, 6)
-        mod_handler = qp.ModPMHandler(start_date=start_date, end_date=end_date)
-
-        df = mod_handler.load_df(sensor, start_date, end_date)
-
-        plot_function(df, pm, month, year)
-        plt.show()
 
 if __name__=='__main__':
-        create_singular_figure(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5])
+    sys.exit(main())
@@ -4,20 +4,31 @@ Project: Air Partners
 
 Script for importing necessary data for air quality analysis for static reporting.
 """
+import os
 import sys
+import pickle
 import pandas as pd
 from calendar import monthrange
-import quantaq
 from quantaq.utils import to_dataframe
-from datetime import datetime
+from datetime import datetime, timedelta
 import data_analysis.quantaq_pipeline as qp
-from pull_from_drive import pull_sensor_install_data
+from data_analysis.quantaq_client import get_client, request_summary
+from data_analysis.compact_frames import compact_frame
+from data_analysis.sensor_store import SensorStore
+from data_analysis.month_store import MonthStore
+from pull_from_drive import pull_sensor_install_data, read_sheet
 from utils.create_maps import main
+from utils.profiling import profiled, report_at_exit
+from utils import watchdog
+from utils.manifest import RunManifest, retry_failed
+from utils import metrics
 
-with open('token.txt', 'r') as f:
-    token = f.read()
-
-client = quantaq.QuantAQAPIClient(token)
+# Device metadata is cached locally and only requested again once it is older than the TTL
+DEVICE_CACHE_PATH = 'device_cache.pckl'
+DEVICE_CACHE_TTL = timedelta(hours=12)
+# Device metadata columns we use, selected by name
+DEVICE_COLUMNS = ['sn', 'model', 'status', 'last_seen', 'city', 'description',
+                  'outdoors', 'geo', 'n_datapoints', 'created']
 
 
 class DataImporter(object):
@@ -33,6 +44,29 @@ class DataImporter(object):
         """
         self.year = year
         self.month = month
+        # memory-mapped copy of every sensor's cleaned data, shared by worker processes
+        self.month_store = MonthStore(f'{year}-{month:02d}')
+        # serial number -> exception of sensors whose data could not be downloaded
+        self.errors = {}
+
+    def _get_devices(self, refresh=False):
+        """
+        Gets metadata of every Roxbury sensor from the QuantAQ API, or from the local cache if
+        it was fetched less than DEVICE_CACHE_TTL ago.
+
+        :param refresh: (optional bool) True to ignore the cache and ask the API
+        :returns: a dataframe of device metadata
+        """
+        if not refresh and os.path.exists(DEVICE_CACHE_PATH):
+            with open(DEVICE_CACHE_PATH, 'rb') as f:
+                fetched, devices_raw = pickle.load(f)
+            if datetime.now() - fetched < DEVICE_CACHE_TTL:
+                return devices_raw
+        devices_raw = to_dataframe(
+            get_client().devices.list(filter="city,like,%_oxbury%"))
+        with open(DEVICE_CACHE_PATH, 'wb') as f:
+            pickle.dump((datetime.now(), devices_raw), f)
+        return devices_raw
 
     def get_all_sensor_list(self):
         """
@@ -42,12 +76,34 @@ class DataImporter(object):
         :returns: A filtered list of sensor information
         :returns: A list of all sensor information
         """
-        devices_raw = to_dataframe(
-            client.devices.list(filter="city,like,%_oxbury%"))
-        devices_simplified = devices_raw.iloc[:, [
-            4, 3, 11, 15, 16, 5, 7, 8, 10, 12]]
+        devices_raw = self._get_devices()
+        devices_simplified = devices_raw[[c for c in DEVICE_COLUMNS if c in devices_raw.columns]]
         return devices_simplified, devices_raw
 
+    def get_offline_sensors(self, sn_list):
+        """
+        Finds sensors that cannot have data for the month according to their device metadata:
+        sensors that were last seen before the month started, or were created after it ended.
+
+        :param sn_list: (list of str) serial numbers of sensors to check
+        :returns: a list of serial numbers of sensors that are offline for the month
+        """
+        start_date, end_date = self._get_start_end_dates(self.year, self.month)
+        start_date, end_date = pd.Timestamp(start_date, tz='UTC'), pd.Timestamp(end_date, tz='UTC')
+        devices = self._get_devices().set_index('sn')
+
+        offline = []
+        for sn in sn_list:
+            # sensors without metadata are kept, there is no evidence they are offline
+            if sn not in devices.index:
+                continue
+            device = devices.loc[sn]
+            last_seen = pd.to_datetime(device.get('last_seen'), utc=True)
+            created = pd.to_datetime(device.get('created'), utc=True)
+            if (pd.notna(last_seen) and last_seen < start_date) or (pd.notna(created) and created >= end_date):
+                offline.append(sn)
+        return offline
+
     def _get_install_data(self):
         """
         Pull sensor installation notes from google drive and modifies dataframe for ease of use.
@@ -55,7 +111,7 @@ class DataImporter(object):
         :returns: a dataframe of sensor install data
         """
         pull_sensor_install_data()
-        df = pd.read_csv('sensor_install_data.csv')
+        df = read_sheet('sensor_install_data')
         df = df[["Timestamp", "Select action", "Sensor serial number (SN)", "Date", "Time",
                  "Location site", "Is the sensor being installed indoors or outdoors?"]]
 
@@ -88,6 +144,7 @@ class DataImporter(object):
 
         return active_sensors
 
+    @profiled('data_month', sensor='sensor_sn')
     def _data_month(self, sensor_sn):
         """
         Gets data for a specific sensor.
@@ -107,10 +164,13 @@ class DataImporter(object):
         # Otherwise download it from API
         except:
             try:
-                # Pull dataframe from API, will return the dataframe and save it as a pickle file
-                df = mod_handler.from_api(sensor_sn)
-            except:
-                # If there is a request protocol error, return an empty dataframe (temp solution)
+                # Pull dataframe from API, will return the dataframe and save it as a pickle file.
+                # A download that hangs is stopped once the sensor is out of time (see utils/watchdog.py)
+                df = watchdog.run('import', mod_handler.from_api, sensor_sn, sensor=sensor_sn)
+            except Exception as e:
+                # If there is a request protocol error or the download ran out of time, return an empty
+                # dataframe (temp solution), and remember why for the run manifest
+                self.errors[sensor_sn] = e
                 return pd.DataFrame()
 
         # If dataframe comes back empty, return it
@@ -133,6 +193,20 @@ class DataImporter(object):
 
         return df
 
+    def load_sensor(self, sensor_sn, columns=None):
+        """
+        Loads the data of a sensor in compact form, used by SensorStore when a sensor is not in memory.
+        Sensors that were already imported are mapped from the month store instead of being unpickled,
+        and only the columns asked for are read.
+
+        :param sensor_sn: (str) The serial number of the sensor to load data for
+        :param columns: (optional list of str) columns to load, defaults to every column
+        :returns: A compact pandas dataframe containing all of the sensor data for the month
+        """
+        if sensor_sn in self.month_store:
+            return self.month_store.frame(sensor_sn, columns)
+        return compact_frame(self._data_month(sensor_sn))
+
     def _get_start_end_dates(self, year_int_YYYY, month_int):
         """
         Creates datetime objects for the start and end of the specified month.
@@ -155,39 +229,89 @@ class DataImporter(object):
         end_date = datetime(next_year, next_month, 1)
         return start_date, end_date
 
-    def get_PM_data(self):
+    def _record_import(self, manifest, sn, df, offline):
+        """
+        Records how the import of a sensor went in the run manifest.
+        """
+        entry = manifest.entry(sn, 'import')
+        entry['rows'] = len(df)
+        if sn in offline:
+            manifest.end(sn, 'import', 'skipped', 'offline all month')
+        elif sn in self.errors:
+            manifest.fail(sn, 'import', self.errors[sn])
+        elif df.empty:
+            manifest.end(sn, 'import', 'empty')
+        else:
+            entry['artifacts'].append(str(self.month_store._dir(sn)))
+            manifest.end(sn, 'import')
+
+    @profiled('get_PM_data', rows=lambda result: len(result[0]))
+    def get_PM_data(self, sn_list=None, manifest=None):
         """
         Collects data from all sensors for the month.
 
+        :param sn_list: (optional list of str) sensors to collect data from, defaults to the sensors installed that month
+        :param manifest: (optional RunManifest) manifest the import of every sensor is recorded in
         :returns: A list of all sensors available from QuantAQ API
-        :returns: A dictionary of sensor serial number keys and pandas dataframes containing sensor data
+        :returns: A SensorStore (a read-only dictionary) of sensor serial number keys and compact pandas dataframes
+                  containing sensor data, loaded again from disk when they are needed (see data_analysis/sensor_store.py)
         """
         # try to get installed sensor list; if there are no credentials, get all sensors
-        try:
-            sn_list = self.get_installed_sensor_list()
-        except:
-            sn_list = self.get_all_sensor_list()
+        if sn_list is None:
+            try:
+                sn_list = self.get_installed_sensor_list()
+            except:
+                sn_list = self.get_all_sensor_list()[0]['sn'].tolist()
         sn_count = len(sn_list)
-        sn_dict = {}
+        sn_dict = SensorStore(sn_list, self.load_sensor)
         print(sn_list)
 
-        sensor_count = 1
+        # skip sensors that were offline all month before making any data requests for them
+        try:
+            offline = self.get_offline_sensors(sn_list)
+        except Exception as e:
+            print(f'Could not check device status ({e}), requesting data for every sensor')
+            offline = []
+        if offline:
+            print(f'Skipping offline sensors: {offline}')
+
+        progress = metrics.Progress('import', sn_count)
         # For every sensor, download DataFrame with data of that sensor and insert it into dictionary
         for sn in sn_list:
             # Print out sensor downloading progress
             print(
-                '\rSensor Progress: {0} / {1}\n'.format(sensor_count, sn_count), end='', flush=True)
+                '\rSensor Progress: {0} / {1}\n'.format(progress.done + 1, sn_count), end='', flush=True)
+            if manifest is not None:
+                manifest.begin(sn, 'import')
             # If sensor data already exists in pickle file, use that
-            df = self._data_month(sn)
-            # Add new dataframe to dictionary
-            sn_dict[sn] = df
-            sensor_count += 1
+            df = pd.DataFrame() if sn in offline else self._data_month(sn)
+            # Add new dataframe to the store, which only keeps a few sensors in memory,
+            # and write it to the month store for loading it again later
+            df = sn_dict.put(sn, compact_frame(df))
+            if not df.empty:
+                self.month_store.write(sn, df)
+                metrics.rows_ingested(len(df), sensor=sn)
+            if manifest is not None:
+                self._record_import(manifest, sn, df, offline)
+            progress.advance(failed=sn in self.errors)
         print('\nDone!')
+        print(f'QuantAQ requests: {request_summary()}')
+        print(f'Sensor data in memory: {sn_dict.stats()["bytes"] / 2**20:.1f} MB')
         return sn_list, sn_dict
 
 
 if __name__ == '__main__':
     (year, month) = (sys.argv[1], sys.argv[2])
+    report_at_exit(f'{int(year)}-{int(month):02d}', 'import_data')
+    metrics.start_exporter('import_data')
+    manifest = RunManifest(f'{int(year)}-{int(month):02d}')
     di = DataImporter(year=int(year), month=int(month))
-    sn_list, sn_dict = di.get_PM_data()
+    if retry_failed() and manifest.sensors:
+        # only download the sensors that failed, the maps still show every sensor of the month
+        sn_list, sn_dict = di.get_PM_data(manifest.to_retry('import'), manifest=manifest)
+        sn_list = list(manifest.sensors)
+        sn_dict = SensorStore(sn_list, di.load_sensor)
+    else:
+        sn_list, sn_dict = di.get_PM_data(manifest=manifest)
     main(sn_list, sn_dict)
+    print(manifest.report(['import']))
@@ -3,57 +3,113 @@ Author: Neel Dhulipala
 Project: Air Partners
 
 Prototype of static reporting pipeline. Used primarily for testing scripts (for now).
+
+Run as a script to plot every figure of a month (python3 plots.py year month [--retry-failed]). make_plots and
+figure_args are also used by the long-running service (see service.py).
 """
 
 from calendar import weekday
 import sys
 from import_data import DataImporter
 from utils.create_plots import *
-from report_generation import generate_report
+from utils.zip_directory import ArchiveBuilder
+from utils.figure_cache import default_store
+from utils.manifest import RunManifest, retry_failed
 import data_analysis.quantaq_pipeline as qp
+from data_analysis.sensor_store import PLOT_COLUMNS
+from utils.profiling import report_at_exit
+from utils import metrics
 from datetime import datetime
 
+# plot functions by name
+PLOT_FUNCTIONS = {f.__name__: f for f in (calendar_plot, timeplot_threshold, diurnal_plot, wind_polar_plot)}
+
+
+def figures(year, month):
+    """
+    Lists the figures of a report, in the order they are plotted.
+
+    :param year: (int) year of the data
+    :param month: (int) month of the data
+    :returns: list of (plot function, pm, keyword arguments) of every figure
+    """
+    return ([(calendar_plot, pm, dict(month=month, year=year)) for pm in ('pm1', 'pm25', 'pm10')]
+            + [(timeplot_threshold, None, {})]
+            + [(diurnal_plot, pm, dict(weekday=weekday)) for weekday in (True, False) for pm in ('pm1', 'pm25', 'pm10')]
+            # wind polar plots (computationally expensive)
+            + [(wind_polar_plot, pm, {}) for pm in ('pm1', 'pm25', 'pm10')])
+
+
+def figure_args(year, month, plot, pm=None, weekday=True):
+    """
+    Finds one figure of a report.
+
+    :param year: (int) year of the data
+    :param month: (int) month of the data
+    :param plot: (str) name of the plot function, e.g. 'diurnal_plot'
+    :param pm: (optional str) 'pm1', 'pm25' or 'pm10', None for the timeplot
+    :param weekday: (optional bool) False for the weekend diurnal plot, ignored by other plots
+    :returns: (plot function, pm, keyword arguments) of the figure
+    """
+    if plot not in PLOT_FUNCTIONS:
+        raise ValueError(f'Unknown plot {plot}, expected one of {sorted(PLOT_FUNCTIONS)}')
+    for plot_function, p, kwargs in figures(year, month):
+        if plot_function.__name__ == plot and p == pm and kwargs.get('weekday', weekday) == weekday:
+            return plot_function, p, kwargs
+    raise ValueError(f'{plot} has no figure for pm={pm}')
+
+
+def make_plots(year, month, sn_list, sn_dict, archive=None, profiles=None, cache=None, manifest=None):
+    """
+    Plots and exports every figure of a month for the given sensors, one sensor at a time.
+    Figures found in the figure store are copied from it instead of being rendered again.
+
+    :param year: (int) year of the data
+    :param month: (int) month of the data
+    :param sn_list: (list of str) serial numbers of the sensors to plot
+    :param sn_dict: (dict) serial number keys and (compact) dataframes containing sensor data
+    :param archive: (optional ArchiveBuilder) archive that figures are added to as they are made
+    :param profiles: (optional list) output profiles to export, see utils/output_profiles.py
+    :param cache: (optional FigureStore) store of exported figures, see utils/figure_cache.py
+    :param manifest: (optional RunManifest) manifest the figures of every sensor are recorded in, see utils/manifest.py
+    """
+    # create date string for data storage
+    date_str = str(year) + '-0' + str(month) if month<=9 else str(year) + '-' + str(month)
+
+    pl = Plotter(date_str, sn_list, sn_dict, profiles=profiles, archive=archive, cache=cache, manifest=manifest)
+    # sensor by sensor, so each sensor's data is loaded once for all of its figures
+    pl.plot_figures(figures(year, month))
+    if cache is not None:
+        stats = cache.stats()
+        print(f"{stats['hits']} figures copied from the figure store, {stats['misses']} rendered")
+        cache.prune()
+
+
+if __name__ == '__main__':
+    # STATICS
+    YEAR = int(sys.argv[1])
+    MONTH = int(sys.argv[2])
+    report_at_exit(f'{YEAR}-{MONTH:02d}', 'plots')
+    # R runs in a process of its own, started before the exporter's and the importer's threads
+    R_WORKER.start()
+    metrics.start_exporter('plots')
+
+    manifest = RunManifest(f'{YEAR}-{MONTH:02d}')
+
+    # Import sensor data
+    di = DataImporter(year=YEAR, month=MONTH)
+    if retry_failed() and manifest.sensors:
+        # only plot the sensors that failed, adding their figures to the month's zip
+        sn_list, sn_dict = di.get_PM_data(manifest.to_retry('plots'))
+        archive = ArchiveBuilder(f'{YEAR}-{MONTH:02d}', append=True)
+    else:
+        sn_list, sn_dict = di.get_PM_data()
+        # start the month's zip, figures are added to it as they are exported
+        archive = ArchiveBuilder(f'{YEAR}-{MONTH:02d}')
+
+    # plot graphs
+    make_plots(YEAR, MONTH, sn_list, sn_dict.select(PLOT_COLUMNS), archive=archive, cache=default_store(),
+               manifest=manifest)
 
-# STATICS
-YEAR = int(sys.argv[1])
-MONTH = int(sys.argv[2])
-
-# Import sensor data
-di = DataImporter(year=YEAR, month=MONTH)
-sn_list, sn_dict = di.get_PM_data()
-
-
-# create date string for data storage
-date_str = str(YEAR) + '-0' + str(MONTH) if MONTH<=9 else str(YEAR) + '-' + str(MONTH)
-
-# plot graphs
-pl = Plotter(date_str, sn_list, sn_dict)
-
-# calendar plots
-pl.plot_and_export(calendar_plot, pm='pm1', month=MONTH, year=YEAR)
-pl.plot_and_export(calendar_plot, pm='pm25',month=MONTH, year=YEAR)
-pl.plot_and_export(calendar_plot, pm='pm10',month=MONTH, year=YEAR)
-print('Calendars plotted')
-plt.close()
-
-# timeplots with thresholds
-pl.plot_and_export(timeplot_threshold, pm=None)
-print('Timelines plotted')
-plt.close()
-
-# diurnal plots
-pl.plot_and_export(diurnal_plot, pm='pm1', weekday=True)
-pl.plot_and_export(diurnal_plot, pm='pm25',weekday=True)
-pl.plot_and_export(diurnal_plot, pm='pm10',weekday=True)
-pl.plot_and_export(diurnal_plot, pm='pm1', weekday=False)
-pl.plot_and_export(diurnal_plot, pm='pm25',weekday=False)
-pl.plot_and_export(diurnal_plot, pm='pm10',weekday=False)
-print('Diurnals plotted')
-plt.close()
-
-# wind polar plots (computationally expensive)
-pl.plot_and_export(wind_polar_plot, pm='pm1')
-pl.plot_and_export(wind_polar_plot, pm='pm25')
-pl.plot_and_export(wind_polar_plot, pm='pm10')
-print('Wind polar plots plotted')
-plt.close()
+    archive.close()
+    print(manifest.report(['plots']))
@@ -3,14 +3,17 @@ Author: Andrew DeCandia
 Project: Air Partners
 
 Script for pulling form data from google drives.
+
+Exports are cached: each sheet's modifiedTime and version are checked first, and the sheet is only
+exported again when it has changed. The CSVs are also stored parsed (as pickles), so pipeline stages
+read them with read_sheet instead of going to the network. The google client libraries are only
+loaded when a sheet is pulled, reading cached sheets does not need them.
 """
 from __future__ import print_function
 import os.path
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+import json
+import pickle
+import pandas as pd
 import requests
 
 from utils.refresh_google_token import refreshToken
@@ -18,11 +21,127 @@ from utils.refresh_google_token import refreshToken
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/drive']
 
+ITEMS = {'maillist': '17GP7PlQYxr1A1_1srrSDpLjCplLztdHWG51XY2qZoVo',
+         'sensor_install_data': '15DDTqQkXqD16vCnOBBTz9mPUmVWnKywjxdNWF9N6Gcg'}
+# modifiedTime and version of the last export of each sheet
+CACHE_PATH = 'drive_cache.json'
+# sheets already checked for changes by this process, so repeated calls in one run stay offline
+_checked = set()
+# set to point the Drive client at another server, e.g. a local stand-in (see benchmarks/stand_ins.py)
+API_URL_VAR = 'DRIVE_API_URL'
+# Drive client of this process, see get_service
+_service = None
+
+
+def _load_cache():
+    try:
+        with open(CACHE_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache):
+    with open(CACHE_PATH, 'w') as f:
+        json.dump(cache, f, indent=2)
+
+
+def _store_parsed(key):
+    """
+    Parse a downloaded CSV and store the dataframe next to it, so it does not need parsing again.
+
+    :param key: (str) name of the sheet
+    :returns: the parsed dataframe
+    """
+    df = pd.read_csv(f'{key}.csv')
+    with open(f'{key}.pckl', 'wb') as f:
+        pickle.dump(df, f)
+    return df
+
+
+def read_sheet(key):
+    """
+    Read a sheet exported from google drive, from the local cache.
+    The sheet is only pulled from google drive if it has never been downloaded.
+
+    :param key: (str) name of the sheet, e.g. 'sensor_install_data'
+    :returns: pandas dataframe of the sheet
+    """
+    if not os.path.exists(f'{key}.csv'):
+        pull_sensor_install_data()
+    if os.path.exists(f'{key}.pckl') and os.path.getmtime(f'{key}.pckl') >= os.path.getmtime(f'{key}.csv'):
+        with open(f'{key}.pckl', 'rb') as f:
+            return pickle.load(f)
+    return _store_parsed(key)
+
+
+def pull_sensor_install_data(force=False):
+    """
+    Exports the mailing list and sensor install data sheets to CSV, if they have changed since they were last exported.
+
+    :param force: (optional bool) True to check google drive again even if this process already did
+    """
+    if not force and _checked.issuperset(ITEMS):
+        return
+    from googleapiclient.errors import HttpError
+
+    try:
+        service = get_service()
+        cache = _load_cache()
+
+        print('Pulling sensor install data from google drive...')
+        for key in ITEMS:
+            # Only export the sheet if it changed since the last export
+            meta = service.files().get(fileId=ITEMS[key], fields='modifiedTime,version').execute()
+            if cache.get(key) == meta and os.path.exists(f'{key}.csv'):
+                print(f'{key} unchanged, using cached copy')
+            else:
+                # Call the Drive v3 API
+                info = service.files().export(
+                    fileId=ITEMS[key], mimeType='text/csv').execute()
+                with open(f'{key}.csv', 'wb') as f:
+                    f.write(info)
+                _store_parsed(key)
+                cache[key] = meta
+                _save_cache(cache)
+            _checked.add(key)
+
+    except HttpError as error:
+        # TODO(developer) - Handle errors from drive API.
+        print(f'An error occurred: {error}')
+
+
+def get_service():
+    """
+    Gets the Drive client, logging in and building it on first use. The client is kept for the rest of
+    the process, its credentials are refreshed when they expire.
 
-def pull_sensor_install_data():
+    :returns: googleapiclient Resource of the Drive v3 API
     """
-    Prints the names and ids of the first 10 files the user has access to.
+    global _service
+    if _service is None:
+        from google.auth.credentials import AnonymousCredentials
+        from googleapiclient.discovery import build
+        api_url = os.environ.get(API_URL_VAR)
+        if api_url and not os.path.exists('token.json'):
+            # a stand-in server needs no google account
+            creds = AnonymousCredentials()
+        else:
+            creds = _get_credentials()
+        _service = build('drive', 'v3', credentials=creds,
+                         client_options={'api_endpoint': api_url} if api_url else None)
+    return _service
+
+
+def _get_credentials():
     """
+    Gets credentials of the google account, logging in if needed.
+
+    :returns: google.oauth2.credentials.Credentials
+    """
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
     # After authorization flow has run for the first time, token must be refreshed
     refreshToken()
     creds = None
@@ -42,24 +161,7 @@ def pull_sensor_install_data():
         # Save the credentials for the next run
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
-
-    try:
-        service = build('drive', 'v3', credentials=creds)
-
-        items = {'maillist': '17GP7PlQYxr1A1_1srrSDpLjCplLztdHWG51XY2qZoVo',
-                 'sensor_install_data': '15DDTqQkXqD16vCnOBBTz9mPUmVWnKywjxdNWF9N6Gcg'}
-
-        print('Pulling sensor install data from google drive...')
-        for key in items:
-            # Call the Drive v3 API
-            info = service.files().export(
-                fileId=items[key], mimeType='text/csv').execute()
-            with open(f'{key}.csv', 'wb') as f:
-                f.write(info)
-
-    except HttpError as error:
-        # TODO(developer) - Handle errors from drive API.
-        print(f'An error occurred: {error}')
+    return creds
 
 
 if __name__ == '__main__':
@@ -4,31 +4,167 @@ Project: Air Partners
 
 Functions to collect figures into a static report PDF
 """
-import os, sys
+import os
+import sys
+import json
 import datetime as dt
+import img2pdf
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
 from pathlib import Path
-from fpdf import FPDF
-from PIL import Image
-from import_data import DataImporter
+from utils.output_profiles import export_figure, get_profiles
+from utils.create_booklet import build_booklet
+from utils.zip_directory import ArchiveBuilder
+from utils.profiling import profiled, report_at_exit
+from utils.manifest import RunManifest, retry_failed
+from utils import metrics, watchdog
+
+# Pages are A4, with the report image placed 210mm x 280mm in the middle of the page
+PAGE_SIZE = (img2pdf.mm_to_pt(210), img2pdf.mm_to_pt(297))
+IMAGE_SIZE = ((img2pdf.ImgSize.abs, img2pdf.mm_to_pt(210)), (img2pdf.ImgSize.abs, img2pdf.mm_to_pt(280)))
+PAGE_COUNT = 2
+# scripts run with this flag also write the network booklet
+BOOKLET_FLAG = '--booklet'
+
+
+def generate_report(month, year, sn, profiles=None):
+    generator = ReportGenerator(month, year, sn, profiles)
+    generator.generate_report()
 
 
-def generate_report(month, year, sn):
-    generator = ReportGenerator(month, year, sn)
-    generator.generate_report()
+def images_to_pdf(img_paths, pdf_path, layout=None):
+    """
+    Writes JPEG images into a PDF, one image per page, in the order given.
+    The JPEG streams are embedded as they are, without being decoded or re-encoded.
+
+    :param img_paths: (list of str) paths of the JPEG pages, in page order
+    :param pdf_path: (str) path of the PDF to write
+    :param layout: (optional callable) img2pdf layout function of the pages, made from PAGE_SIZE and IMAGE_SIZE by default
+    :returns: none, makes a PDF file
+    """
+    if layout is None:
+        layout = img2pdf.get_layout_fun(pagesize=PAGE_SIZE, imgsize=IMAGE_SIZE)
+    pdf_bytes = img2pdf.convert(img_paths, layout_fun=layout)
+    Path(pdf_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(pdf_path, 'wb') as f:
+        f.write(pdf_bytes)
+
+
+def images_to_pdfs(jobs):
+    """
+    Writes many PDFs in one call, e.g. the reports of every sensor, all with the same page layout.
+
+    :param jobs: (list of (list of str, str)) pairs of page image paths and the PDF path they go in
+    :returns: list of PDF paths written
+    """
+    # every report has the same pages, the layout is worked out once for all of them
+    layout = img2pdf.get_layout_fun(pagesize=PAGE_SIZE, imgsize=IMAGE_SIZE)
+    written = []
+    for img_paths, pdf_path in jobs:
+        images_to_pdf(img_paths, pdf_path, layout)
+        written.append(pdf_path)
+    return written
+
+
+@profiled('report_pdfs', rows=len)
+def create_report_pdfs(month, year, sn_list, profiles=None, archive=None):
+    """
+    Makes the PDF reports of several sensors in one batch.
+    Report images of every sensor MUST be created first.
+
+    :param month: (int) month of the reports
+    :param year: (int) year of the reports
+    :param sn_list: (list of str) serial numbers of the sensors
+    :param profiles: (optional list) output profiles to make PDFs for
+    :param archive: (optional ArchiveBuilder) archive that PDFs are added to as they are written
+    :returns: list of PDF paths written
+    """
+    jobs = []
+    for sn in sn_list:
+        jobs.extend(ReportGenerator(month, year, sn, profiles).pdf_jobs())
+    written = images_to_pdfs(jobs)
+    if archive is not None:
+        archive.add(written)
+    return written
+
+def make_reports(month, year, sn_list, archive=None, booklet=False, booklet_sensors=None, manifest=None):
+    """
+    Makes the report images and PDFs of several sensors, and (optionally) the network booklet.
+    Sensors whose report cannot be made (e.g. because figures are missing) are skipped.
+
+    :param month: (int) month of the reports
+    :param year: (int) year of the reports
+    :param sn_list: (list of str) serial numbers of the sensors
+    :param archive: (optional ArchiveBuilder) archive that reports are added to as they are made
+    :param booklet: (optional bool) True to also export booklet pages and write the network booklet
+    :param booklet_sensors: (optional list of str) sensors in the booklet, defaults to the sensors whose reports were made
+    :param manifest: (optional RunManifest) manifest the report of every sensor is recorded in, see utils/manifest.py
+    :returns: list of serial numbers of the sensors whose reports were made
+    """
+    # generate report images for each sensor
+    finished = []
+    progress = metrics.Progress('report_images', len(sn_list))
+    for sn in sn_list:
+        generator = ReportGenerator(month, year, sn, booklet=booklet, archive=archive)
+        try:
+            # the pages of a sensor have a time budget, see utils/watchdog.py
+            if manifest is None:
+                watchdog.run('report', generator._create_report_image, sensor=sn)
+            else:
+                manifest.begin(sn, 'report')
+                with manifest.record(sn, 'report') as entry:
+                    watchdog.run('report', generator._create_report_image, sensor=sn)
+                    entry['artifacts'].extend(str(p) for pages, _ in generator.pdf_jobs() for p in pages)
+            finished.append(sn)
+            progress.advance()
+            print(f"Finished report {sn} ({progress}).")
+        except Exception as e:
+            plt.close('all')
+            progress.advance(failed=True)
+            print(f"No report generated {sn}.")
+            if manifest is not None:
+                manifest.fail(sn, 'report', e)
+    # write the PDFs of every finished report in one batch
+    written = create_report_pdfs(month, year, finished, archive=archive)
+    if manifest is not None:
+        for sn in finished:
+            with manifest.record(sn, 'report') as entry:
+                entry['artifacts'].extend(str(p) for p in written if os.path.basename(str(p)).startswith(f'{sn}_'))
+            manifest.end(sn, 'report')
+    # write one booklet for the whole network
+    if booklet:
+        path = build_booklet(month, year, finished if booklet_sensors is None else booklet_sensors)
+        if archive is not None:
+            archive.add(path)
+    return finished
+
 
 class ReportGenerator:
 
-    def __init__(self, month, year, sn):
+    def __init__(self, month, year, sn, profiles=None, booklet=False, archive=None):
+        """
+        Args:
+            month: (int) month of the report
+            year: (int) year of the report
+            sn: (str) serial number of the sensor the report is for
+            profiles: (optional list) output profiles to export pages for, see utils/output_profiles.py
+            booklet: (optional bool) True if pages for the network booklet should also be exported
+            archive: (optional ArchiveBuilder) archive that pages are added to as they are made
+        """
         self.month = month
         self.year = year
         self.sn = sn
+        self.profiles = profiles
+        self.booklet = booklet
+        self.archive = archive
+        # shared images (logos, etc.) drawn on the current page, as (image path, AxesImage) pairs
+        self._assets = []
         # Convert to date object
         date_obj = dt.date(year, month, 1)
         # format strings for current and previous month
         self.year_month = date_obj.isoformat()[:-3]
 
+    @profiled('report_image', sensor='self.sn')
     def _create_report_image(self):
         """
         Create JPEG file of static report with compiled visualizations and captions.
@@ -42,13 +178,23 @@ class ReportGenerator:
 
             :param plot_function: string representing function used to create plot.
             :param pm: string with particulate matter for graph, set to None for timeplot
-            :returns: none
+            :returns: the AxesImage drawn
             """
 
             plt.grid(0);plt.yticks([]);plt.xticks([])
             img = mpimg.imread(img_path)
-            plt.imshow(img)
-        
+            return plt.imshow(img)
+
+        def import_and_plot_asset(img_path):
+            """
+            Plot an image that is the same on every report (logos, etc.) and remember where it was drawn,
+            so the booklet can embed it once instead of on every page.
+            """
+            self._assets.append((img_path, import_and_plot_img(img_path)))
+
+        # images of a page an earlier attempt did not finish (e.g. one that ran out of time) are not on this page
+        self._assets = []
+
         ################# FIRST PAGE ############################
 
         fig = plt.figure(figsize=(8.5,11))
@@ -61,14 +207,10 @@ class ReportGenerator:
         
         ## Logos
         fig.add_subplot(grid[:2,:1], frameon=False)
-        plt.grid(0);plt.yticks([]);plt.xticks([])
-        air_img = plt.imread('_images/airpartners_logo.png', )
-        plt.imshow(air_img)
+        import_and_plot_asset('_images/airpartners_logo.png')
 
         fig.add_subplot(grid[:2,8:], frameon=False)
-        plt.grid(0);plt.yticks([]);plt.xticks([])
-        ace_img = plt.imread('_images/ace_logo.png')
-        plt.imshow(ace_img)
+        import_and_plot_asset('_images/ace_logo.png')
         
         ## Title
         fig.add_subplot(grid[:2,2:7], frameon=False)
@@ -160,8 +302,7 @@ class ReportGenerator:
 
         ## Particle Sizes
         fig.add_subplot(grid[16:20,:6], frameon=False)
-        plt.grid(0);plt.yticks([]);plt.xticks([])
-        import_and_plot_img('_images/particle_sizes.png')
+        import_and_plot_asset('_images/particle_sizes.png')
         
         ## Map
         fig.add_subplot(grid[16:20,6:], frameon=False)
@@ -169,11 +310,8 @@ class ReportGenerator:
         import_and_plot_img('_images/locs/{0}.png'.format(self.sn))
 
 
-        # Create Pictures directory in Reports directory (if exists, does nothing)
-        folders = f'{self.year_month}/Reports/Pictures/{self.sn}'
-        Path(folders).mkdir(parents=True, exist_ok=True)
-        # Save first page
-        plt.savefig('{1}/Reports/Pictures/{0}/{1}_{2}_pg_2.jpeg'.format(self.sn,self.year_month,str('Report')), bbox_inches='tight',dpi = 300)
+        # Save first page (export creates the Pictures directory if it does not exist)
+        self._export_page(fig, 1)
         plt.close()
 
         ############### SECOND PAGE ####################
@@ -182,14 +320,10 @@ class ReportGenerator:
 
         ## Logos
         fig2.add_subplot(grid2[:2,:1], frameon=False)
-        plt.grid(0);plt.yticks([]);plt.xticks([])
-        air_img = plt.imread('_images/airpartners_logo.png', )
-        plt.imshow(air_img)
+        import_and_plot_asset('_images/airpartners_logo.png')
 
         fig2.add_subplot(grid2[:2,8:], frameon=False)
-        plt.grid(0);plt.yticks([]);plt.xticks([])
-        ace_img = plt.imread('_images/ace_logo.png')
-        plt.imshow(ace_img)
+        import_and_plot_asset('_images/ace_logo.png')
         
         ## Title
         fig2.add_subplot(grid2[:2,:], frameon=False)
@@ -257,41 +391,86 @@ class ReportGenerator:
         )
 
         # Save second page
-        plt.savefig('{1}/Reports/Pictures/{0}/{1}_{2}_pg_1.jpeg'.format(self.sn,self.year_month,str('Report')), bbox_inches='tight',dpi = 300)
+        self._export_page(fig2, 2)
         plt.close()
 
 
+    def _export_page(self, fig, page):
+        """
+        Export a finished report page for every output profile, and for the booklet if requested.
+
+        :param fig: (matplotlib.figure.Figure) the report page
+        :param page: (int) page number
+        """
+        if self.booklet:
+            self._export_booklet_page(fig, page)
+        paths = export_figure(fig, self.year_month, 'Reports/Pictures/{0}/{1}_{2}_pg_{3}.jpeg'.format(self.sn,self.year_month,str('Report'),page), self.profiles)
+        if self.archive is not None:
+            self.archive.add(paths)
+        self._assets = []
+
+    def _export_booklet_page(self, fig, page):
+        """
+        Export a page without its shared images, along with where those images belong on the page,
+        so the booklet can draw them from a single embedded copy.
+
+        :param fig: (matplotlib.figure.Figure) the report page
+        :param page: (int) page number
+        """
+        for _, img in self._assets:
+            img.set_visible(False)
+        # find the area savefig(bbox_inches='tight') will crop to, in inches
+        fig.canvas.draw()
+        renderer = fig.canvas.get_renderer()
+        bbox = fig.get_tightbbox(renderer).padded(plt.rcParams['savefig.pad_inches'])
+        placements = []
+        for img_path, img in self._assets:
+            ext = img.get_window_extent(renderer)
+            # position of the image as fractions of the exported page, origin at the bottom left
+            placements.append({
+                'asset': img_path,
+                'box': [(ext.x0/fig.dpi - bbox.x0)/bbox.width, (ext.y0/fig.dpi - bbox.y0)/bbox.height,
+                        (ext.x1/fig.dpi - bbox.x0)/bbox.width, (ext.y1/fig.dpi - bbox.y0)/bbox.height]
+            })
+        rel_path = 'Reports/Booklet/{0}/{1}_{2}_pg_{3}'.format(self.sn,self.year_month,str('Report'),page)
+        export_figure(fig, self.year_month, f'{rel_path}.jpeg', ['print'])
+        with open(f'{self.year_month}/{rel_path}.json', 'w') as f:
+            json.dump(placements, f)
+        for _, img in self._assets:
+            img.set_visible(True)
+
+    def page_paths(self, profile='print'):
+        """
+        Gets the paths of the report page images in page order.
+
+        :param profile: (optional str or OutputProfile) output profile of the images
+        :returns: list of paths to JPEG pages
+        """
+        profile = get_profiles([profile])[0]
+        return [profile.path(self.year_month, 'Reports/Pictures/{0}/{1}_{2}_pg_{3}.jpeg'.format(self.sn,self.year_month,str('Report'),pg))
+                for pg in range(1, PAGE_COUNT+1)]
+
+    def pdf_jobs(self):
+        """
+        Gets the page images and PDF path of this report for every output profile.
+
+        :returns: list of (page image paths, PDF path) pairs
+        """
+        return [(self.page_paths(profile),
+                 profile.path(self.year_month, 'Reports/PDFs/{0}_{1}_{2}.pdf'.format(self.sn,self.year_month,str('Report'))))
+                for profile in get_profiles(self.profiles)]
+
     def _create_report_pdf(self):
         """
         Makes a PDF copy of the jpeg version of the report.
         _create_report_image MUST be run first.
         """
-        
-        def images_to_pdf(imgs_path, pdf_path):
-            # initialize PDF
-            pdf = FPDF()
-            pdf.set_auto_page_break(0)
-            
-            img_list = [f'{imgs_path}/{img}' for img in os.listdir(imgs_path)]
-            # add pages for each image and place image on page
-            for img in img_list:
-                # add page with the same size as image
-                pdf.add_page()
-                pdf.image(img, 0, 8, 210, 280)
-                # close the image to save on memory
-                Image.open(img).close()
-            # save output into assigned PDF path
-            pdf.output(pdf_path)
-            pdf.close()
-
-        # Create PDFs directory in Reports directory (if exists, does nothing)
-        folders = f'{self.year_month}/Reports/PDFs'
-        Path(folders).mkdir(parents=True, exist_ok=True)
-        # Convert images to PDFs
-        images_to_pdf('{1}/Reports/Pictures/{0}'.format(self.sn,self.year_month),
-                    '{1}/Reports/PDFs/{0}_{1}_{2}.pdf'.format(self.sn,self.year_month,str('Report')))
+        written = images_to_pdfs(self.pdf_jobs())
+        if self.archive is not None:
+            self.archive.add(written)
 
     
+    @profiled('generate_report', sensor='self.sn')
     def generate_report(self):
         """
         Generate a JPEG and PDF report for a given month and year
@@ -303,15 +482,24 @@ class ReportGenerator:
 if __name__=='__main__':
     # get year and month from sys args
     year, month = int(sys.argv[1]), int(sys.argv[2])
-    # Import sensor data from pickles
+    report_at_exit(f'{year}-{month:02d}', 'report_generation')
+    metrics.start_exporter('report_generation')
+    # Import sensor data from pickles. Imported here, the importer loads the QuantAQ and Drive clients,
+    # which only this script entry point needs
+    from import_data import DataImporter
     di = DataImporter(year=year, month=month)
     sn_list = di.get_installed_sensor_list()
-
-    # generate reports for each sensor
-    for sn in sn_list:
-        try:
-            generate_report(month, year, sn)
-            print(f"Finished report {sn}.")
-        except:
-            print(f"No report generated {sn}.")
+    manifest = RunManifest(f'{year}-{month:02d}')
+
+    # add reports to the month's zip as they are made
+    archive = ArchiveBuilder(dt.date(year, month, 1).isoformat()[:-3], append=True)
+    booklet = BOOKLET_FLAG in sys.argv
+    if retry_failed() and manifest.sensors:
+        # only make the reports that failed, the booklet still has every sensor with booklet pages
+        make_reports(month, year, manifest.to_retry('report'), archive=archive, booklet=booklet,
+                     booklet_sensors=sn_list, manifest=manifest)
+    else:
+        make_reports(month, year, sn_list, archive=archive, booklet=booklet, manifest=manifest)
+    archive.close()
+    print(manifest.report(['report']))
     # generate_report(6, 2022, "MOD-PM-00217")
\ No newline at end of file
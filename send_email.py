@@ -4,8 +4,11 @@ Project: Air Partners
 
 Script for sending emails with attachments from a gmail account.
 """
+import os
 import smtplib
 import sys
+import time
+import threading
 import pandas as pd
 import datetime as dt
 from dateutil.relativedelta import relativedelta
@@ -15,32 +18,27 @@ from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.utils import COMMASPACE, formatdate
 from email import encoders
+from concurrent.futures import ThreadPoolExecutor
 from utils.zip_directory import zip_directory
 from utils.dropbox_util import upload_zip
-from utils.dropbox_util import delete_zip
+from pull_from_drive import read_sheet
+from utils.profiling import profiled, report_at_exit
+from utils.manifest import RunManifest
+from utils import metrics
 
 
-def send_mail(send_from, send_to, subject, message, files=[],
-              server="localhost", port=587, username='', password='',
-              use_tls=True):
+def build_message(send_from, subject, message, files=[]):
     """
-    Compose and send email with provided info and attachments.
+    Compose an email with provided info and attachments, without any recipients.
 
     :param send_from: (str) from name
-    :param send_to: (list[str]) to name(s)
     :param subject (str): message title
     :param message (html): message body
     :param files (list[str]): list of file paths to be attached to email
-    :param server (str): mail server host name
-    :param port (int): port number
-    :param username (str): server auth username
-    :param password (str): server auth password
-    :param use_tls (bool): use TLS mode
-    :returns: none, sends an email
+    :returns: MIMEMultipart message
     """
     msg = MIMEMultipart()
     msg['From'] = send_from
-    msg['To'] = COMMASPACE.join(send_to)
     msg['Date'] = formatdate(localtime=True)
     msg['Subject'] = subject
 
@@ -54,19 +52,145 @@ def send_mail(send_from, send_to, subject, message, files=[],
         part.add_header('Content-Disposition',
                         'attachment; filename={}'.format(Path(path).name))
         msg.attach(part)
+    return msg
 
+
+def _connect(server, port, username, password, use_tls):
+    """
+    Open an SMTP connection and log in. Logging in is skipped when there is no username
+    (e.g. for a local SMTP server used for testing).
+    """
     smtp = smtplib.SMTP(server, port)
     if use_tls:
         smtp.starttls()
-    smtp.login(username, password)
+    if username:
+        smtp.login(username, password)
+    return smtp
+
+
+def send_mail(send_from, send_to, subject, message, files=[],
+              server="localhost", port=587, username='', password='',
+              use_tls=True):
+    """
+    Compose and send email with provided info and attachments.
+
+    :param send_from: (str) from name
+    :param send_to: (list[str]) to name(s)
+    :param subject (str): message title
+    :param message (html): message body
+    :param files (list[str]): list of file paths to be attached to email
+    :param server (str): mail server host name
+    :param port (int): port number
+    :param username (str): server auth username
+    :param password (str): server auth password
+    :param use_tls (bool): use TLS mode
+    :returns: none, sends an email
+    """
+    msg = build_message(send_from, subject, message, files)
+    msg['To'] = COMMASPACE.join(send_to)
+
+    smtp = _connect(server, port, username, password, use_tls)
     smtp.sendmail(send_from, send_to, msg.as_string())
     smtp.quit()
 
 
-if __name__ == '__main__':
-    # get year and month from sys args
-    year, month = int(sys.argv[1]), int(sys.argv[2])
+@profiled('send_bulk_mail', rows=len)
+def send_bulk_mail(send_from, recipients, subject, message, files=[],
+                   server="localhost", port=587, username='', password='',
+                   use_tls=True, connections=2, max_per_second=2, max_attempts=3):
+    """
+    Send the same email to every recipient individually (so recipients stay anonymous to each other).
+
+    The message and its attachments are built once. Emails are sent over a small pool of persistent,
+    logged in SMTP connections, at no more than max_per_second emails per second in total. Failed sends
+    are retried on a fresh connection.
+
+    :param send_from: (str) from name
+    :param recipients: (list[str]) email addresses to send to, one email each
+    :param subject (str): message title
+    :param message (html): message body
+    :param files (list[str]): list of file paths to be attached to email
+    :param server (str): mail server host name
+    :param port (int): port number
+    :param username (str): server auth username
+    :param password (str): server auth password
+    :param use_tls (bool): use TLS mode
+    :param connections (int): number of SMTP connections to send over at once
+    :param max_per_second (float): rate limit across all connections
+    :param max_attempts (int): number of times to try each recipient
+    :returns: dict of recipients and their delivery status ('sent', the last error, or 'not attempted')
+    """
+    # Every email is the same apart from the To header, so the message is only rendered once
+    body = build_message(send_from, subject, message, files).as_string()
 
+    lock = threading.Lock()
+    next_send = [time.monotonic()]
+
+    def _wait_for_turn():
+        # space sends evenly so the pool as a whole stays under the rate limit
+        with lock:
+            now = time.monotonic()
+            wait = next_send[0] - now
+            next_send[0] = max(now, next_send[0]) + 1 / max_per_second
+        if wait > 0:
+            time.sleep(wait)
+
+    local = threading.local()
+    pool_smtps = []
+    progress = metrics.Progress('send_email', len(recipients))
+
+    def _send(email):
+        status = 'not attempted'
+        for attempt in range(max_attempts):
+            try:
+                if getattr(local, 'smtp', None) is None:
+                    local.smtp = _connect(server, port, username, password, use_tls)
+                    with lock:
+                        pool_smtps.append(local.smtp)
+                _wait_for_turn()
+                s = time.monotonic()
+                local.smtp.sendmail(send_from, [email], f'To: {email}\n' + body)
+                metrics.observe('pipeline_request_seconds', time.monotonic() - s, service='smtp', status='sent')
+                print(f'{email}: sent')
+                progress.advance()
+                return email, 'sent'
+            except (smtplib.SMTPException, OSError) as e:
+                status = f'failed ({e})'
+                print(f'{email}: attempt {attempt + 1} {status}')
+                # drop the connection, the next attempt (or recipient) opens a new one
+                try:
+                    local.smtp.close()
+                except Exception:
+                    pass
+                local.smtp = None
+                metrics.inc('pipeline_failures_total', stage='smtp_send')
+                if attempt < max_attempts - 1:
+                    time.sleep(2**attempt)
+        progress.advance(failed=True)
+        return email, status
+
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        statuses = dict(pool.map(_send, recipients))
+
+    for smtp in pool_smtps:
+        try:
+            smtp.quit()
+        except Exception:
+            pass
+
+    sent = sum(status == 'sent' for status in statuses.values())
+    print(f'Sent {sent} / {len(statuses)} emails.')
+    return statuses
+
+
+def send_reports(year, month):
+    """
+    Zips a month's reports, uploads the zip to Dropbox and emails every subscriber.
+
+    :param year: (int) year of the reports
+    :param month: (int) month of the reports
+    :returns: dict of subscribers and their delivery status, also written to logs/{year_month}_delivery_log.csv
+    """
     # Convert to date object
     date_obj = dt.date(year, month, 1)
     # format strings for current and previous month
@@ -74,26 +198,28 @@ if __name__ == '__main__':
 
     # create zip file
     zip_directory(year_month)
-    # upload zip file to Dropbox; if file already exists, replace it
-    try:
-        upload_zip(year_month)
-    except:
-        delete_zip(year_month)
-        upload_zip(year_month)
+    # upload zip file to Dropbox; if file already exists, it is overwritten in place
+    upload_zip(year_month)
 
-    # Get password from saved location
-    with open('app_password.txt', 'r') as f:
-        password = f.read()
+    # SMTP_SERVER (host:port) sends through another server, e.g. a local stand-in (see benchmarks/stand_ins.py),
+    # without logging in
+    if os.environ.get('SMTP_SERVER'):
+        server, port = os.environ['SMTP_SERVER'].rsplit(':', 1)
+        smtp_settings = dict(server=server, port=int(port), username='', password='', use_tls=False)
+    else:
+        # Get password from saved location
+        with open('app_password.txt', 'r') as f:
+            password = f.read()
+        smtp_settings = dict(server='smtp.gmail.com', username='airpartners@airpartners.org', password=password)
 
     # Get list of subscribed emails to send to
-    df = pd.read_csv('maillist.csv')
+    df = read_sheet('maillist')
     df = df.loc[df['Status of Subscription'] == 'Subbed']
     mailing_list = df['Emails'].tolist()
 
     # Send emails individually to preserve anonymity of subscribers
-    for email in mailing_list:
-        send_mail(send_from= "Air Partners Reports <reports@airpartners.org>",
-              send_to=[email],
+    statuses = send_bulk_mail(send_from= "Air Partners Reports <reports@airpartners.org>",
+              recipients=mailing_list,
               subject=f'Air Quality Reports {year_month}',
               message="""
               <a href="https://www.dropbox.com/sh/spwnq0yqvjvewax/AADk0c2Tum-7p_1ul6xiKzrPa?dl=0">These reports</a> 
@@ -106,4 +232,19 @@ if __name__ == '__main__':
               Long Link:<br>https://www.dropbox.com/sh/spwnq0yqvjvewax/AADk0c2Tum-7p_1ul6xiKzrPa?dl=0<br><br>
               Best regards,<br>Air Partners<br><br><br>
               <a href="https://forms.gle/z9jPc8QNVRCCyChQ7">Unsubscribe</a>""",
-              server='smtp.gmail.com', username='airpartners@airpartners.org', password=password)
+              **smtp_settings)
+
+    # Log delivery status of every subscriber
+    Path('logs').mkdir(exist_ok=True)
+    pd.DataFrame(statuses.items(), columns=['Emails', 'Status']).to_csv(f'logs/{year_month}_delivery_log.csv', index=False)
+    return statuses
+
+
+if __name__ == '__main__':
+    # get year and month from sys args
+    year, month = int(sys.argv[1]), int(sys.argv[2])
+    report_at_exit(f'{year}-{month:02d}', 'send_email')
+    metrics.start_exporter('send_email')
+    send_reports(year, month)
+    # the last script of the run, summarize every stage
+    print(RunManifest(f'{year}-{month:02d}').report())
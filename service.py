@@ -0,0 +1,413 @@
+"""
+Project: Air Partners
+
+Long-running service that keeps the pipeline warm between jobs.
+
+Every script of pipeline.sh starts cold: it imports matplotlib, seaborn, R and openair, logs in to
+QuantAQ, Google Drive and Dropbox, and loads fonts before doing any work. The service does all of this
+once when it starts, keeps sensor data of recent months in memory, and then runs jobs sent to it over a
+local socket, so a rerun or an ad-hoc regeneration only costs its own compute:
+
+    python3 service.py serve                                      # start the service
+    python3 service.py monthly 2022 6 [--no-email] [--retry-failed] [--booklet]   # the whole monthly run, like pipeline.sh
+    python3 service.py sensor 2022 6 MOD-PM-00217 [--booklet]     # re-render one sensor's figures and report
+    python3 service.py figure 2022 6 MOD-PM-00217 diurnal_plot --pm pm25 --weekend   # re-render one figure
+    python3 figure.py 2022 6 calendar_plot MOD-PM-00217 pm25      # render one figure, see figure.py
+    python3 service.py status                                     # running, queued and finished jobs
+    python3 service.py stop                                       # stop once the queued jobs are done
+
+Jobs run one at a time in the order they were sent (matplotlib and R are not thread safe). Clients wait
+for their job to finish unless --no-wait is given. Figures rendered for figure.py are kept in a
+size-bounded cache (see utils/figure_cache.py), figures found there are answered without queueing. Every job writes its own entry (service_{kind}) to
+the month's run report, and the service's metrics are exported like the scripts' (see utils/metrics.py).
+"""
+
+import os
+import sys
+import io
+import base64
+import json
+import time
+import queue
+import argparse
+import itertools
+import threading
+import traceback
+import socketserver
+from collections import deque
+from datetime import datetime
+import matplotlib.pyplot as plt
+import utils.create_plots as create_plots
+import utils.create_maps as create_maps
+from import_data import DataImporter
+from plots import PLOT_FUNCTIONS, figure_args, make_plots
+from report_generation import make_reports
+from send_email import send_reports
+from pull_from_drive import get_service, pull_sensor_install_data
+from data_analysis.quantaq_client import get_client
+from data_analysis.sensor_store import SensorStore, PLOT_COLUMNS
+from utils.create_plots import Plotter
+from utils.dropbox_util import get_transfer_data
+from utils.zip_directory import ArchiveBuilder
+from utils.figure_cache import FigureCache, default_store
+from utils.manifest import RunManifest
+from utils.service_client import SOCKET_PATH, request
+from figure import figure_key, render_figure
+from utils import metrics, profiling
+
+JOB_KINDS = ('monthly', 'sensor', 'figure', 'render')
+# finished jobs listed by status
+HISTORY = 50
+# months of sensor data kept in memory
+MONTHS_KEPT = 2
+
+
+def _warm_plotting():
+    # draw and save a throwaway figure with text, so fonts and the renderer are loaded before the first job
+    import seaborn
+    fig = plt.figure()
+    plt.title('PM₂.₅ (μg/m³)')
+    plt.plot([0, 1], [0, 1])
+    fig.savefig(io.BytesIO(), format='jpeg')
+    plt.close(fig)
+
+
+def _warm_dropbox():
+    get_transfer_data().dbx.check_and_refresh_access_token()
+
+
+class PipelineService(object):
+    """
+    Runs pipeline jobs one at a time, keeping libraries, logged in clients and sensor data in memory.
+    """
+
+    def __init__(self, socket_path=SOCKET_PATH):
+        """
+        Args:
+            socket_path: (optional str) path of the unix socket jobs are sent to
+        """
+        self.socket_path = socket_path
+        self.jobs = queue.Queue()
+        self.running = None
+        self.finished = deque(maxlen=HISTORY)
+        # year_month -> (DataImporter, SensorStore of plot columns), most recently used last
+        self._months = {}
+        self._ids = itertools.count(1)
+        self._done = {}
+        self._server = None
+        self.figures = FigureCache()
+
+    def warm_up(self):
+        """
+        Imports the plotting libraries, loads R and openair, and logs in to every service. Steps that fail
+        (e.g. for missing credentials) are skipped, jobs that need them will fail with the reason.
+        """
+        steps = [('matplotlib, seaborn and fonts', _warm_plotting),
+                 ('R and openair', lambda: create_plots.R_WORKER.call(create_plots._load_r)),
+                 ('QuantAQ', get_client),
+                 ('Google Drive', get_service),
+                 ('Dropbox', _warm_dropbox)]
+        if create_maps.MAP_RENDERER == 'kaleido':
+            steps.append(('plotly', lambda: __import__('plotly.io')))
+        for name, step in steps:
+            start = time.perf_counter()
+            try:
+                step()
+                print(f'Warmed up {name} in {time.perf_counter() - start:.1f}s')
+            except Exception as e:
+                print(f'Could not warm up {name}: {type(e).__name__}: {e}')
+
+    def _month(self, year, month):
+        """
+        Gets the importer and plot data of a month, kept in memory for later jobs.
+
+        :returns: (DataImporter, SensorStore) of the month
+        """
+        year_month = f'{year}-{month:02d}'
+        if year_month not in self._months:
+            di = DataImporter(year=year, month=month)
+            self._months[year_month] = (di, SensorStore(di.month_store.sensors(), di.load_sensor, columns=PLOT_COLUMNS))
+        self._months[year_month] = self._months.pop(year_month)
+        while len(self._months) > MONTHS_KEPT:
+            self._months.pop(next(iter(self._months)))
+        return self._months[year_month]
+
+    def run_monthly(self, year, month, email=True, retry_failed=False, booklet=False):
+        """
+        Runs the whole monthly pipeline: imports data, draws maps, plots, reports and (optionally) emails them.
+        Every sensor's progress is recorded in the month's run manifest (see utils/manifest.py).
+
+        :param year: (int) year of the reports
+        :param month: (int) month of the reports
+        :param email: (optional bool) False to make the reports without uploading and emailing them
+        :param retry_failed: (optional bool) True to only redo the sensors that failed at each stage of an earlier run
+        :param booklet: (optional bool) True to also write the network booklet
+        :returns: dict with the number of sensors and reports made, and the manifest's summary
+        """
+        year_month = f'{year}-{month:02d}'
+        manifest = RunManifest(year_month)
+        retry_failed = retry_failed and bool(manifest.sensors)
+        # the install data may have changed since an earlier job
+        try:
+            pull_sensor_install_data(force=True)
+        except Exception as e:
+            print(f'Could not pull sensor install data ({e})')
+        di = DataImporter(year=year, month=month)
+        if retry_failed:
+            di.get_PM_data(manifest.to_retry('import'), manifest=manifest)
+            sn_list = list(manifest.sensors)
+            sn_dict = SensorStore(sn_list, di.load_sensor)
+        else:
+            sn_list, sn_dict = di.get_PM_data(manifest=manifest)
+        # copy, drawing maps leaves out sensors without data from the list it is given
+        create_maps.main(list(sn_list), sn_dict)
+        self._months.pop(year_month, None)
+        self._months[year_month] = (di, sn_dict.select(PLOT_COLUMNS))
+        with ArchiveBuilder(year_month, append=retry_failed) as archive:
+            store = self._months[year_month][1]
+            make_plots(year, month, manifest.to_retry('plots') if retry_failed else sn_list, store,
+                       archive=archive, cache=default_store(), manifest=manifest)
+            finished = make_reports(month, year, manifest.to_retry('report') if retry_failed else sn_list,
+                                    archive=archive, booklet=booklet, booklet_sensors=sn_list if retry_failed else None,
+                                    manifest=manifest)
+        if email:
+            send_reports(year, month)
+        print(manifest.report())
+        return {'sensors': len(sn_list), 'reports': len(finished), 'manifest': manifest.summary()}
+
+    def run_sensor(self, year, month, sn, booklet=False):
+        """
+        Re-renders every figure and the report of one sensor from its stored data, and (optionally) rebuilds the booklet.
+
+        :param year: (int) year of the report
+        :param month: (int) month of the report
+        :param sn: (str) serial number of the sensor
+        :param booklet: (optional bool) True to also rebuild the network booklet
+        :returns: dict telling whether the report was made
+        """
+        di, store = self._month(year, month)
+        # the sensor's data is read again, it may have changed since it was loaded
+        if store.put(sn, di.load_sensor(sn)).empty:
+            raise ValueError(f'{sn} has no data for {year}-{month:02d}')
+        with ArchiveBuilder(f'{year}-{month:02d}', append=True) as archive:
+            manifest = RunManifest(f'{year}-{month:02d}')
+            make_plots(year, month, [sn], store, archive=archive, cache=default_store(), manifest=manifest)
+            finished = make_reports(month, year, [sn], archive=archive, booklet=booklet, booklet_sensors=store.sn_list,
+                                    manifest=manifest)
+        return {'report': sn in finished}
+
+    def run_figure(self, year, month, sn, plot, pm=None, weekday=True):
+        """
+        Re-renders one figure of one sensor.
+
+        :param year: (int) year of the data
+        :param month: (int) month of the data
+        :param sn: (str) serial number of the sensor
+        :param plot: (str) name of the plot function, e.g. 'diurnal_plot'
+        :param pm: (optional str) 'pm1', 'pm25' or 'pm10', None for the timeplot
+        :param weekday: (optional bool) False for the weekend diurnal plot
+        :returns: dict with the figure made
+        """
+        plot_function, pm, kwargs = figure_args(year, month, plot, pm, weekday)
+        di, store = self._month(year, month)
+        if sn not in store:
+            store.put(sn, di.load_sensor(sn))
+        if store[sn].empty:
+            raise ValueError(f'{sn} has no data for {year}-{month:02d}')
+        Plotter(f'{year}-{month:02d}', [sn], store).plot_and_export(plot_function, pm, **kwargs)
+        return {'sensor': sn, 'plot': plot, 'pm': pm, **kwargs}
+
+    def run_render(self, year, month, sn, plot, pm=None, weekday=True, profile='print'):
+        """
+        Renders one figure for figure.py and adds it to the figure cache (see figure.render_figure).
+
+        :returns: dict with the size of the JPEG, and the JPEG itself under 'image' for the request waiting for it
+        """
+        data = render_figure(year, month, sn, plot, pm, weekday, profile)
+        key = figure_key(year, month, sn, plot, pm, weekday, profile)
+        if key is not None:
+            self.figures.put(key, data)
+        return {'bytes': len(data), 'image': data}
+
+    def render(self, args):
+        """
+        Answers a render request from the figure cache, or renders the figure in turn with the other jobs.
+
+        :param args: (dict) arguments of run_render
+        :returns: dict with the base64 encoded JPEG under 'image' and whether it was cached, or the failed job
+        """
+        args = dict(args, year=int(args['year']), month=int(args['month']))
+        key = figure_key(**args)
+        data = self.figures.get(key) if key is not None else None
+        cached = data is not None
+        if not cached:
+            job = self.submit('render', args)
+            self._wait(job)
+            if job['status'] != 'done':
+                return job
+            data = job['result'].pop('image')
+        return {'status': 'done', 'cached': cached, 'image': base64.b64encode(data).decode()}
+
+    def _wait(self, job):
+        done = self._done.get(job['id'])
+        if done is not None:
+            done.wait()
+
+    def submit(self, kind, args):
+        """
+        Queues a job.
+
+        :param kind: (str) one of JOB_KINDS
+        :param args: (dict) arguments of the job's run_ method, year and month are required
+        :returns: the job, a dict that is updated as it runs
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f'Unknown job {kind}, expected one of {JOB_KINDS}')
+        args = dict(args, year=int(args['year']), month=int(args['month']))
+        job = {'id': next(self._ids), 'kind': kind, 'args': args, 'status': 'queued',
+               'queued': datetime.now().isoformat(timespec='seconds')}
+        self._done[job['id']] = threading.Event()
+        self.jobs.put(job)
+        metrics.set_gauge('pipeline_queue_depth', self.jobs.qsize(), queue='service')
+        return job
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            metrics.set_gauge('pipeline_queue_depth', self.jobs.qsize(), queue='service')
+            if job is None:
+                self._server.shutdown()
+                return
+            self.running = job
+            job['status'] = 'running'
+            job['started'] = datetime.now().isoformat(timespec='seconds')
+            print(f"Job {job['id']}: {job['kind']} {job['args']}")
+            # the run report of a job only covers that job
+            profiling.reset()
+            start = time.perf_counter()
+            try:
+                job['result'] = getattr(self, f"run_{job['kind']}")(**job['args'])
+                job['status'] = 'done'
+            except Exception as e:
+                traceback.print_exc()
+                job['status'] = 'failed'
+                job['error'] = f'{type(e).__name__}: {e}'
+                metrics.inc('pipeline_failures_total', stage=f"service_{job['kind']}")
+            finally:
+                plt.close('all')
+                job['seconds'] = round(time.perf_counter() - start, 2)
+                print(f"Job {job['id']} {job['status']} in {job['seconds']}s")
+                try:
+                    year_month = f"{job['args']['year']}-{job['args']['month']:02d}"
+                    profiling.write_report(f'logs/{year_month}_run_report.json', f"service_{job['kind']}")
+                except Exception:
+                    # the job is finished without its run report, clients waiting on it and later jobs go on
+                    print(f"Could not write the run report of job {job['id']}")
+                    traceback.print_exc()
+                self.running = None
+                self.finished.append(job)
+                self._done.pop(job['id']).set()
+
+    def handle(self, request):
+        """
+        Answers a request sent to the socket.
+
+        :param request: (dict) 'kind' is a job kind, 'status' or 'stop'. Jobs also have 'args', and 'wait'
+            to answer once the job is finished instead of when it is queued
+        :returns: dict answer
+        """
+        kind = request.get('kind')
+        if kind == 'status':
+            return {'running': self.running, 'queued': [j for j in list(self.jobs.queue) if j is not None],
+                    'finished': list(self.finished), 'figure_cache': self.figures.stats()}
+        if kind == 'render':
+            return self.render(request.get('args', {}))
+        if kind == 'stop':
+            self.jobs.put(None)
+            return {'stopping': True, 'queued': self.jobs.qsize() - 1}
+        job = self.submit(kind, request.get('args', {}))
+        if request.get('wait', True):
+            self._wait(job)
+        return job
+
+    def serve(self):
+        """
+        Warms up, then runs jobs sent to the socket until a stop request.
+        """
+        if os.path.exists(self.socket_path):
+            try:
+                request({'kind': 'status'}, self.socket_path)
+                raise RuntimeError(f'A service is already listening on {self.socket_path}')
+            except (ConnectionRefusedError, FileNotFoundError):
+                # left behind by a service that did not stop cleanly
+                os.remove(self.socket_path)
+        self.warm_up()
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, _Handler)
+        self._server.daemon_threads = True
+        self._server.service = self
+        worker = threading.Thread(target=self._work, daemon=True)
+        worker.start()
+        print(f'Listening on {self.socket_path}')
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            os.remove(self.socket_path)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # one JSON request per connection, answered with one JSON line
+
+    def handle(self):
+        try:
+            answer = self.server.service.handle(json.loads(self.rfile.readline()))
+        except Exception as e:
+            answer = {'error': f'{type(e).__name__}: {e}'}
+        self.wfile.write((json.dumps(answer, default=str) + '\n').encode())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the pipeline as a long-running service, or send it jobs.')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='unix socket of the service')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('serve', help='start the service')
+    commands.add_parser('status', help='list running, queued and finished jobs')
+    commands.add_parser('stop', help='stop the service once queued jobs are done')
+    for kind, help_text in [('monthly', 'run the whole monthly pipeline'),
+                            ('sensor', "re-render one sensor's figures and report"),
+                            ('figure', 're-render one figure of one sensor')]:
+        job = commands.add_parser(kind, help=help_text)
+        job.add_argument('year', type=int)
+        job.add_argument('month', type=int)
+        if kind != 'monthly':
+            job.add_argument('sn', help='serial number of the sensor')
+        if kind == 'monthly':
+            job.add_argument('--no-email', dest='email', action='store_false', help='do not upload or email the reports')
+            job.add_argument('--retry-failed', action='store_true',
+                             help='only redo the sensors that failed at each stage of an earlier run')
+        if kind in ('monthly', 'sensor'):
+            job.add_argument('--booklet', action='store_true', help='also write the network booklet')
+        if kind == 'figure':
+            job.add_argument('plot', choices=sorted(PLOT_FUNCTIONS))
+            job.add_argument('--pm', choices=['pm1', 'pm25', 'pm10'], help='pollutant, not needed for timeplot_threshold')
+            job.add_argument('--weekend', dest='weekday', action='store_false', help='weekend diurnal plot')
+        job.add_argument('--no-wait', dest='wait', action='store_false', help='return once the job is queued')
+    args = vars(parser.parse_args(argv))
+    command, socket_path, wait = args.pop('command'), args.pop('socket'), args.pop('wait', True)
+
+    if command == 'serve':
+        # before the exporter's and the service's threads, see utils/watchdog.py
+        create_plots.R_WORKER.start()
+        metrics.start_exporter('service')
+        PipelineService(socket_path).serve()
+        return 0
+    if command in JOB_KINDS:
+        answer = request({'kind': command, 'args': args, 'wait': wait}, socket_path)
+    else:
+        answer = request({'kind': command}, socket_path)
+    print(json.dumps(answer, indent=2, default=str))
+    return 1 if 'error' in answer or answer.get('status') == 'failed' else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
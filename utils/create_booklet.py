@@ -0,0 +1,227 @@
+"""
+Project: Air Partners
+
+Script to collect the reports of every sensor into one PDF booklet for the whole network.
+
+Report pages for the booklet are exported by ReportGenerator(booklet=True) without the images that
+are the same on every report (logos, particle size graphic), along with a JSON file saying where
+those images go. The booklet embeds each of those images once and draws it on every page that
+needs it, and embeds the page JPEGs as they are, without decoding or re-encoding them.
+"""
+
+import sys
+import json
+import zlib
+import datetime as dt
+from pathlib import Path
+import pikepdf
+from pikepdf import Name, Dictionary, Array
+from PIL import Image
+
+# A4 pages, with the report image placed 210mm x 280mm in the middle of the page (same as the sensor PDFs)
+MM = 72 / 25.4
+PAGE_W, PAGE_H = 210 * MM, 297 * MM
+IMAGE_W, IMAGE_H = 210 * MM, 280 * MM
+IMAGE_Y = (PAGE_H - IMAGE_H) / 2
+# table of contents layout
+TOC_LOGO_H = 40
+TOC_LINES_PER_PAGE = 30
+TOC_LINE_SPACING = 20
+TOC_FONT_SIZE = 12
+
+DIC_MONTH = {1:"January",2:"February",3:"March",4:"April",5:"May",6:"June",
+             7:"July",8:"August",9:"September",10:"October",11:"November",12:"December"}
+
+
+def _jpeg_xobject(pdf, img_path):
+    """
+    Embed a JPEG file as an image XObject, passing the JPEG stream through as it is.
+
+    :param pdf: (pikepdf.Pdf) PDF to embed the image in
+    :param img_path: (str) path to the JPEG
+    :returns: image XObject
+    """
+    # opening the image only reads its header, the pixels are never decoded
+    with Image.open(img_path) as img:
+        width, height = img.size
+        colorspace = Name.DeviceGray if img.mode == 'L' else Name.DeviceRGB
+    xobj = pikepdf.Stream(pdf, Path(img_path).read_bytes())
+    xobj.Type = Name.XObject
+    xobj.Subtype = Name.Image
+    xobj.Width = width
+    xobj.Height = height
+    xobj.ColorSpace = colorspace
+    xobj.BitsPerComponent = 8
+    xobj.Filter = Name.DCTDecode
+    return xobj
+
+
+def _png_xobject(pdf, img_path):
+    """
+    Embed a (possibly transparent) image as a Flate compressed image XObject.
+
+    :param pdf: (pikepdf.Pdf) PDF to embed the image in
+    :param img_path: (str) path to the image
+    :returns: image XObject
+    """
+    with Image.open(img_path) as img:
+        img = img.convert('RGBA')
+    width, height = img.size
+
+    def _stream(data, colorspace):
+        stream = pikepdf.Stream(pdf, zlib.compress(data))
+        stream.Type = Name.XObject
+        stream.Subtype = Name.Image
+        stream.Width = width
+        stream.Height = height
+        stream.ColorSpace = colorspace
+        stream.BitsPerComponent = 8
+        stream.Filter = Name.FlateDecode
+        return stream
+
+    xobj = _stream(img.convert('RGB').tobytes(), Name.DeviceRGB)
+    xobj.SMask = _stream(img.getchannel('A').tobytes(), Name.DeviceGray)
+    return xobj
+
+
+def _add_page(pdf, font, xobjects, content):
+    """
+    Add a page to the PDF.
+
+    :param pdf: (pikepdf.Pdf) PDF to add the page to
+    :param font: (pikepdf.Dictionary) font used for text on the page
+    :param xobjects: (dict) resource names and the XObjects they refer to
+    :param content: (str) page content stream
+    :returns: index of the new page
+    """
+    page = Dictionary(
+        Type=Name.Page,
+        MediaBox=Array([0, 0, PAGE_W, PAGE_H]),
+        Resources=Dictionary(
+            XObject=Dictionary({f'/{name}': xobj for name, xobj in xobjects.items()}),
+            Font=Dictionary(F1=font)
+        ),
+        Contents=pikepdf.Stream(pdf, content.encode('latin-1'))
+    )
+    pdf.pages.append(pikepdf.Page(page))
+    return len(pdf.pages) - 1
+
+
+def _draw(name, x, y, w, h):
+    """
+    Content stream operators that draw an XObject in the given rectangle.
+    """
+    return f'q {w:.4f} 0 0 {h:.4f} {x:.4f} {y:.4f} cm /{name} Do Q\n'
+
+
+def _text(x, y, size, s):
+    """
+    Content stream operators that write a line of text.
+    """
+    s = s.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return f'BT /F1 {size} Tf {x:.4f} {y:.4f} Td ({s}) Tj ET\n'
+
+
+def build_booklet(month, year, sn_list, out_path=None):
+    """
+    Write one PDF for the whole network, with a table of contents and a section per sensor.
+    Booklet pages of every sensor MUST be exported first (see ReportGenerator(booklet=True)).
+
+    :param month: (int) month of the reports
+    :param year: (int) year of the reports
+    :param sn_list: (list of str) serial numbers of the sensors to include, in order
+    :param out_path: (optional str) path of the booklet, defaults to {year_month}/Reports/{year_month}_Network_Report.pdf
+    :returns: path of the booklet
+    """
+    year_month = dt.date(year, month, 1).isoformat()[:-3]
+    if out_path is None:
+        out_path = f'{year_month}/Reports/{year_month}_Network_Report.pdf'
+
+    # pages of every sensor that has booklet pages, in page order
+    sections = []
+    for sn in sn_list:
+        pages = sorted(Path(f'{year_month}/Reports/Booklet/{sn}').glob('*.jpeg'),
+                       key=lambda p: int(p.stem.rsplit('_', 1)[-1]))
+        if pages:
+            sections.append((sn, pages))
+
+    pdf = pikepdf.new()
+    font = pdf.make_indirect(Dictionary(Type=Name.Font, Subtype=Name.Type1, BaseFont=Name.Helvetica))
+    # images shared by every page are embedded once and referenced from every page
+    shared = {}
+
+    def _shared(img_path):
+        if img_path not in shared:
+            shared[img_path] = (f'S{len(shared)}', pdf.make_indirect(_png_xobject(pdf, img_path)))
+        return shared[img_path]
+
+    toc_pages = max(1, -(-len(sections) // TOC_LINES_PER_PAGE))
+    first_page = {}
+    page_index = toc_pages
+    for sn, pages in sections:
+        first_page[sn] = page_index
+        page_index += len(pages)
+
+    ## Table of contents
+    toc_links = []
+    for t in range(toc_pages):
+        xobjects = {}
+        content = ''
+        # logos
+        for img_path, x in (('_images/airpartners_logo.png', 50), ('_images/ace_logo.png', None)):
+            name, xobj = _shared(img_path)
+            xobjects[name] = xobj
+            w = TOC_LOGO_H * int(xobj.Width) / int(xobj.Height)
+            x = PAGE_W - 50 - w if x is None else x
+            content += _draw(name, x, PAGE_H - 50 - TOC_LOGO_H, w, TOC_LOGO_H)
+        content += _text(50, PAGE_H - 130, 18, 'Particulate Matter Monthly Summary')
+        content += _text(50, PAGE_H - 155, 14, f'{DIC_MONTH[month]} {year}: Roxbury sensor network')
+        y = PAGE_H - 200
+        for sn, _ in sections[t*TOC_LINES_PER_PAGE:(t+1)*TOC_LINES_PER_PAGE]:
+            page_str = str(first_page[sn] + 1)
+            content += _text(70, y, TOC_FONT_SIZE, sn)
+            # right align the page number (Helvetica digits are 0.556 em wide)
+            content += _text(PAGE_W - 70 - 0.556*TOC_FONT_SIZE*len(page_str), y, TOC_FONT_SIZE, page_str)
+            toc_links.append((t, [70, y - 4, PAGE_W - 70, y + TOC_FONT_SIZE], first_page[sn]))
+            y -= TOC_LINE_SPACING
+        _add_page(pdf, font, xobjects, content)
+
+    ## Sensor sections
+    for sn, pages in sections:
+        for page in pages:
+            xobjects = {'Im0': _jpeg_xobject(pdf, page)}
+            content = _draw('Im0', 0, IMAGE_Y, IMAGE_W, IMAGE_H)
+            with open(page.with_suffix('.json'), 'r') as f:
+                placements = json.load(f)
+            for placement in placements:
+                name, xobj = _shared(placement['asset'])
+                xobjects[name] = xobj
+                x0, y0, x1, y1 = placement['box']
+                content += _draw(name, x0*IMAGE_W, IMAGE_Y + y0*IMAGE_H, (x1-x0)*IMAGE_W, (y1-y0)*IMAGE_H)
+            _add_page(pdf, font, xobjects, content)
+
+    # clickable table of contents entries
+    for t, rect, target in toc_links:
+        link = Dictionary(Type=Name.Annot, Subtype=Name.Link, Rect=Array(rect), Border=Array([0, 0, 0]),
+                          Dest=Array([pdf.pages[target].obj, Name.Fit]))
+        toc_page = pdf.pages[t].obj
+        if Name.Annots not in toc_page:
+            toc_page.Annots = Array()
+        toc_page.Annots.append(pdf.make_indirect(link))
+
+    # bookmarks for every sensor
+    with pdf.open_outline() as outline:
+        outline.root.append(pikepdf.OutlineItem('Contents', 0))
+        for sn, _ in sections:
+            outline.root.append(pikepdf.OutlineItem(sn, first_page[sn]))
+
+    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+    pdf.save(out_path)
+    print(f'Booklet with {len(sections)} sensors saved to {out_path}')
+    return out_path
+
+
+if __name__ == '__main__':
+    # get year, month and sensors from sys args
+    year, month = int(sys.argv[1]), int(sys.argv[2])
+    build_booklet(month, year, sys.argv[3:])
@@ -3,32 +3,172 @@ Author: Neel Dhulipala
 Project: Air Partners
 
 Script to create maps for every sensor.
+
+Maps are cached in _images/locs: a sensor's map is only re-rendered when its location,
+or the location of any sensor shown on its map, has changed since it was last rendered.
+
+By default maps are drawn from basemap tiles cached on disk (see utils/tile_cache.py), so
+rendering works offline once the tiles for the network have been downloaded. Set
+renderer='kaleido' to render them with plotly and live Mapbox tiles instead.
+
+The Mapbox token and plotly are only loaded when they are needed, so importing this module is cheap
+and needs no credentials.
 """
 
 import os
+import json
+import hashlib
+import math
+from functools import lru_cache
 import pandas as pd
-import plotly.graph_objects as go
+from utils.tile_cache import TileCache
+from utils import watchdog
+from data_analysis.compact_frames import sensor_location
 
 def _read_token(token_path):
         with open(token_path, 'r') as f:
             token = f.read()
             return token
 
-MAPBOX_TOKEN = _read_token('mapbox_token.txt')
+MAPBOX_TOKEN_PATH = 'mapbox_token.txt'
+
+@lru_cache(maxsize=None)
+def _mapbox_token():
+    """
+    Reads the Mapbox token on first use.
+
+    :returns: the token, or None if there is no token file (cached tiles can still be drawn without one)
+    """
+    if not os.path.exists(MAPBOX_TOKEN_PATH):
+        return None
+    return _read_token(MAPBOX_TOKEN_PATH)
+
+MAP_DIR = '_images/locs'
+CACHE_PATH = f'{MAP_DIR}/map_cache.json'
+MAP_STYLE = 'basic'
+MAP_ZOOM = 14
+# plotly's default export size
+MAP_WIDTH, MAP_HEIGHT = 700, 500
+# bump this when the look of the maps changes, so every cached map is re-rendered
+MAP_VERSION = 1
+# 'tiles' draws maps from the local tile cache, 'kaleido' renders them with plotly
+MAP_RENDERER = 'tiles'
 
 def get_lats_and_longs(sn_list, sn_dict):
     for i in range(len(sn_list) -1,-1,-1):
         sn = sn_list[i]
         if sn_dict[sn].shape == (0,0):
-            sn_list.pop(i)   
+            sn_list.pop(i)
     sn_locs = pd.DataFrame()
     sn_locs['sensor'] = sn_list
-    sn_locs['lats'] = [sn_dict[sn].iloc[-1]['geo']['lat'] for sn in sn_list]
-    sn_locs['longs'] = [sn_dict[sn].iloc[-1]['geo']['lon'] for sn in sn_list]
+    sn_locs['lats'] = [sensor_location(sn_dict[sn])[0] for sn in sn_list]
+    sn_locs['longs'] = [sensor_location(sn_dict[sn])[1] for sn in sn_list]
     sn_locs = sn_locs.set_index('sensor')
     return sn_locs
 
-def show(df, sn_list):
+def _visible_neighbours(df, sn):
+    """
+    Gets the sensors whose markers can appear on the map centered on a sensor.
+
+    :param df: (pd.DataFrame) sensor latitudes and longitudes, indexed by sensor
+    :param sn: (str) sensor the map is centered on
+    :returns: sorted list of (sensor, lat, lon) tuples, including the sensor itself
+    """
+    lat = df['lats'][sn]
+    # Mapbox tiles are 512px wide, so the whole world is 512 * 2^zoom px wide at a given zoom level
+    deg_per_px = 360 / (512 * 2**MAP_ZOOM)
+    # markers and their labels can stick into the map from just outside of it, so look a bit further out
+    half_width = deg_per_px * MAP_WIDTH
+    half_height = deg_per_px * MAP_HEIGHT * math.cos(math.radians(lat))
+    near = df[(abs(df['lats'] - lat) <= half_height) & (abs(df['longs'] - df['longs'][sn]) <= half_width)]
+    return sorted((str(s), round(float(r['lats']), 6), round(float(r['longs']), 6)) for s, r in near.iterrows())
+
+def _map_key(df, sn, renderer=MAP_RENDERER):
+    """
+    Gets the cache key of a sensor's map, based on everything that changes what the map looks like.
+
+    :param df: (pd.DataFrame) sensor latitudes and longitudes, indexed by sensor
+    :param sn: (str) sensor the map is centered on
+    :param renderer: (optional str) 'tiles' or 'kaleido'
+    :returns: hex digest identifying the map
+    """
+    key = {
+        'version': MAP_VERSION,
+        'renderer': renderer,
+        'style': MAP_STYLE,
+        'zoom': MAP_ZOOM,
+        'size': [MAP_WIDTH, MAP_HEIGHT],
+        'center': [round(float(df['lats'][sn]), 6), round(float(df['longs'][sn]), 6)],
+        'markers': _visible_neighbours(df, sn),
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def _load_cache():
+    try:
+        with open(CACHE_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_cache(cache):
+    with open(CACHE_PATH, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+def _show_tiles(df, sn_list):
+    """
+    Draws maps from cached basemap tiles, downloading the tiles covering the network first if needed.
+
+    :param df: (pd.DataFrame) sensor latitudes and longitudes, indexed by sensor
+    :param sn_list: (list of str) sensors to create maps for
+    :returns: dict of sensor keys and PNG bytes of their maps
+    """
+    tiles = TileCache(token=_mapbox_token())
+    tiles.prefetch(list(df['lats']), list(df['longs']), MAP_ZOOM, MAP_WIDTH, MAP_HEIGHT)
+    return {sn: tiles.render_png(df['lats'][sn], df['longs'][sn], MAP_ZOOM, MAP_WIDTH, MAP_HEIGHT,
+                                 markers=_visible_neighbours(df, sn))
+            for sn in sn_list}
+
+def _to_png(fig):
+    # kaleido can hang without ever answering, it is killed once the map is out of time and started again
+    # for the next map (see utils/watchdog.py)
+    import plotly.io as pio
+    with watchdog.kill_after(watchdog.BUDGETS['map'], lambda: getattr(pio.kaleido.scope, '_proc', None)):
+        return pio.to_image(fig, format='png', width=MAP_WIDTH, height=MAP_HEIGHT, engine='kaleido')
+
+def show(df, sn_list, force=False, renderer=MAP_RENDERER):
+    """
+    Creates a map image for every sensor whose map is not already cached.
+
+    :param df: (pd.DataFrame) sensor latitudes and longitudes, indexed by sensor
+    :param sn_list: (list of str) sensors to create maps for
+    :param force: (optional bool) True if every map should be re-rendered
+    :param renderer: (optional str) 'tiles' to draw maps from the local tile cache, 'kaleido' to render them with plotly
+    :returns: list of sensors whose maps were rendered, maps that ran out of time are left out and
+        rendered again next time
+    """
+    # Create folder for images if does not already exist
+    if not os.path.exists(MAP_DIR):
+        os.mkdir(MAP_DIR)
+
+    # Only render maps that have changed since they were last rendered
+    cache = _load_cache()
+    keys = {sn: _map_key(df, sn, renderer) for sn in sn_list}
+    stale = [sn for sn in sn_list
+             if force or cache.get(sn) != keys[sn] or not os.path.exists(f'{MAP_DIR}/{sn}.png')]
+    print(f'{len(sn_list) - len(stale)} maps unchanged, rendering {len(stale)}.')
+
+    if renderer == 'tiles':
+        for sn, img in (_show_tiles(df, stale) if stale else {}).items():
+            with open(f'{MAP_DIR}/{sn}.png', 'wb') as f:
+                f.write(img)
+            cache[sn] = keys[sn]
+            print(f'Finished {sn} image.')
+        _save_cache(cache)
+        return stale
+
+    import plotly.graph_objects as go
+    if _mapbox_token() is None:
+        raise FileNotFoundError(f'{MAPBOX_TOKEN_PATH} is needed to render maps with kaleido')
     data = go.Scattermapbox(lat=list(df['lats']),
                             lon=list(df['longs']),
                             mode='markers+text',
@@ -36,26 +176,38 @@ def show(df, sn_list):
                             textposition='top center',
                             textfont=dict(size=28, color='black'),
                             text=[sn_list[i] for i in range(len(sn_list))])
-    
-    # Create folder for images if does not already exist
-    if not os.path.exists('_images/locs'):
-        os.mkdir('_images/locs')
-    # Iterate through all sensors and create images for each one
-    for sn in sn_list:
+    figs = []
+    for sn in stale:
         # Layout graphic so that image centers on sensor in question
         layout = dict(margin=dict(l=0, t=0, r=0, b=0, pad=0),
-                mapbox=dict(accesstoken=MAPBOX_TOKEN,
+                mapbox=dict(accesstoken=_mapbox_token(),
                             center=dict(lat=df['lats'][sn], lon=df['longs'][sn]),
-                            style='basic',
-                            zoom=14))
-        fig = go.Figure(data=data, layout=layout)
-        
-        
-        # creates image twice in case figure not fully complete by first iteration
-        fig.write_image(f'_images/locs/{sn}.png', format='png', engine="kaleido")
-        fig.write_image(f'_images/locs/{sn}.png')
+                            style=MAP_STYLE,
+                            zoom=MAP_ZOOM))
+        figs.append((sn, go.Figure(data=data, layout=layout)))
+
+    if figs:
+        # plotly keeps one kaleido process alive for every render. Its first map render can come back
+        # before the map has finished loading, so render one map to warm it up instead of writing every map twice.
+        try:
+            watchdog.run('map', _to_png, figs[0][1])
+        except watchdog.JobTimeout as e:
+            print(f'Could not warm up kaleido ({e})')
+    rendered = []
+    for sn, fig in figs:
+        try:
+            img = watchdog.run('map', _to_png, fig, sensor=sn)
+        except watchdog.JobTimeout as e:
+            print(f'No map for {sn}: {e}')
+            continue
+        with open(f'{MAP_DIR}/{sn}.png', 'wb') as f:
+            f.write(img)
+        cache[sn] = keys[sn]
+        _save_cache(cache)
+        rendered.append(sn)
         print(f'Finished {sn} image.')
+    return rendered
 
 def main(sn_list, sn_dict):
     df = get_lats_and_longs(sn_list, sn_dict)
-    show(df, sn_list)
\ No newline at end of file
+    show(df, sn_list)
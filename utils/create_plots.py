@@ -6,15 +6,27 @@ Script for creating and exporting all figures needed for static reporting.
 """
 
 import os
+from functools import lru_cache
 import matplotlib.pyplot as plt
 from matplotlib.ticker import MaxNLocator
 from visualizers.calendar_plot import CalendarPlot
 from visualizers.timeplot_thresholds import Timeplot
 from visualizers.diurnal_plot import DiurnalPlot
-from data_analysis.dataviz import OpenAirPlots
+from utils.output_profiles import export_figure, get_profiles
+from utils.figure_cache import code_version, figure_key, frame_digest
+from data_analysis.compact_frames import expand_frame
+from utils.profiling import stage
+from utils.metrics import Progress
+from utils import watchdog
 
 # Subscripts (for captions and labels)
 SUB = str.maketrans("0123456789", "₀₁₂₃₄₅₆₇₈₉")
+# columns of a sensor's data each plot is drawn from, 'pm' stands for the pollutant plotted. A figure is only
+# drawn again when these change, plots that are not listed are drawn again when any column changes
+PLOT_INPUTS = {'calendar_plot': ['timestamp', 'pm'],
+               'timeplot_threshold': ['timestamp', 'pm1', 'pm25', 'pm10'],
+               'diurnal_plot': ['timestamp', 'pm'],
+               'wind_polar_plot': ['timestamp', 'wind_speed', 'wind_dir', 'pm']}
 
 def calendar_plot(data_PM, pm, month, year):
     # Create calendar plot
@@ -51,6 +63,28 @@ def diurnal_plot(dataPM, pm, weekday=False):
 #         tick.set_rotation(45)
 
 
+@lru_cache(maxsize=None)
+def _open_air():
+    # R (through rpy2) and openair are only loaded when a polar plot is drawn, they are slow to start
+    # and not needed for any other plot. Loaded once, they are kept for the rest of the process
+    from data_analysis.dataviz import OpenAirPlots
+    return OpenAirPlots()
+
+
+# R runs in a process of its own, see utils/watchdog.py. The scripts start it before any of their threads
+R_WORKER = watchdog.Worker('R')
+
+
+def _load_r():
+    # runs in the R process, loads R and openair there before the first polar plot
+    _open_air()
+
+
+def _polar_plot(df, file_prefix, pollutants):
+    # runs in the R process
+    _open_air().polar_plot(df, file_prefix, pollutants)
+
+
 def wind_polar_plot(data_PM, pm):
     #df = df.rename(columns={"timestamp_local": "date", "wind_speed": "ws", "wind_dir": "wd"})
     #df.wd = df.wd.replace(0.0, 360.0)
@@ -59,9 +93,9 @@ def wind_polar_plot(data_PM, pm):
     # Remove any points where wind data was unavailable. 
     df = df[df.wind_speed != 0]
 
-    # Format the dataPM to be read in R and plot wind data
-    air_plt = OpenAirPlots()
-    air_plt.polar_plot(df, 'utils/', [pm])
+    # Format the dataPM to be read in R and plot wind data. polarPlot can hang inside R, so it runs in the
+    # R process, which is killed (and started again) if it takes too long
+    R_WORKER.call(_polar_plot, df, 'utils/', [pm], timeout=watchdog.BUDGETS['polar_plot'])
     #ro.r.polarPlot(dataPM, pollutant = p, main = f"{p.upper()} Polar Plot")
     
     # Take current image, save image again using matplotlib
@@ -75,13 +109,57 @@ def wind_polar_plot(data_PM, pm):
 
 class Plotter(object):
 
-    def __init__(self, year_month, sn_list, sn_dict):
+    def __init__(self, year_month, sn_list, sn_dict, profiles=None, archive=None, cache=None, manifest=None):
+        """
+        Args:
+            year_month: (str) month of the data, e.g. '2022-06'
+            sn_list: (list of str) serial numbers of sensors to plot
+            sn_dict: (dict) serial number keys and (compact) dataframes containing sensor data
+            profiles: (optional list) output profiles to export, see utils/output_profiles.py
+            archive: (optional ArchiveBuilder) archive that exported figures are added to as they are made
+            cache: (optional FigureStore) store of exported figures, figures whose data, parameters and plotting
+                code are unchanged are copied from it instead of being rendered again (see utils/figure_cache.py)
+            manifest: (optional RunManifest) manifest the figures of every sensor are recorded in; a figure that
+                fails is recorded there and the other figures are still plotted (see utils/manifest.py)
+        """
         self.year_month = year_month
         self.sn_list = sn_list
         self.sn_dict = sn_dict
+        self.profiles = profiles
+        self.archive = archive
+        self.cache = cache
+        self.manifest = manifest
+        # digests of slices of the sensors' data, computed once for all of the figures drawn from them
+        self._digests = {}
 
+    def _export(self, rel_path):
+        # export the current figure for every output profile from a single render
+        paths = export_figure(plt.gcf(), self.year_month, rel_path, self.profiles)
+        if self.archive is not None:
+            self.archive.add(paths)
+        return paths
 
-    def plot_and_export(self, plot_function, pm, **kwargs):
+    def _rel_path(self, plot_function, sn, pm, kwargs):
+        # path of a figure relative to the month directory
+        name = plot_function.__name__
+        if pm == None:
+            return 'Graphs/{2}/{0}_{1}_{2}.jpeg'.format(sn, self.year_month, name)
+        if 'weekday' in kwargs:
+            day = 'weekday' if kwargs.get('weekday') else 'weekend'
+            return 'Graphs/{2}/{3}/{4}/{0}_{1}_{2}.jpeg'.format(sn, self.year_month, name, pm, day)
+        return 'Graphs/{2}/{3}/{0}_{1}_{2}.jpeg'.format(sn, self.year_month, name, pm)
+
+    def _cache_key(self, plot_function, sn, pm, kwargs):
+        # the slice of data the figure is drawn from, its parameters and the code that draws it
+        columns = PLOT_INPUTS.get(plot_function.__name__)
+        if columns is not None:
+            columns = tuple(pm if c == 'pm' else c for c in columns)
+        if (sn, columns) not in self._digests:
+            self._digests[sn, columns] = frame_digest(self.sn_dict[sn], columns)
+        return figure_key(self._digests[sn, columns], plot=plot_function.__name__, pm=pm, code=code_version(), **kwargs)
+
+
+    def _make_dirs(self, plot_function, pm):
         try:
             os.mkdir('{}'.format(self.year_month))
         except:
@@ -107,23 +185,96 @@ class Plotter(object):
                 os.mkdir('{0}/Graphs/{1}/{2}/weekend'.format(self.year_month, str(plot_function.__name__), pm))
             except:
                 pass
+
+    def plot_and_export(self, plot_function, pm, **kwargs):
+        """
+        Plots and exports one figure for every sensor.
+        """
+        self._make_dirs(plot_function, pm)
+        progress = Progress(plot_function.__name__, len(self.sn_list))
+        profiles = get_profiles(self.profiles)
+        for sn in self.sn_list:
+            if self.sn_dict[sn].empty:
+                progress.advance()
+            else:
+                progress.advance(failed=not self._plot_figure(plot_function, sn, pm, kwargs, profiles))
+
+    def plot_figures(self, figures):
+        """
+        Plots and exports several figures for every sensor, all figures of a sensor before the next sensor,
+        so the data of every sensor is only loaded once. With a manifest, every sensor's record of the
+        plots stage is started and finished here.
+
+        :param figures: (list) (plot function, pm, keyword arguments) of every figure, see plots.figures
+        """
+        for plot_function, pm, _ in figures:
+            self._make_dirs(plot_function, pm)
+        progress = Progress('plots', len(self.sn_list))
+        profiles = get_profiles(self.profiles)
         for sn in self.sn_list:
-            if not self.sn_dict[sn].empty:
-                if pm == None:
-                    plot_function(self.sn_dict[sn], **kwargs)
-                    plt.savefig('{1}/Graphs/{2}/{0}_{1}_{2}.jpeg'.format(sn, self.year_month, str(plot_function.__name__)), bbox_inches='tight',dpi = 300)
-                ### 
-                ### TODO: this function needs refactoring since directory structures for each plot is very different
-                ###
-                elif 'weekday' in kwargs:
-                    plot_function(self.sn_dict[sn], pm, **kwargs)
-                    if kwargs.get('weekday'):
-                        plt.savefig('{1}/Graphs/{2}/{3}/weekday/{0}_{1}_{2}.jpeg'.format(sn, self.year_month, str(plot_function.__name__), pm), bbox_inches='tight',dpi = 300)
-                        #print("Finished {1}/Graphs/{2}/{3}/weekday/{0}_{1}_{2}.jpeg".format(sn, self.year_month, str(plot_function.__name__), pm))
-                    else:
-                        plt.savefig('{1}/Graphs/{2}/{3}/weekend/{0}_{1}_{2}.jpeg'.format(sn, self.year_month, str(plot_function.__name__), pm), bbox_inches='tight',dpi = 300)
-                        #print("Finished {1}/Graphs/{2}/{3}/weekend/{0}_{1}_{2}.jpeg".format(sn, self.year_month, str(plot_function.__name__), pm))
-                else:
-                    plot_function(self.sn_dict[sn], pm, **kwargs)
-                    plt.savefig('{1}/Graphs/{2}/{3}/{0}_{1}_{2}.jpeg'.format(sn, self.year_month, str(plot_function.__name__), pm), bbox_inches='tight',dpi = 300)
-                plt.close()
\ No newline at end of file
+            if self.manifest is not None:
+                self.manifest.begin(sn, 'plots')
+            if self.sn_dict[sn].empty:
+                if self.manifest is not None:
+                    self.manifest.end(sn, 'plots', 'empty')
+                progress.advance()
+                continue
+            ok = True
+            for plot_function, pm, kwargs in figures:
+                ok = self._plot_figure(plot_function, sn, pm, kwargs, profiles) and ok
+            plt.close('all')
+            if self.manifest is not None:
+                self.manifest.end(sn, 'plots')
+            progress.advance(failed=not ok)
+            print(f'Plotted {sn} ({progress}).')
+
+    def _plot_figure(self, plot_function, sn, pm, kwargs, profiles):
+        # plots one figure of one sensor; with a manifest, a figure that fails is recorded and False is returned,
+        # so the other figures are still plotted
+        if self.manifest is None:
+            self._plot_sensor(plot_function, sn, pm, kwargs, profiles)
+            return True
+        try:
+            with self.manifest.record(sn, 'plots') as entry:
+                entry['artifacts'].extend(self._plot_sensor(plot_function, sn, pm, kwargs, profiles))
+        except Exception as e:
+            plt.close('all')
+            print(f'\nCould not plot {plot_function.__name__} ({pm}) of {sn}: {e}')
+            return False
+        return True
+
+    def _plot_sensor(self, plot_function, sn, pm, kwargs, profiles):
+        # plots and exports one figure of one sensor, or copies it from the figure store; returns the exported paths
+        with stage('plot_and_export', sensor=sn, plot=plot_function.__name__, pm=pm) as job:
+            rel_path = self._rel_path(plot_function, sn, pm, kwargs)
+            key = self._cache_key(plot_function, sn, pm, kwargs) if self.cache is not None else None
+            paths = self.cache.restore(key, self.year_month, rel_path, profiles) if key else None
+            job['cached'] = paths is not None
+            if paths is not None:
+                if self.archive is not None:
+                    self.archive.add(paths)
+            else:
+                # only the sensor being plotted is expanded from its compact form
+                data = expand_frame(self.sn_dict[sn])
+                job['rows'] = len(data)
+                # only the drawing has a time budget (see utils/watchdog.py), files are written once it is
+                # done, so a figure that runs out of time leaves nothing half written behind
+                budget = watchdog.BUDGETS.get(plot_function.__name__, watchdog.BUDGETS['plot'])
+                watchdog.run('plot', self._draw, plot_function, data, pm, kwargs, budget=budget, sensor=sn)
+                paths = self._export(rel_path)
+                plt.close()
+                if key:
+                    self.cache.store(key, paths, profiles)
+        return paths
+
+    def _draw(self, plot_function, data, pm, kwargs):
+        # draws one figure of one sensor
+        try:
+            if pm == None:
+                plot_function(data, **kwargs)
+            else:
+                plot_function(data, pm, **kwargs)
+        except watchdog.JobTimeout:
+            # drop the half-drawn figure before it is drawn again
+            plt.close('all')
+            raise
\ No newline at end of file
@@ -1,8 +1,90 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import os
 import json
+import hashlib
 import sys
+import time
+import threading
+import requests
 import dropbox
+from urllib.parse import urlsplit
+from dropbox.files import CommitInfo, UploadSessionCursor, WriteMode
+from dropbox.exceptions import ApiError, InternalServerError, RateLimitError
+from utils.profiling import profiled
+from utils import metrics
+
+# Files are uploaded in chunks of this size (a multiple of 4 MB, as Dropbox requires), so memory use stays
+# constant and files over the 150 MB limit of a single upload call can be uploaded
+CHUNK_SIZE = 8 * 1024 * 1024
+# block size of Dropbox content hashes
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+MAX_RETRIES = 5
+CREDS_PATH = 'utils/dropbox_creds.json'
+# set to send every Dropbox request to another server, e.g. a local stand-in (see benchmarks/stand_ins.py)
+API_URL_VAR = 'DROPBOX_API_URL'
+# Dropbox client shared by the process, see get_transfer_data
+_transfer_data = None
+_transfer_lock = threading.Lock()
+
+
+class _RedirectSession(requests.Session):
+    """
+    requests session that sends Dropbox API requests to another server. The Dropbox SDK only talks
+    to its own https hosts, so requests are redirected here, with the original host in a header.
+    """
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url.rstrip('/')
+
+    def request(self, method, url, *args, **kwargs):
+        parts = urlsplit(url)
+        if parts.hostname and parts.hostname.endswith('dropboxapi.com'):
+            kwargs['headers'] = {**(kwargs.get('headers') or {}), 'X-Stand-In-Host': parts.hostname}
+            url = self.base_url + parts.path + (f'?{parts.query}' if parts.query else '')
+        return super().request(method, url, *args, **kwargs)
+
+
+def _correct_offset(error):
+    """
+    Gets the offset Dropbox expects next from an upload session error, if that is what the error is about.
+
+    :param error: (dropbox.exceptions.ApiError) error raised by an upload session call
+    :returns: the correct offset, or None if the error is about something else
+    """
+    err = error.error
+    if hasattr(err, 'is_lookup_failed') and err.is_lookup_failed():
+        err = err.get_lookup_failed()
+    if hasattr(err, 'is_incorrect_offset') and err.is_incorrect_offset():
+        return err.get_incorrect_offset().correct_offset
+    return None
+
+def _session_gone(error):
+    """
+    Checks whether an upload session error says the session no longer exists, e.g. a session saved by an
+    interrupted upload that has since expired (Dropbox keeps them for a week) or was closed.
+
+    :param error: (dropbox.exceptions.ApiError) error raised by an upload session call
+    :returns: True if the upload has to start over in a new session
+    """
+    err = error.error
+    if hasattr(err, 'is_lookup_failed') and err.is_lookup_failed():
+        err = err.get_lookup_failed()
+    # Dropbox reports an expired session as not found
+    return (hasattr(err, 'is_not_found') and err.is_not_found()) or (hasattr(err, 'is_closed') and err.is_closed())
+
+def _content_hash(path):
+    """
+    Computes the Dropbox content hash of a local file: the SHA-256 of the SHA-256 digests of its 4 MB blocks.
+
+    :param path: (str) path of the local file
+    :returns: hex digest, comparable to FileMetadata.content_hash
+    """
+    blocks = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            blocks.update(hashlib.sha256(block).digest())
+    return blocks.hexdigest()
 
 class TransferData:
     """
@@ -20,22 +102,130 @@ class TransferData:
     https://stackoverflow.com/questions/70641660/how-do-you-get-and-use-a-refresh-token-for-the-dropbox-api-python-3-x/71794390#71794390
     """
     def __init__(self):
-        with open('utils/dropbox_creds.json') as creds:
+        api_url = os.environ.get(API_URL_VAR)
+        session = _RedirectSession(api_url) if api_url else None
+        if api_url and not os.path.exists(CREDS_PATH):
+            # a stand-in server needs no Dropbox account
+            self.dbx = dropbox.Dropbox(oauth2_access_token='stand-in', session=session)
+            return
+        with open(CREDS_PATH) as creds:
             data = json.load(creds)
         self.dbx = dropbox.Dropbox(
             app_key=data['app_key'],
             app_secret=data['app_secret'],
-            oauth2_refresh_token=data['refresh_token']
+            oauth2_refresh_token=data['refresh_token'],
+            session=session
         )
 
-    def upload_file(self, file_from, file_to):
+    def _retry(self, call, *args, **kwargs):
+        """
+        Make a Dropbox API call, retrying with backoff when the connection drops or Dropbox is busy.
+        """
+        for attempt in range(MAX_RETRIES):
+            s = time.monotonic()
+            try:
+                result = call(*args, **kwargs)
+                metrics.observe('pipeline_request_seconds', time.monotonic() - s, service='dropbox', status=200)
+                return result
+            except RateLimitError as e:
+                metrics.inc('pipeline_failures_total', stage='dropbox_request')
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                time.sleep(e.backoff or 2**attempt)
+            except (InternalServerError, requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                metrics.inc('pipeline_failures_total', stage='dropbox_request')
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                time.sleep(2**attempt)
+
+    def upload_file(self, file_from, file_to, overwrite=False, chunk_size=CHUNK_SIZE):
         """
         upload a file to Dropbox using API v2
+
+        Large files are uploaded with an upload session, one chunk at a time. Each chunk is retried on its own,
+        and the session is saved next to the file ({file_from}.upload.json), so an interrupted upload resumes
+        from the last chunk Dropbox received instead of starting over. A saved session that Dropbox no longer
+        knows (expired or closed) is dropped and the file is uploaded again in a new session.
+
+        :param file_from: (str) path of the local file
+        :param file_to: (str) full Dropbox path to upload the file to, including the file name
+        :param overwrite: (optional bool) True to replace the file if it already exists on Dropbox
+        :param chunk_size: (optional int) size of the chunks uploaded in each call
         """
+        mode = WriteMode.overwrite if overwrite else WriteMode.add
+        size = os.path.getsize(file_from)
 
         with open(file_from, 'rb') as f:
-            self.dbx.files_upload(f.read(), file_to)
+            if size <= chunk_size:
+                self._retry(self.dbx.files_upload, f.read(), file_to, mode=mode)
+                return
+
+            def new_session():
+                f.seek(0)
+                result = self._retry(self.dbx.files_upload_session_start, f.read(chunk_size))
+                return {'session_id': result.session_id, 'offset': f.tell(), 'size': size,
+                        'mtime': os.path.getmtime(file_from), 'file_to': file_to}
+
+            # resume the upload session of an earlier, interrupted upload of the same file
+            state_path = f'{file_from}.upload.json'
+            state = {}
+            restarted = False
+            if os.path.exists(state_path):
+                with open(state_path, 'r') as s:
+                    state = json.load(s)
+            if state.get('size') != size or state.get('mtime') != os.path.getmtime(file_from) or state.get('file_to') != file_to:
+                state = new_session()
+                restarted = True
+            cursor = UploadSessionCursor(session_id=state['session_id'], offset=state['offset'])
+
+            while True:
+                with open(state_path, 'w') as s:
+                    json.dump(state, s)
+                f.seek(cursor.offset)
+                chunk = f.read(chunk_size)
+                try:
+                    if cursor.offset + len(chunk) >= size:
+                        self._retry(self.dbx.files_upload_session_finish, chunk, cursor,
+                                    CommitInfo(path=file_to, mode=mode))
+                        break
+                    self._retry(self.dbx.files_upload_session_append_v2, chunk, cursor)
+                    cursor.offset += len(chunk)
+                except ApiError as e:
+                    if _session_gone(e) and self._uploaded(file_from, file_to, size):
+                        # the session was finished, by a call whose answer was lost or by an earlier run
+                        break
+                    if _session_gone(e) and not restarted:
+                        # the saved session expired or was closed, it cannot be resumed: upload the file again
+                        os.remove(state_path)
+                        state = new_session()
+                        restarted = True
+                        cursor = UploadSessionCursor(session_id=state['session_id'], offset=state['offset'])
+                        continue
+                    # Dropbox already has (or is missing) part of this chunk, carry on from where it actually is
+                    offset = _correct_offset(e)
+                    if offset is None:
+                        raise
+                    cursor.offset = offset
+                state['offset'] = cursor.offset
+
+        os.remove(state_path)
         
+    def _uploaded(self, file_from, file_to, size):
+        """
+        Checks whether Dropbox already has a local file at the given path, with the same size and content.
+
+        :param file_from: (str) path of the local file
+        :param file_to: (str) full Dropbox path of the file
+        :param size: (int) size of the local file
+        :returns: True if the file on Dropbox is the local file
+        """
+        try:
+            metadata = self._retry(self.dbx.files_get_metadata, file_to)
+        except ApiError:
+            # nothing at that path
+            return False
+        return getattr(metadata, 'size', None) == size and getattr(metadata, 'content_hash', None) == _content_hash(file_from)
+
     def delete_file(self, file):
         """
         delete a file from Dropbox using API v2
@@ -43,11 +233,25 @@ class TransferData:
 
         self.dbx.files_delete(file)
 
-def upload_zip(year_month):
+def get_transfer_data():
+    """
+    Gets the Dropbox client shared by the whole process, logging in on first use.
+
+    :returns: TransferData
+    """
+    global _transfer_data
+    with _transfer_lock:
+        if _transfer_data is None:
+            _transfer_data = TransferData()
+        return _transfer_data
+
+@profiled('upload_zip')
+def upload_zip(year_month, overwrite=True):
     """
     Uploads a zip specified by year_month to the Air Partners Dropbox account.
+    If the zip already exists on Dropbox, it is replaced in place (unless overwrite is False).
     """
-    transferData = TransferData()
+    transferData = get_transfer_data()
 
     # zip file name
     zip_name = f'{year_month}.zip'
@@ -57,7 +261,7 @@ def upload_zip(year_month):
     file_to = f'/Report_Zips/{zip_name}'  # The full path to upload the file to, including the file name
 
     # API v2 --> upload file to Dropbox
-    transferData.upload_file(file_from, file_to)
+    transferData.upload_file(file_from, file_to, overwrite=overwrite)
     print('file uploaded')
 
 def delete_zip(year_month_prev):
@@ -65,7 +269,7 @@ def delete_zip(year_month_prev):
     If it exists, deletes the zip file of reports from the previous month from
     the Air Partners Dropbox account.
     """
-    transferData = TransferData()
+    transferData = get_transfer_data()
 
     # zip file name
     zip_name = f'{year_month_prev}.zip'
@@ -0,0 +1,241 @@
+"""
+Project: Air Partners
+
+Caches of rendered figures, keyed by a digest of the data they were drawn from and every parameter
+of the figure, so a figure is only served from a cache while its data is unchanged.
+
+FigureCache keeps encoded figures in memory for the service (see service.py and figure.py).
+FigureStore keeps the exported JPEGs of the pipeline's figures on disk, outside of the month
+directory, so a rerun of plots.py copies unchanged figures instead of rendering them again. Its keys
+also include the version of the plotting code, so every figure is rendered again once the code that
+draws it changes. Both drop their least recently used figures once they hold more than their size limit.
+
+Set PIPELINE_FIGURE_CACHE=0 to render every figure of a run again without using the store.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from functools import lru_cache
+import pandas as pd
+
+# bytes of rendered figures kept in memory
+FIGURE_CACHE_BYTES = 256 * 2**20
+# exported figures kept on disk, the month directories are deleted after every run so the store is kept apart
+FIGURE_STORE_DIR = 'figure_cache'
+FIGURE_STORE_BYTES = 2 * 2**30
+STORE_VAR = 'PIPELINE_FIGURE_CACHE'
+# code that decides what a figure looks like; figures drawn by an older version are never reused
+PLOT_CODE = ['utils/create_plots.py', 'utils/output_profiles.py', 'visualizers/calendar_plot.py',
+             'visualizers/diurnal_plot.py', 'visualizers/timeplot_thresholds.py', 'data_analysis/dataviz.py']
+# bump this when figures change for a reason the plotting code does not show (e.g. new fonts on the server)
+FIGURE_VERSION = 1
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def figure_key(data_digest, **params):
+    """
+    Makes the cache key of a figure.
+
+    :param data_digest: (str) digest of the data the figure is drawn from
+    :param params: parameters of the figure, e.g. plot='calendar_plot', pm='pm25', profile='web'
+    :returns: hex digest
+    """
+    return hashlib.sha1(json.dumps([data_digest, params], sort_keys=True, default=str).encode()).hexdigest()
+
+
+class FigureCache(object):
+    """
+    Least recently used cache of figure bytes, bounded by their total size. Safe to use from several threads.
+    """
+
+    def __init__(self, max_bytes=FIGURE_CACHE_BYTES):
+        """
+        Args:
+            max_bytes: (optional int) total size of the figures kept, figures larger than this are never kept
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._figures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: (str) key of the figure, see figure_key
+        :returns: bytes of the figure, or None if it is not cached
+        """
+        with self._lock:
+            data = self._figures.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._figures.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        """
+        Adds a figure, dropping the least recently used figures if the cache is full.
+
+        :param key: (str) key of the figure, see figure_key
+        :param data: (bytes) the encoded figure
+        """
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._figures:
+                self.bytes -= len(self._figures.pop(key))
+            self._figures[key] = data
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                _, dropped = self._figures.popitem(last=False)
+                self.bytes -= len(dropped)
+
+    def stats(self):
+        """
+        :returns: dict with the number of figures cached, their size in bytes, hits and misses
+        """
+        with self._lock:
+            return {'figures': len(self._figures), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+@lru_cache(maxsize=None)
+def code_version():
+    """
+    :returns: digest of the plotting code, its dependencies' versions and FIGURE_VERSION
+    """
+    import matplotlib
+    h = hashlib.sha1(f'{FIGURE_VERSION} {matplotlib.__version__} {pd.__version__}'.encode())
+    for path in PLOT_CODE:
+        h.update((REPO_DIR / path).read_bytes())
+    return h.hexdigest()
+
+
+def frame_digest(df, columns=None):
+    """
+    Gets a digest of the contents of a (compact) sensor frame.
+
+    :param df: (pd.DataFrame) the data
+    :param columns: (optional list of str) columns to include, defaults to every column
+    :returns: hex digest
+    """
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    h = hashlib.sha1(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    # the timezones of timestamp columns are kept in attrs, other attrs (sensor metadata) are not plotted
+    h.update(json.dumps([list(df.columns), [str(t) for t in df.dtypes], df.attrs.get('timestamps')],
+                        sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class FigureStore(object):
+    """
+    Content-addressed store of exported figures on disk, one JPEG per output profile:
+
+        {store_dir}/{key[:2]}/{key}/{profile}.jpeg
+    """
+
+    def __init__(self, store_dir=FIGURE_STORE_DIR, max_bytes=FIGURE_STORE_BYTES):
+        """
+        Args:
+            store_dir: (optional str) directory figures are stored in
+            max_bytes: (optional int) size the store is pruned to, see prune
+        """
+        self.store_dir = Path(store_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _dir(self, key):
+        return self.store_dir / key[:2] / key
+
+    def restore(self, key, year_month, rel_path, profiles):
+        """
+        Copies a stored figure to where it is exported, for every output profile.
+
+        :param key: (str) key of the figure, see figure_key
+        :param year_month: (str) root directory of the month, e.g. '2022-06'
+        :param rel_path: (str) path of the figure relative to the month directory
+        :param profiles: (list of OutputProfile) output profiles of the figure
+        :returns: list of paths written, or None if the figure is not stored for every profile
+        """
+        folder = self._dir(key)
+        sources = [folder / f'{p.name}.jpeg' for p in profiles]
+        if not all(src.exists() for src in sources):
+            with self._lock:
+                self.misses += 1
+            return None
+        paths = []
+        for profile, src in zip(profiles, sources):
+            path = profile.path(year_month, rel_path)
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            # copied, not linked, exports write over their files in place
+            shutil.copyfile(src, path)
+            paths.append(path)
+        # the modification time of a figure's folder is when it was last used, for pruning
+        os.utime(folder)
+        with self._lock:
+            self.hits += 1
+        return paths
+
+    def store(self, key, paths, profiles):
+        """
+        Stores the exported files of a figure.
+
+        :param key: (str) key of the figure, see figure_key
+        :param paths: (list of str) exported files, one per profile
+        :param profiles: (list of OutputProfile) output profiles of the files, in the same order
+        """
+        folder = self._dir(key)
+        folder.mkdir(parents=True, exist_ok=True)
+        for profile, path in zip(profiles, paths):
+            tmp = folder / f'{profile.name}.{os.getpid()}.{threading.get_ident()}.tmp'
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, folder / f'{profile.name}.jpeg')
+
+    def prune(self, max_bytes=None):
+        """
+        Deletes the least recently used figures until the store holds at most max_bytes.
+
+        :param max_bytes: (optional int) size to prune to, defaults to the store's max_bytes
+        :returns: number of figures deleted
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        folders = []
+        total = 0
+        for folder in self.store_dir.glob('*/*'):
+            size = sum(f.stat().st_size for f in folder.iterdir())
+            folders.append((folder.stat().st_mtime, size, folder))
+            total += size
+        deleted = 0
+        for _, size, folder in sorted(folders, key=lambda f: f[0]):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(folder, ignore_errors=True)
+            total -= size
+            deleted += 1
+        return deleted
+
+    def stats(self):
+        """
+        :returns: dict with the figures restored from the store and those that had to be rendered
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def default_store():
+    """
+    :returns: FigureStore the pipeline exports figures through, or None if it was turned off through the environment
+    """
+    if os.environ.get(STORE_VAR, '1') in ('', '0'):
+        return None
+    return FigureStore()
@@ -0,0 +1,223 @@
+"""
+Project: Air Partners
+
+Run manifest: the status of every sensor at every stage of a month's run.
+
+Stages record, for each sensor, whether it succeeded, failed (and why), ran out of time (see utils/watchdog.py),
+had no data or was skipped,
+how long it took and which files it made. The manifest is kept in logs/{year-month}_manifest.json
+and shared by every script of the pipeline, so it covers the whole run:
+
+    {"sensors": {"MOD-PM-00217": {"import": {"status": "ok", "error": null, "started": ..., "finished": ...,
+                                             "seconds": 12.3, "rows": 43200, "artifacts": [...]},
+                                  "plots": {...}, "report": {...}}},
+     "summary": {"import": {"ok": 18, "failed": 1, "empty": 1}, ...}}
+
+Scripts run with --retry-failed only redo the sensors that need it at their stage (see RunManifest.to_retry).
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+
+# stages of a sensor, in the order they run
+STAGES = ['import', 'plots', 'report']
+RETRY_FLAG = '--retry-failed'
+
+
+def _now():
+    return datetime.now().isoformat(timespec='milliseconds')
+
+
+def _status(error):
+    # jobs stopped by the watchdog, and requests that timed out, are told apart from other failures
+    return 'timeout' if isinstance(error, TimeoutError) else 'failed'
+
+
+class RunManifest(object):
+    """
+    Status, errors, timings and artifacts of every sensor at every stage of a month's run, saved after every change.
+    """
+
+    def __init__(self, year_month, log_dir='logs'):
+        """
+        Args:
+            year_month: (str) month of the run, e.g. '2022-06'
+            log_dir: (optional str) directory the manifest is kept in
+        """
+        self.year_month = year_month
+        self.path = Path(log_dir) / f'{year_month}_manifest.json'
+        self.sensors = {}
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as f:
+                    self.sensors = json.load(f).get('sensors', {})
+            except ValueError:
+                print(f'Could not read {self.path}, starting a new manifest')
+        self._lock = threading.RLock()
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'sensors': self.sensors, 'summary': self.summary()}, f, indent=2, default=str)
+        os.replace(tmp, self.path)
+
+    def entry(self, sn, stage):
+        """
+        :returns: the record of a sensor at a stage, or None if the stage has not run for it
+        """
+        return self.sensors.get(sn, {}).get(stage)
+
+    def begin(self, sn, stage):
+        """
+        Starts a new record of a sensor at a stage, replacing the one from an earlier run.
+
+        :param sn: (str) serial number of the sensor
+        :param stage: (str) one of STAGES
+        :returns: the record
+        """
+        with self._lock:
+            entry = {'status': 'running', 'error': None, 'started': _now(), 'finished': None,
+                     'seconds': 0.0, 'artifacts': []}
+            self.sensors.setdefault(sn, {})[stage] = entry
+            self._save()
+            return entry
+
+    @contextmanager
+    def record(self, sn, stage):
+        """
+        Records a piece of work of a stage for a sensor, adding its time to the sensor's unfinished record (call
+        begin first to start a new one, and end once every piece of work is done). Errors are recorded and
+        raised again. More fields, and paths of the files made, can be added to the record:
+
+            with manifest.record(sn, 'plots') as entry:
+                ...
+                entry['artifacts'].extend(paths)
+        """
+        with self._lock:
+            entry = self.entry(sn, stage)
+            if entry is None or entry['finished'] is not None:
+                entry = self.begin(sn, stage)
+        start = time.perf_counter()
+        try:
+            yield entry
+        except Exception as e:
+            with self._lock:
+                entry['status'] = _status(e)
+                entry['error'] = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            with self._lock:
+                entry['seconds'] = round(entry['seconds'] + time.perf_counter() - start, 3)
+                self._save()
+
+    def end(self, sn, stage, status=None, error=None):
+        """
+        Finishes the record of a sensor at a stage. Unless a status is given, a record that did not fail is 'ok'.
+
+        :param sn: (str) serial number of the sensor
+        :param stage: (str) one of STAGES
+        :param status: (optional str) 'ok', 'failed', 'timeout', 'empty' (no data) or 'skipped'
+        :param error: (optional str) why the stage failed or was skipped
+        """
+        with self._lock:
+            entry = self.entry(sn, stage)
+            if entry is None or entry['finished'] is not None:
+                entry = self.begin(sn, stage)
+            if status is not None:
+                entry['status'] = status
+            elif entry['status'] == 'running':
+                entry['status'] = 'ok'
+            if error is not None:
+                entry['error'] = error
+            entry['finished'] = _now()
+            self._save()
+
+    def fail(self, sn, stage, error):
+        """
+        Finishes the record of a sensor at a stage that failed, or ran out of time.
+
+        :param sn: (str) serial number of the sensor
+        :param stage: (str) one of STAGES
+        :param error: (Exception) why it failed
+        """
+        self.end(sn, stage, _status(error), f'{type(error).__name__}: {error}')
+
+    def to_retry(self, stage):
+        """
+        Finds the sensors a stage has to run again for: those that failed or ran out of time at it, or never got
+        to it, and those whose earlier stage finished after it did (e.g. after their import was retried).
+
+        :param stage: (str) one of STAGES
+        :returns: list of serial numbers
+        """
+        previous = STAGES[:STAGES.index(stage)]
+        retry = []
+        for sn, stages in self.sensors.items():
+            entry = stages.get(stage)
+            if entry is not None and entry['status'] in ('failed', 'timeout', 'running'):
+                retry.append(sn)
+                continue
+            finished = entry['finished'] if entry is not None else ''
+            if any(stages.get(p, {}).get('status') == 'ok' and (stages[p]['finished'] or '') > finished
+                   for p in previous):
+                retry.append(sn)
+        return retry
+
+    def sensors_at(self, stage, status='ok'):
+        """
+        :returns: list of serial numbers of the sensors with a status at a stage
+        """
+        return [sn for sn, stages in self.sensors.items() if stages.get(stage, {}).get('status') == status]
+
+    def summary(self):
+        """
+        :returns: dict of stages and the number of sensors with each status
+        """
+        with self._lock:
+            counts = {}
+            for stages in self.sensors.values():
+                for stage, entry in stages.items():
+                    counts.setdefault(stage, {})
+                    counts[stage][entry['status']] = counts[stage].get(entry['status'], 0) + 1
+            return {stage: counts[stage] for stage in STAGES + sorted(set(counts) - set(STAGES)) if stage in counts}
+
+    def report(self, stages=None):
+        """
+        Describes the run for the end of a script: the count of every status per stage, and every failure.
+
+        :param stages: (optional list of str) stages to describe, defaults to every stage
+        :returns: (str) the description
+        """
+        summary = self.summary()
+        stages = [s for s in (stages or summary) if s in summary]
+        lines = [f'Run summary {self.year_month} ({self.path}):']
+        for stage in stages:
+            lines.append(f'  {stage:<8}' + ', '.join(f'{n} {status}' for status, n in sorted(summary[stage].items())))
+        for sn, entries in sorted(self.sensors.items()):
+            for stage in stages:
+                entry = entries.get(stage)
+                if entry is not None and entry['status'] in ('failed', 'timeout'):
+                    lines.append(f'  {entry["status"].upper()} {stage} {sn}: {entry["error"]}')
+        if any(summary[s].get('failed') or summary[s].get('timeout') for s in stages):
+            lines.append(f'  rerun the failed sensors with {RETRY_FLAG}')
+        return '\n'.join(lines)
+
+
+def retry_failed(argv=None):
+    """
+    :returns: True if a script was run with --retry-failed
+    """
+    return RETRY_FLAG in (sys.argv if argv is None else argv)
+
+
+if __name__ == '__main__':
+    # print the summary of a month's run: python3 -m utils.manifest year month
+    year, month = int(sys.argv[1]), int(sys.argv[2])
+    print(RunManifest(f'{year}-{month:02d}').report())
@@ -0,0 +1,276 @@
+"""
+Project: Air Partners
+
+Live metrics of a running pipeline, in the Prometheus text format.
+
+Pipeline stages update counters, gauges and histograms here as they go: rows ingested, API request
+latencies, queue depths, progress and ETA of each stage, and failures. While a script runs, the
+metrics can be watched in two ways, both turned on through the environment:
+
+    PIPELINE_METRICS_FILE=path   rewrite a textfile every few seconds, e.g. for node_exporter's textfile
+                                 collector, or to read with `cat` during a long month-end run
+    PIPELINE_METRICS_PORT=port   serve the metrics at http://127.0.0.1:{port}/metrics
+
+Updating metrics is cheap, so stages always update them; nothing is written or served unless asked for.
+"""
+
+import os
+import time
+import atexit
+import bisect
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FILE_VAR = 'PIPELINE_METRICS_FILE'
+PORT_VAR = 'PIPELINE_METRICS_PORT'
+# seconds between rewrites of the textfile
+WRITE_INTERVAL = 5
+# seconds of ingested rows the throughput gauge is averaged over
+THROUGHPUT_WINDOW = 60
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# name -> (type, help) of every metric
+METRICS = {
+    'pipeline_rows_ingested_total': ('counter', 'Sensor data rows ingested'),
+    'pipeline_rows_per_second': ('gauge', f'Rows ingested per second over the last {THROUGHPUT_WINDOW} seconds'),
+    'pipeline_request_seconds': ('histogram', 'Latency of requests to external services'),
+    'pipeline_queue_depth': ('gauge', 'Items waiting in a queue'),
+    'pipeline_stage_done': ('gauge', 'Items a stage has finished'),
+    'pipeline_stage_total': ('gauge', 'Items a stage has to do'),
+    'pipeline_stage_eta_seconds': ('gauge', 'Estimated seconds until a stage is done'),
+    'pipeline_stage_seconds': ('histogram', 'Time taken by jobs of a stage'),
+    'pipeline_failures_total': ('counter', 'Failed jobs, requests and retries'),
+    'pipeline_timeouts_total': ('counter', 'Jobs stopped for running out of their time budget'),
+}
+
+_lock = threading.Lock()
+# name -> {sorted label tuple: value}, histograms keep [bucket counts, sum, count]
+_values = {name: {} for name in METRICS}
+_ingested = deque()
+_script = None
+_writer = None
+_server = None
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """
+    Adds to a counter.
+
+    :param name: (str) name of the metric, one of METRICS
+    :param value: (optional float) amount to add
+    :param labels: (optional) labels of the series, e.g. stage='import'
+    """
+    with _lock:
+        series = _values[name]
+        key = _key(labels)
+        series[key] = series.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    """
+    Sets a gauge.
+
+    :param name: (str) name of the metric, one of METRICS
+    :param value: (float) new value
+    :param labels: (optional) labels of the series
+    """
+    with _lock:
+        _values[name][_key(labels)] = value
+
+
+def observe(name, seconds, **labels):
+    """
+    Adds an observation to a histogram.
+
+    :param name: (str) name of the metric, one of METRICS
+    :param seconds: (float) observed value
+    :param labels: (optional) labels of the series, e.g. service='quantaq'
+    """
+    with _lock:
+        series = _values[name]
+        key = _key(labels)
+        if key not in series:
+            series[key] = [[0] * len(BUCKETS), 0.0, 0]
+        buckets, _, _ = hist = series[key]
+        i = bisect.bisect_left(BUCKETS, seconds)
+        if i < len(BUCKETS):
+            buckets[i] += 1
+        hist[1] += seconds
+        hist[2] += 1
+
+
+def rows_ingested(rows, **labels):
+    """
+    Counts rows of sensor data ingested, for the row counter and the throughput gauge.
+
+    :param rows: (int) number of rows
+    :param labels: (optional) labels of the series, e.g. sensor='MOD-PM-00217'
+    """
+    inc('pipeline_rows_ingested_total', rows, **labels)
+    now = time.monotonic()
+    with _lock:
+        _ingested.append((now, rows))
+
+
+def _throughput():
+    # rows per second over the window, called with the lock held
+    now = time.monotonic()
+    while _ingested and _ingested[0][0] < now - THROUGHPUT_WINDOW:
+        _ingested.popleft()
+    if not _ingested:
+        return 0.0
+    span = max(now - _ingested[0][0], 1.0)
+    return sum(rows for _, rows in _ingested) / span
+
+
+class Progress(object):
+    """
+    Progress of a stage over a known number of items, kept up to date in the stage gauges with an ETA.
+    """
+
+    def __init__(self, stage, total):
+        """
+        Args:
+            stage: (str) name of the stage
+            total: (int) number of items the stage has to do
+        """
+        self.stage = stage
+        self.total = total
+        self.done = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        set_gauge('pipeline_stage_total', total, stage=stage)
+        self._update()
+
+    def _update(self):
+        set_gauge('pipeline_stage_done', self.done, stage=self.stage)
+        set_gauge('pipeline_queue_depth', self.total - self.done, queue=self.stage)
+        eta = self.eta()
+        if eta is not None:
+            set_gauge('pipeline_stage_eta_seconds', eta, stage=self.stage)
+
+    def eta(self):
+        """
+        :returns: estimated seconds until the stage is done, from the average time of the items so far
+        """
+        if self.done == 0:
+            return None
+        return (time.monotonic() - self.started) / self.done * (self.total - self.done)
+
+    def advance(self, failed=False):
+        """
+        Marks an item done.
+
+        :param failed: (optional bool) True if the item failed
+        """
+        with self._lock:
+            self.done += 1
+            self._update()
+        if failed:
+            inc('pipeline_failures_total', stage=self.stage)
+
+    def __str__(self):
+        eta = self.eta()
+        return f'{self.done} / {self.total}' + (f', about {eta / 60:.0f} min left' if eta is not None else '')
+
+
+def _format(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+def render():
+    """
+    :returns: (str) every metric in the Prometheus text exposition format
+    """
+    base = (('script', _script),) if _script else ()
+    lines = []
+    with _lock:
+        _values['pipeline_rows_per_second'][()] = _throughput()
+        for name, (kind, help_text) in METRICS.items():
+            series = _values[name]
+            if not series:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for key, value in sorted(series.items()):
+                key = base + key
+                if kind != 'histogram':
+                    lines.append(f'{name}{_labels(key)} {_format(value)}')
+                    continue
+                buckets, total, count = value
+                cumulative = 0
+                for bound, n in zip(BUCKETS, buckets):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{_labels(key, [("le", str(bound))])} {cumulative}')
+                lines.append(f'{name}_bucket{_labels(key, [("le", "+Inf")])} {count}')
+                lines.append(f'{name}_sum{_labels(key)} {_format(total)}')
+                lines.append(f'{name}_count{_labels(key)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path):
+    """
+    Writes the metrics to a file, replacing it in one step so readers never see half a file.
+
+    :param path: (str) path of the textfile
+    """
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200 if self.path.rstrip('/') in ('', '/metrics') else 404)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_exporter(script):
+    """
+    Starts writing and/or serving the metrics of a script, if asked for through the environment.
+    The textfile is written one last time when the script exits.
+
+    :param script: (str) name of the script, added to every series as the script label
+    """
+    global _script, _writer, _server
+    _script = script
+    path = os.environ.get(FILE_VAR)
+    if path and _writer is None:
+        def _write_loop():
+            while True:
+                try:
+                    write_textfile(path)
+                except OSError as e:
+                    print(f'Could not write metrics to {path}: {e}')
+                time.sleep(WRITE_INTERVAL)
+        _writer = threading.Thread(target=_write_loop, daemon=True)
+        _writer.start()
+        atexit.register(write_textfile, path)
+    port = os.environ.get(PORT_VAR)
+    if port and _server is None:
+        _server = ThreadingHTTPServer(('127.0.0.1', int(port)), _Handler)
+        _server.daemon_threads = True
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
+        print(f'Serving metrics at http://127.0.0.1:{port}/metrics')
@@ -0,0 +1,166 @@
+"""
+Project: Air Partners
+
+Output quality profiles for exported figures and report pages. A figure is
+rendered once in memory at the highest resolution any requested profile needs,
+and every profile is then encoded from that single raster.
+
+The 'print' profile writes to the usual location (e.g. 2022-06/Graphs/...),
+every other profile writes to a mirrored tree under the profile's name
+(e.g. 2022-06/email/Graphs/...).
+
+By default figures and pages are exported for print, which stays on disk (report pages are drawn from
+the printed figures), and for email, which is what goes into the month's zip that is uploaded and emailed.
+The zip holds a single variant of every file, see archive_name.
+"""
+
+import io
+import os
+from pathlib import Path
+from PIL import Image
+
+
+class OutputProfile(object):
+    """
+    Encoding settings for one variant of an exported image.
+    """
+
+    def __init__(self, name, dpi, quality, progressive=False, optimize=False):
+        """
+        Args:
+            name: (str) name of the profile, also the subdirectory its files are written to
+            dpi: (int) resolution of the exported image
+            quality: (int) JPEG quality, 1 (worst) to 95 (best)
+            progressive: (bool) True if the JPEG should be progressively encoded
+            optimize: (bool) True if Pillow should optimize the Huffman tables (smaller, slower)
+        """
+        self.name = name
+        self.dpi = dpi
+        self.quality = quality
+        self.progressive = progressive
+        self.optimize = optimize
+
+    def path(self, year_month, rel_path):
+        """
+        Gets the path a file should be written to for this profile.
+
+        :param year_month: (str) root directory of the month, e.g. '2022-06'
+        :param rel_path: (str) path of the file relative to the month directory
+        :returns: string path of the file
+        """
+        if self.name == 'print':
+            return f'{year_month}/{rel_path}'
+        return f'{year_month}/{self.name}/{rel_path}'
+
+
+PROFILES = {
+    # full resolution, same as the figures have always been exported
+    'print': OutputProfile('print', dpi=300, quality=95),
+    # small enough to be opened on screen from the emailed zip
+    'email': OutputProfile('email', dpi=120, quality=80, progressive=True, optimize=True),
+    'web': OutputProfile('web', dpi=96, quality=75, progressive=True, optimize=True),
+}
+
+DEFAULT_PROFILES = ('print', 'email')
+# profile of the figures, pages and PDFs that go into the month's zip
+ARCHIVE_PROFILE = 'email'
+
+
+def get_profiles(profiles=None):
+    """
+    Resolves a list of profile names and/or OutputProfile objects.
+
+    :param profiles: (optional list) profile names or OutputProfile objects, defaults to DEFAULT_PROFILES
+    :returns: list of OutputProfile objects
+    """
+    if profiles is None:
+        profiles = DEFAULT_PROFILES
+    return [PROFILES[p] if isinstance(p, str) else p for p in profiles]
+
+
+def archive_name(year_month, rel_path):
+    """
+    Picks the variant of an exported file that goes into the month's zip: the ARCHIVE_PROFILE variant,
+    under the path of the print variant. Files that were not exported for ARCHIVE_PROFILE go in as they are.
+
+    :param year_month: (str) root directory of the month, e.g. '2022-06'
+    :param rel_path: (str) path of the file relative to the month directory
+    :returns: name of the file in the zip, or None if the file is left out
+    """
+    first, _, rest = rel_path.partition('/')
+    if first in PROFILES and rest:
+        return rest if first == ARCHIVE_PROFILE else None
+    if ARCHIVE_PROFILE != 'print' and Path(PROFILES[ARCHIVE_PROFILE].path(year_month, rel_path)).exists():
+        return None
+    return rel_path
+
+
+def export_figure(fig, year_month, rel_path, profiles=None, bbox_inches='tight'):
+    """
+    Renders a matplotlib figure once and saves a JPEG for every output profile.
+
+    :param fig: (matplotlib.figure.Figure) figure to export
+    :param year_month: (str) root directory of the month, e.g. '2022-06'
+    :param rel_path: (str) path of the JPEG relative to the month directory
+    :param profiles: (optional list) profile names or OutputProfile objects, defaults to DEFAULT_PROFILES
+    :param bbox_inches: (optional str) passed to savefig
+    :returns: list of paths that were written
+    """
+    profiles = get_profiles(profiles)
+    render_dpi = max(p.dpi for p in profiles)
+
+    # uncompressed PNG is the cheapest lossless way to get the raster out of matplotlib
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=render_dpi, bbox_inches=bbox_inches,
+                pil_kwargs={'compress_level': 0})
+    buf.seek(0)
+
+    paths = []
+    with Image.open(buf) as img:
+        img = img.convert('RGB')
+        for profile in profiles:
+            if profile.dpi == render_dpi:
+                out = img
+            else:
+                scale = profile.dpi / render_dpi
+                size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+                out = img.resize(size, Image.LANCZOS)
+            path = profile.path(year_month, rel_path)
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            _save_jpeg(out, path, profile)
+            paths.append(path)
+    return paths
+
+
+def _save_jpeg(img, target, profile):
+    # files are written next to their path and moved there once complete, so an export that is
+    # interrupted never leaves a truncated JPEG where reports and the zip would pick it up
+    out = f'{target}.part' if isinstance(target, str) else target
+    try:
+        img.save(out, format='JPEG', quality=profile.quality, progressive=profile.progressive,
+                 optimize=profile.optimize, dpi=(profile.dpi, profile.dpi))
+    except BaseException:
+        if out is not target and os.path.exists(out):
+            os.remove(out)
+        raise
+    if out is not target:
+        os.replace(out, target)
+
+
+def encode_figure(fig, profile='print', bbox_inches='tight'):
+    """
+    Renders a matplotlib figure to JPEG bytes for one output profile, without writing a file.
+
+    :param fig: (matplotlib.figure.Figure) figure to encode
+    :param profile: (optional str or OutputProfile) output profile of the image
+    :param bbox_inches: (optional str) passed to savefig
+    :returns: bytes of the JPEG
+    """
+    profile = get_profiles([profile])[0]
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=profile.dpi, bbox_inches=bbox_inches, pil_kwargs={'compress_level': 0})
+    buf.seek(0)
+    out = io.BytesIO()
+    with Image.open(buf) as img:
+        _save_jpeg(img.convert('RGB'), out, profile)
+    return out.getvalue()
@@ -0,0 +1,299 @@
+"""
+Project: Air Partners
+
+Per-stage profiling of pipeline runs.
+
+Functions decorated with @profiled, and blocks wrapped in `with stage(...)`, are recorded as jobs: their
+wall time, CPU time, resident memory, the rows they handled and the sensor they were for. Each script of
+the pipeline writes its jobs, and a summary per stage, to a JSON run report when it exits
+(logs/{year-month}_run_report.json, one entry per script).
+
+Recording times and resident memory costs next to nothing, so it is always on. More detail can be
+turned on through the environment:
+
+    PIPELINE_TRACEMALLOC=1   also record the peak memory Python allocated in every job (slows Python code down)
+    PIPELINE_CPROFILE=N      profile every sensor job with cProfile and keep the N slowest of each stage,
+                             as .prof files in logs/profiles/ (open with pstats or snakeviz)
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import atexit
+import pstats
+import cProfile
+import functools
+import inspect
+import threading
+import tracemalloc
+from pathlib import Path
+from datetime import datetime
+from utils import metrics
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+TRACEMALLOC_VAR = 'PIPELINE_TRACEMALLOC'
+CPROFILE_VAR = 'PIPELINE_CPROFILE'
+PROFILE_DIR = 'logs/profiles'
+
+_jobs = []
+_lock = threading.Lock()
+# jobs running right now, outermost first, so peaks of nested jobs are also counted in the jobs around them
+_active = []
+# stage name -> heap of (seconds, counter, label, cProfile.Profile) of its slowest jobs
+_slowest = {}
+_counter = [0]
+_local = threading.local()
+_started = datetime.now()
+
+
+def _mb(n):
+    return round(n / 2**20, 2)
+
+
+def _rss():
+    # current resident memory of the process, from /proc where there is one
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _tracing():
+    return os.environ.get(TRACEMALLOC_VAR, '') not in ('', '0')
+
+
+def _keep_profiles():
+    try:
+        return int(os.environ.get(CPROFILE_VAR, 0))
+    except ValueError:
+        return 0
+
+
+def _note_peak():
+    # hand the traced peak so far to every running job, then start a new peak for the next stretch
+    peak = tracemalloc.get_traced_memory()[1]
+    for job in _active:
+        job['_peak'] = max(job.get('_peak', 0), peak)
+    tracemalloc.reset_peak()
+
+
+class stage(object):
+    """
+    Records a block of code as a job of a stage. The record is a dict, more fields (e.g. rows) can be added to it:
+
+        with stage('plot_and_export', sensor=sn, plot='calendar_plot') as job:
+            ...
+            job['rows'] = len(data)
+    """
+
+    def __init__(self, name, sensor=None, **fields):
+        """
+        Args:
+            name: (str) name of the stage, jobs of the same stage are summarized together
+            sensor: (optional str) serial number of the sensor the job is for
+            fields: (optional) anything else worth keeping with the job, must be JSON serializable
+        """
+        self.job = {'stage': name, 'sensor': sensor, **fields}
+        self._profile = None
+
+    def __enter__(self):
+        self.job['start'] = datetime.now().isoformat(timespec='seconds')
+        if _tracing():
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            with _lock:
+                _note_peak()
+                _active.append(self.job)
+        # only the outermost sensor job of a thread is profiled, profilers cannot be nested
+        if self.job['sensor'] is not None and _keep_profiles() and not getattr(_local, 'profiling', False):
+            _local.profiling = True
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self.job
+
+    def __exit__(self, exc_type, exc, tb):
+        job = self.job
+        job['seconds'] = round(time.perf_counter() - self._wall, 4)
+        job['cpu_seconds'] = round(time.process_time() - self._cpu, 4)
+        if self._profile is not None:
+            self._profile.disable()
+            _local.profiling = False
+        rss, peak_rss = _rss(), _peak_rss()
+        job['rss_mb'] = _mb(rss) if rss is not None else None
+        job['peak_rss_mb'] = _mb(peak_rss) if peak_rss is not None else None
+        if exc_type is not None:
+            job['error'] = f'{exc_type.__name__}: {exc}'
+            metrics.inc('pipeline_failures_total', stage=job['stage'])
+        metrics.observe('pipeline_stage_seconds', job['seconds'], stage=job['stage'])
+        with _lock:
+            if any(j is job for j in _active):
+                _note_peak()
+                _active[:] = [j for j in _active if j is not job]
+                job['peak_traced_mb'] = _mb(job.pop('_peak'))
+            _jobs.append(job)
+            if self._profile is not None:
+                self._keep(job)
+        return False
+
+    def _keep(self, job):
+        # keep the profile if the job is one of the slowest of its stage
+        slowest = _slowest.setdefault(job['stage'], [])
+        _counter[0] += 1
+        entry = (job['seconds'], _counter[0], job['sensor'], self._profile)
+        if len(slowest) < _keep_profiles():
+            heapq.heappush(slowest, entry)
+        elif entry[0] > slowest[0][0]:
+            heapq.heapreplace(slowest, entry)
+
+
+def _lookup(arguments, name):
+    # argument of a call by name, a dotted name reads an attribute of it (e.g. 'self.sn')
+    first, *attrs = name.split('.')
+    value = arguments.get(first)
+    for attr in attrs:
+        value = getattr(value, attr, None)
+    return value
+
+
+def _count_rows(result):
+    # pandas is not imported for this, a result can only be a dataframe once something else imported it
+    pd = sys.modules.get('pandas')
+    if pd is not None and isinstance(result, pd.DataFrame):
+        return len(result)
+    return None
+
+
+def profiled(name=None, sensor=None, rows=_count_rows):
+    """
+    Decorator that records every call of a function as a job (see stage).
+
+    :param name: (optional str) name of the stage, defaults to the function's name
+    :param sensor: (optional str) name of the argument holding the sensor's serial number, e.g. 'sensor_sn' or 'self.sn'
+    :param rows: (optional callable) gets the number of rows handled from the function's result,
+        counts the rows of returned dataframes by default
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            sn = None
+            if sensor is not None:
+                sn = _lookup(signature.bind_partial(*args, **kwargs).arguments, sensor)
+            with stage(name or fn.__name__, sensor=sn) as job:
+                result = fn(*args, **kwargs)
+                job['rows'] = rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def summary(jobs=None):
+    """
+    Summarizes jobs per stage.
+
+    :param jobs: (optional list of dict) jobs to summarize, defaults to every job recorded so far
+    :returns: dict of stage names and their job count, total and slowest times, rows and errors
+    """
+    if jobs is None:
+        with _lock:
+            jobs = list(_jobs)
+    stages = {}
+    for job in jobs:
+        s = stages.setdefault(job['stage'], {'jobs': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'max_seconds': 0.0,
+                                             'slowest_sensor': None, 'rows': 0, 'errors': 0})
+        s['jobs'] += 1
+        s['seconds'] = round(s['seconds'] + job['seconds'], 4)
+        s['cpu_seconds'] = round(s['cpu_seconds'] + job['cpu_seconds'], 4)
+        if job['seconds'] >= s['max_seconds']:
+            s['max_seconds'], s['slowest_sensor'] = job['seconds'], job['sensor']
+        s['rows'] += job.get('rows') or 0
+        s['errors'] += 'error' in job
+        if job.get('peak_traced_mb') is not None:
+            s['peak_traced_mb'] = max(s.get('peak_traced_mb', 0), job['peak_traced_mb'])
+    return stages
+
+
+def _dump_profiles(script):
+    paths = []
+    with _lock:
+        slowest = {name: sorted(heap, reverse=True) for name, heap in _slowest.items()}
+    for name, heap in slowest.items():
+        for seconds, _, sn, profile in heap:
+            path = Path(PROFILE_DIR) / f'{script}_{name}_{sn}.prof'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            pstats.Stats(profile).dump_stats(path)
+            paths.append({'stage': name, 'sensor': sn, 'seconds': seconds, 'path': str(path)})
+    return paths
+
+
+def write_report(path, script):
+    """
+    Writes the jobs recorded so far to a JSON run report, replacing the script's entry from earlier runs.
+    Each script of the pipeline has its own entry, so one report covers the whole monthly run.
+
+    :param path: (str) path of the report, e.g. 'logs/2022-06_run_report.json'
+    :param script: (str) name of the script, e.g. 'import_data'
+    """
+    with _lock:
+        jobs = list(_jobs)
+    peak_rss = _peak_rss()
+    run = {
+        'started': _started.isoformat(timespec='seconds'),
+        'finished': datetime.now().isoformat(timespec='seconds'),
+        'peak_rss_mb': _mb(peak_rss) if peak_rss is not None else None,
+        'stages': summary(jobs),
+        'jobs': jobs,
+        'profiles': _dump_profiles(script),
+    }
+    report = {}
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                report = json.load(f)
+        except ValueError:
+            report = {}
+    report.setdefault('runs', {})[script] = run
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    os.replace(f'{path}.tmp', path)
+    print(f'Run report written to {path}')
+
+
+def report_at_exit(year_month, script):
+    """
+    Writes the run report of a script when it exits, also when it crashes.
+
+    :param year_month: (str) month the pipeline is running for, e.g. '2022-06'
+    :param script: (str) name of the script, e.g. 'import_data'
+    """
+    atexit.register(write_report, f'logs/{year_month}_run_report.json', script)
+
+
+def reset():
+    """
+    Forgets the jobs recorded so far, so the next run report only covers what runs from now on
+    (e.g. between the jobs of the long-running service, see service.py).
+    """
+    global _started
+    with _lock:
+        _jobs.clear()
+        _slowest.clear()
+        _started = datetime.now()
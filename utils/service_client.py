@@ -0,0 +1,26 @@
+"""
+Project: Air Partners
+
+Client side of the long-running service (see service.py): sends a request to its socket and reads the answer.
+Kept apart from the service so clients (e.g. figure.py) do not import the whole pipeline to talk to it.
+"""
+
+import json
+import socket
+
+SOCKET_PATH = 'service.sock'
+
+
+def request(message, socket_path=SOCKET_PATH):
+    """
+    Sends a request to a running service.
+
+    :param message: (dict) the request, see PipelineService.handle
+    :param socket_path: (optional str) path of the service's socket
+    :returns: dict answer of the service
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(message) + '\n').encode())
+        with sock.makefile('r') as f:
+            return json.loads(f.readline())
@@ -0,0 +1,177 @@
+"""
+Project: Air Partners
+
+Local basemap tile cache and static map renderer for sensor maps.
+
+Tiles for the area covering the sensor network are downloaded once and stored on disk in
+_images/tiles/{style}/{z}/{x}/{y}.png. Maps are then drawn from the cached tiles with Pillow,
+so rendering a map needs no browser, no kaleido and no network connection.
+"""
+
+import os
+import io
+import math
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from PIL import Image, ImageDraw, ImageFont
+
+TILE_DIR = '_images/tiles'
+# Mapbox raster tiles of a Mapbox style, 512px tiles line up with the zoom levels plotly uses for mapbox maps
+MAPBOX_URL = 'https://api.mapbox.com/styles/v1/mapbox/{style}/tiles/512/{z}/{x}/{y}?access_token={token}'
+MAPBOX_STYLE = 'streets-v11'
+TILE_SIZE = 512
+ATTRIBUTION = '© Mapbox © OpenStreetMap'
+DOWNLOAD_WORKERS = 4
+
+
+def _world_px(lat, lon, zoom, tile_size=TILE_SIZE):
+    """
+    Converts a latitude and longitude into Web Mercator pixel coordinates at a zoom level.
+
+    :returns: (x, y) pixel coordinates, origin at the top left of the world
+    """
+    world = tile_size * 2**zoom
+    x = (lon + 180) / 360 * world
+    sin_lat = math.sin(math.radians(lat))
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * world
+    return x, y
+
+
+def _find_font(size):
+    """
+    Gets a TrueType font for map labels, falling back to Pillow's built-in font.
+    """
+    try:
+        from matplotlib import font_manager
+        return ImageFont.truetype(font_manager.findfont('DejaVu Sans'), size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+class TileCache(object):
+    """
+    Downloads basemap tiles once and serves them from disk afterwards.
+    """
+
+    def __init__(self, token=None, style=MAPBOX_STYLE, cache_dir=TILE_DIR, url=MAPBOX_URL, tile_size=TILE_SIZE):
+        """
+        Args:
+            token: (optional str) Mapbox access token, only needed for tiles that are not cached yet
+            style: (optional str) Mapbox style of the tiles
+            cache_dir: (optional str) directory tiles are stored in
+            url: (optional str) URL template of the tile server
+            tile_size: (optional int) width and height of a tile in pixels
+        """
+        self.token = token.strip() if token else token
+        self.style = style
+        self.cache_dir = cache_dir
+        self.url = url
+        self.tile_size = tile_size
+        self.session = None
+
+    def _tile_path(self, z, x, y):
+        return f'{self.cache_dir}/{self.style}/{z}/{x}/{y}.png'
+
+    def tile(self, z, x, y):
+        """
+        Gets a tile, downloading it first if it is not cached.
+
+        :returns: PIL image of the tile
+        """
+        path = self._tile_path(z, x, y)
+        if not os.path.exists(path):
+            if self.token is None:
+                raise FileNotFoundError(f'Tile {z}/{x}/{y} is not cached and no Mapbox token was given')
+            if self.session is None:
+                self.session = requests.Session()
+            r = self.session.get(self.url.format(style=self.style, z=z, x=x, y=y, token=self.token), timeout=30)
+            r.raise_for_status()
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file first so an interrupted download never leaves a broken tile behind
+            with open(f'{path}.part', 'wb') as f:
+                f.write(r.content)
+            os.replace(f'{path}.part', path)
+        return Image.open(path).convert('RGB')
+
+    def _tile_range(self, lat_min, lon_min, lat_max, lon_max, zoom, margin_px):
+        # tile y grows southwards
+        x0, y0 = _world_px(lat_max, lon_min, zoom, self.tile_size)
+        x1, y1 = _world_px(lat_min, lon_max, zoom, self.tile_size)
+        n = 2**zoom
+        tx0 = max(0, int((x0 - margin_px) // self.tile_size))
+        ty0 = max(0, int((y0 - margin_px) // self.tile_size))
+        tx1 = min(n - 1, int((x1 + margin_px) // self.tile_size))
+        ty1 = min(n - 1, int((y1 + margin_px) // self.tile_size))
+        return [(zoom, x, y) for x in range(tx0, tx1 + 1) for y in range(ty0, ty1 + 1)]
+
+    def prefetch(self, lats, lons, zoom, width, height):
+        """
+        Downloads every tile needed to draw a map of the given size centered on any of the given points.
+
+        :param lats: (list of float) latitudes of the sensors
+        :param lons: (list of float) longitudes of the sensors
+        :param zoom: (int) zoom level of the maps
+        :param width: (int) width of the maps in pixels
+        :param height: (int) height of the maps in pixels
+        :returns: number of tiles that were downloaded
+        """
+        tiles = self._tile_range(min(lats), min(lons), max(lats), max(lons), zoom, max(width, height) / 2)
+        missing = [t for t in tiles if not os.path.exists(self._tile_path(*t))]
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+            list(pool.map(lambda t: self.tile(*t), missing))
+        print(f'{len(tiles) - len(missing)} tiles cached, downloaded {len(missing)}.')
+        return len(missing)
+
+    def render(self, lat, lon, zoom, width, height, markers=(), marker_size=30, marker_color='green',
+               font_size=28, font_color='black'):
+        """
+        Draws a map centered on a point, with labelled markers, from cached tiles.
+
+        :param lat: (float) latitude of the center of the map
+        :param lon: (float) longitude of the center of the map
+        :param zoom: (int) zoom level of the map
+        :param width: (int) width of the map in pixels
+        :param height: (int) height of the map in pixels
+        :param markers: (optional list) (label, lat, lon) tuples of markers to draw
+        :param marker_size: (optional int) diameter of the markers in pixels
+        :param marker_color: (optional str) color of the markers
+        :param font_size: (optional int) size of the labels in pixels
+        :param font_color: (optional str) color of the labels
+        :returns: PIL image of the map
+        """
+        cx, cy = _world_px(lat, lon, zoom, self.tile_size)
+        left, top = cx - width / 2, cy - height / 2
+        n = 2**zoom
+
+        img = Image.new('RGB', (width, height), 'white')
+        tx0, ty0 = int(left // self.tile_size), int(top // self.tile_size)
+        tx1, ty1 = int((left + width) // self.tile_size), int((top + height) // self.tile_size)
+        for tx in range(tx0, tx1 + 1):
+            for ty in range(max(0, ty0), min(n - 1, ty1) + 1):
+                tile = self.tile(zoom, tx % n, ty)
+                img.paste(tile, (round(tx * self.tile_size - left), round(ty * self.tile_size - top)))
+
+        draw = ImageDraw.Draw(img)
+        font = _find_font(font_size)
+        r = marker_size / 2
+        for label, m_lat, m_lon in markers:
+            mx, my = _world_px(m_lat, m_lon, zoom, self.tile_size)
+            mx, my = mx - left, my - top
+            draw.ellipse([mx - r, my - r, mx + r, my + r], fill=marker_color)
+            # label sits centered above the marker, like plotly's 'top center'
+            tw, th = draw.textbbox((0, 0), label, font=font)[2:]
+            draw.text((mx - tw / 2, my - r - th - 2), label, fill=font_color, font=font)
+
+        small = _find_font(10)
+        tw, th = draw.textbbox((0, 0), ATTRIBUTION, font=small)[2:]
+        draw.text((width - tw - 4, height - th - 4), ATTRIBUTION, fill='black', font=small)
+        return img
+
+    def render_png(self, *args, **kwargs):
+        """
+        Same as render, but returns the map as PNG bytes.
+        """
+        buf = io.BytesIO()
+        self.render(*args, **kwargs).save(buf, format='PNG')
+        return buf.getvalue()
@@ -0,0 +1,315 @@
+"""
+Project: Air Partners
+
+Time budgets for the jobs of a run, so that one component that hangs cannot stall the whole pipeline.
+
+Jobs of ingestion (a sensor's download), rendering (a figure, a map) and reporting (a sensor's report
+pages) run with a time budget (see run). A job that runs out of time is stopped, marked as timed out in
+the run report, the metrics and the run manifest (see utils/manifest.py), and tried again after a backoff.
+Once it has run out of time on every attempt, JobTimeout is raised and the run goes on without it.
+
+How a job is stopped depends on where it is stuck:
+
+- calls that can hang outside of Python, like R's polarPlot, run in a worker process of their own that is
+  killed and started again once their time is up (see Worker); helper processes, like plotly's kaleido,
+  are killed (see kill_after)
+- network code asks for the time left (see remaining) and never waits longer than that
+- any other Python code is interrupted with SIGALRM, if the job runs in the main thread (the scripts of
+  pipeline.sh do; jobs of the service, see service.py, only stop in the two ways above)
+
+PIPELINE_BUDGET_SCALE=2 doubles every budget, e.g. on a slow machine, and PIPELINE_BUDGET_SCALE=0 turns them off.
+"""
+
+import os
+import time
+import signal
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from utils import metrics
+from utils.profiling import stage
+
+# seconds a job has, by kind of job
+BUDGETS = {
+    # a sensor's month of data, from QuantAQ and IEM
+    'import': 30 * 60,
+    # a figure of a sensor, the polar plots start R and are much slower than the others
+    'plot': 2 * 60,
+    'wind_polar_plot': 6 * 60,
+    # one call of R's polarPlot
+    'polar_plot': 3 * 60,
+    # a sensor's map, rendered by kaleido
+    'map': 2 * 60,
+    # a sensor's report pages
+    'report': 3 * 60,
+}
+# times a job is tried, and seconds waited before trying it again (doubled after every attempt)
+ATTEMPTS = 2
+BACKOFF = 10
+SCALE_VAR = 'PIPELINE_BUDGET_SCALE'
+
+_local = threading.local()
+
+
+class JobTimeout(TimeoutError):
+    """
+    Raised when a job runs out of its time budget.
+    """
+
+
+def _scale():
+    try:
+        return float(os.environ.get(SCALE_VAR, 1))
+    except ValueError:
+        return 1.0
+
+
+def _deadlines():
+    # deadlines of the jobs running in this thread, outermost first
+    if not hasattr(_local, 'deadlines'):
+        _local.deadlines = []
+    return _local.deadlines
+
+
+def _expired():
+    deadlines = _deadlines()
+    return bool(deadlines) and min(deadlines) <= time.monotonic()
+
+
+def remaining(default=None):
+    """
+    Gets the time left to the job running in this thread, for calls that wait (timeouts of requests, sleeps).
+
+    :param default: (optional float) seconds to wait if no job with a budget is running
+    :returns: seconds left, at most default if one is given
+    """
+    deadlines = _deadlines()
+    if not deadlines:
+        return default
+    left = min(deadlines) - time.monotonic()
+    if left <= 0:
+        raise JobTimeout('out of time')
+    return left if default is None else min(default, left)
+
+
+def _on_alarm(signum, frame):
+    raise JobTimeout('out of time')
+
+
+def _arm():
+    # sets SIGALRM to go off at the earliest deadline, signals are only handled in the main thread
+    if threading.current_thread() is not threading.main_thread() or not hasattr(signal, 'setitimer'):
+        return
+    deadlines = _deadlines()
+    if deadlines:
+        if not hasattr(_local, 'handler'):
+            _local.handler = signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, max(min(deadlines) - time.monotonic(), 0.001))
+    else:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        if hasattr(_local, 'handler'):
+            signal.signal(signal.SIGALRM, _local.handler)
+            del _local.handler
+
+
+@contextmanager
+def limit(seconds):
+    """
+    Gives a block of code a time budget, it raises JobTimeout once the time is up (see the module docstring).
+    Budgets can be nested, the earliest deadline counts.
+
+    :param seconds: (float) seconds the block has, None for no budget
+    """
+    if seconds is None:
+        yield
+        return
+    deadlines = _deadlines()
+    deadlines.append(time.monotonic() + seconds)
+    _arm()
+    try:
+        yield
+    finally:
+        deadlines.pop()
+        _arm()
+
+
+def run(name, fn, *args, budget=None, sensor=None, attempts=ATTEMPTS, backoff=BACKOFF, **kwargs):
+    """
+    Runs a job within a time budget, trying it again after a backoff when it runs out of time.
+    Every attempt is recorded in the run report (stage budget_{name}, with timed_out set if it ran out of time).
+
+    :param name: (str) kind of job, one of BUDGETS
+    :param fn: (callable) the job, called with args and kwargs
+    :param budget: (optional float) seconds every attempt has, defaults to BUDGETS[name]
+    :param sensor: (optional str) serial number of the sensor the job is for
+    :param attempts: (optional int) times the job is tried
+    :param backoff: (optional float) seconds waited before the second attempt, doubled after every attempt
+    :returns: what the job returned, raises JobTimeout if it ran out of time on every attempt
+    """
+    seconds = (BUDGETS[name] if budget is None else budget) * _scale()
+    if not seconds:
+        return fn(*args, **kwargs)
+    for attempt in range(1, attempts + 1):
+        with stage(f'budget_{name}', sensor=sensor, budget=seconds, attempt=attempt) as job:
+            try:
+                with limit(seconds):
+                    return fn(*args, **kwargs)
+            except JobTimeout as e:
+                job['timed_out'] = True
+                metrics.inc('pipeline_timeouts_total', job=name)
+                # the job this one is part of ran out of time, it is tried again (or not) there
+                if _expired():
+                    raise
+                label = f'{name} of {sensor}' if sensor is not None else name
+                if attempt == attempts:
+                    raise JobTimeout(f'{label} ran out of its {seconds:g} s budget on every attempt ({attempts})') from e
+                wait = backoff * 2 ** (attempt - 1)
+                print(f'\n{label} ran out of its {seconds:g} s budget, trying again in {wait} s')
+        time.sleep(remaining(wait))
+
+
+def _serve(conn):
+    # runs in a Worker's process, answering the calls sent to it until the pipe is closed
+    while True:
+        try:
+            fn, args, kwargs = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = ('ok', fn(*args, **kwargs))
+        except Exception as e:
+            result = ('error', e)
+        try:
+            conn.send(result)
+        except Exception:
+            # results and errors that cannot be pickled
+            conn.send(('error', RuntimeError(repr(result[1]))))
+
+
+class Worker(object):
+    """
+    A process of its own that runs calls sent to it, one at a time, for calls that can hang outside of
+    Python (e.g. in R). A call that takes too long is stopped by killing the process, which is started
+    again right away, and whatever state the call left behind is thrown away with it. State the calls
+    share on purpose (e.g. R and openair, once loaded) is kept between calls.
+
+    The process is started with forkserver (or spawn where there is no forkserver), never by forking the
+    process that uses it, which may be running threads (e.g. the metrics exporter or the service's).
+    """
+
+    def __init__(self, name):
+        """
+        Args:
+            name: (str) name of the process, e.g. 'R'
+        """
+        self.name = name
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.ctx = multiprocessing.get_context(method)
+        self.process = None
+        self.conn = None
+        # one call at a time, the process answers them in order
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts the process if it is not running. Scripts call this before they start any threads.
+        """
+        with self._lock:
+            self._start()
+
+    def stop(self):
+        """
+        Kills the process, the next call starts it again.
+        """
+        with self._lock:
+            self._stop()
+
+    def _start(self):
+        if self.process is not None and self.process.is_alive():
+            return
+        self._stop()
+        self.conn, child = self.ctx.Pipe()
+        self.process = self.ctx.Process(target=_serve, args=(child,), name=self.name, daemon=True)
+        self.process.start()
+        child.close()
+
+    def _stop(self):
+        if self.process is not None:
+            if self.process.is_alive():
+                self.process.kill()
+            self.process.join()
+            self.conn.close()
+        self.process = self.conn = None
+
+    def call(self, fn, *args, timeout=None, **kwargs):
+        """
+        Runs a call in the process, which is killed (and started again) if the call takes longer than timeout
+        (or the time left to the job it is part of).
+
+        :param fn: (callable) the call, a module-level function, its arguments and result must be picklable
+        :param timeout: (optional float) seconds the call has
+        :returns: what the call returned, raises JobTimeout if it ran out of time and the call's error if it failed
+        """
+        if timeout is not None:
+            # PIPELINE_BUDGET_SCALE=0 turns the timeout off
+            timeout = timeout * _scale() or None
+        with self._lock:
+            self._start()
+            wait = remaining(timeout)
+            try:
+                self.conn.send((fn, args, kwargs))
+                if not self.conn.poll(wait):
+                    raise JobTimeout(f'{fn.__name__} did not finish in {wait:.0f} s, killed the {self.name} process')
+                status, result = self.conn.recv()
+            except EOFError:
+                self.process.join()
+                code = self.process.exitcode
+                self._stop()
+                self._start()
+                raise RuntimeError(f'the {self.name} process died with exit code {code} in {fn.__name__}')
+            except BaseException as e:
+                # out of time (here or in the job this call is part of), the process is still busy with the call
+                self._stop()
+                if isinstance(e, JobTimeout):
+                    self._start()
+                raise
+        if status == 'error':
+            raise result
+        return result
+
+
+@contextmanager
+def kill_after(seconds, get_process):
+    """
+    Kills a helper process that a block of code waits on (e.g. plotly's kaleido) if the block takes longer
+    than seconds (or the time left to the job it is part of). The block then raises JobTimeout, the helper
+    is expected to be started again when it is next needed.
+
+    :param seconds: (float) seconds the block has
+    :param get_process: (callable) gets the helper's subprocess.Popen, or None if it is not running
+    """
+    fired = threading.Event()
+
+    def kill():
+        process = get_process()
+        if process is not None and process.poll() is None:
+            fired.set()
+            process.kill()
+
+    wait = remaining(seconds * _scale()) if seconds * _scale() else None
+    timer = threading.Timer(wait, kill) if wait is not None else None
+    if timer is not None:
+        timer.daemon = True
+        timer.start()
+    try:
+        yield
+    except Exception as e:
+        if fired.is_set():
+            raise JobTimeout(f'did not finish in {wait:.0f} s, killed its helper process') from e
+        if isinstance(e, JobTimeout):
+            # stopped by a budget of its own while the helper was working, the next call would read its answer
+            kill()
+        raise
+    finally:
+        if timer is not None:
+            timer.cancel()
@@ -1,14 +1,158 @@
-import shutil
+import os
 import sys
+import zlib
+import queue
+import zipfile
+import threading
+import warnings
+from pathlib import Path
+from utils import metrics
+from utils.output_profiles import archive_name
 
-def zip_directory(dirName):
+# formats that are already compressed are stored as they are, deflating them again only costs time
+STORED_SUFFIXES = {'.jpeg', '.jpg', '.png', '.pdf', '.zip', '.gz'}
+# folders of intermediate data that are left out of the archive unless asked for
+INTERMEDIATE_DIRS = {'qaq_cleaned_data', 'Booklet'}
+
+
+class ArchiveBuilder(object):
+    """
+    Builds the zip of a month's reports while the reports are being made.
+
+    Files are handed to add() as soon as they are produced and are written to the zip by a background
+    thread, so zipping overlaps with rendering instead of running after it. Pipeline stages run as
+    separate scripts, so later stages open the archive with append=True to add to it. Of files exported
+    for several output profiles, only the email variant is archived (see utils/output_profiles.py).
+    """
+
+    def __init__(self, year_month, append=False, include_intermediate=False, zip_dir='zips', compresslevel=6):
+        """
+        Args:
+            year_month: (str) directory of the month to archive, e.g. '2022-06'
+            append: (optional bool) True to add to an existing archive instead of starting a new one
+            include_intermediate: (optional bool) True if intermediate data (e.g. qaq_cleaned_data) should be included
+            zip_dir: (optional str) directory the zip is written to
+            compresslevel: (optional int) deflate level for files that are not already compressed
+        """
+        self.year_month = year_month
+        self.include_intermediate = include_intermediate
+        self.compresslevel = compresslevel
+        self.zip_path = f'{zip_dir}/{year_month}.zip'
+        Path(zip_dir).mkdir(parents=True, exist_ok=True)
+        mode = 'a' if append and os.path.exists(self.zip_path) else 'w'
+        self.zf = zipfile.ZipFile(self.zip_path, mode)
+        # CRC32 checksums of the entries in the archive, used to skip files that were already added unchanged
+        self.entries = {info.filename: info.CRC for info in self.zf.infolist()}
+        self._rebuild = False
+        self._queue = queue.Queue()
+        self._error = None
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _arcname(self, path):
+        return Path(path).resolve().relative_to(Path(self.year_month).resolve()).as_posix()
+
+    def _included(self, arcname):
+        return self.include_intermediate or not INTERMEDIATE_DIRS.intersection(arcname.split('/')[:-1])
+
+    def _crc(self, path):
+        crc = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                crc = zlib.crc32(chunk, crc)
+        return crc
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            metrics.set_gauge('pipeline_queue_depth', self._queue.qsize(), queue='archive')
+            if item is None:
+                break
+            path, arcname = item
+            try:
+                crc = self._crc(path)
+                if self.entries.get(arcname) == crc:
+                    continue
+                if arcname in self.entries:
+                    # the file changed since it was added, the old entry is dropped when the archive is closed
+                    self._rebuild = True
+                stored = Path(path).suffix.lower() in STORED_SUFFIXES
+                with warnings.catch_warnings():
+                    warnings.filterwarnings('ignore', message='Duplicate name')
+                    self.zf.write(path, arcname,
+                                  compress_type=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED,
+                                  compresslevel=None if stored else self.compresslevel)
+                self.entries[arcname] = crc
+            except Exception as e:
+                self._error = e
+
+    def add(self, paths):
+        """
+        Queues files to be added to the archive.
+
+        :param paths: (str or list of str) paths of files inside the month directory
+        """
+        if isinstance(paths, (str, os.PathLike)):
+            paths = [paths]
+        for path in paths:
+            arcname = archive_name(self.year_month, self._arcname(path))
+            if arcname is not None and self._included(arcname):
+                self._queue.put((str(path), arcname))
+        metrics.set_gauge('pipeline_queue_depth', self._queue.qsize(), queue='archive')
+
+    def add_tree(self, directory=None):
+        """
+        Queues every file in a directory (the whole month by default) that is not in the archive yet.
+
+        :param directory: (optional str) directory inside the month directory
+        """
+        directory = directory or self.year_month
+        self.add(sorted(p for p in Path(directory).rglob('*') if p.is_file()))
+
+    def _drop_replaced(self):
+        """
+        Rewrites the archive keeping only the latest entry of each file.
+        """
+        tmp_path = f'{self.zip_path}.part'
+        with zipfile.ZipFile(self.zip_path, 'r') as zin, zipfile.ZipFile(tmp_path, 'w') as zout:
+            latest = {info.filename: info for info in zin.infolist()}
+            for info in latest.values():
+                zout.writestr(info, zin.read(info), compress_type=info.compress_type)
+        os.replace(tmp_path, self.zip_path)
+
+    def close(self):
+        """
+        Waits for every queued file to be written and finishes the archive.
+
+        :returns: path of the zip
+        """
+        self._queue.put(None)
+        self._writer.join()
+        self.zf.close()
+        if self._rebuild:
+            self._drop_replaced()
+        if self._error is not None:
+            raise self._error
+        return self.zip_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def zip_directory(dirName, include_intermediate=False):
     """
-    Creates a compressed copy of the given directory.
+    Creates a compressed copy of the given directory. Files that were already added to
+    the archive while the reports were made are not added again.
 
     :param dirName: (str) the name of the directory to zip
+    :param include_intermediate: (optional bool) True if intermediate data (e.g. qaq_cleaned_data) should be included
     :returns: none, makes a zipped directory file
     """
-    shutil.make_archive(f'zips/{dirName}', 'zip', dirName)
+    with ArchiveBuilder(dirName, append=True, include_intermediate=include_intermediate) as archive:
+        archive.add_tree()
 
 
 if __name__ == '__main__':
@@ -6,7 +6,6 @@ Class for creating timeplots to show air quality trends throughout the month
 on a minute (sampling) basis.
 """
 
-from IPython.core.pylabtools import figsize
 from matplotlib.offsetbox import AnchoredText
 import matplotlib.pyplot as plt
 